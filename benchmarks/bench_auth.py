@@ -0,0 +1,62 @@
+### Per-request authentication cost (get_verified_user incl. HMAC check),
+### uncached user lookup vs. the user cache
+###
+### usage: python benchmarks/bench_auth.py [--iterations 20000]
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'server'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault("FE_RATE_LIMIT", "0")     # measure the verification, not admission.py
+import cache
+import database as db
+import main_server
+import shared.datatypes as t
+import shared.signature as s
+
+
+def measure(iterations: int) -> float:
+    signature = s.sign_message("alice", "FTCH", "secret")
+    start = time.perf_counter()
+    for _ in range(iterations):
+        user = main_server.get_verified_user("alice", "FTCH", signature)
+    elapsed = time.perf_counter() - start
+    assert user.verified
+    return elapsed / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="auth cost with and without the user cache")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    main_server.VERIFICATION_REQUIRED = True
+    with tempfile.TemporaryDirectory() as tmp:
+        with contextlib.redirect_stdout(io.StringIO()):
+            db.DB_PATH = os.path.join(tmp, "bench.db")
+            db.create_tables()
+            for i in range(1000):
+                db.register_user(t.User(False, f"user{i}", "secret", False))
+            db.register_user(t.User(False, "alice", "secret", False))
+
+        configured = db.user_cache
+        db.user_cache = cache.TTLCache(0, 0)  # stores nothing
+        uncached = measure(args.iterations)
+        db.user_cache = cache.TTLCache(configured.maxsize, configured.ttl)
+        cached = measure(args.iterations)
+        db.close_connection()
+
+    print(f"{args.iterations} verifications")
+    print(f"uncached  {uncached:8.2f} us/request")
+    print(f"cached    {cached:8.2f} us/request  ({uncached / cached:.1f}x faster)")
+    print(f"cache     {db.user_cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
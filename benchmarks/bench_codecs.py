@@ -0,0 +1,76 @@
+### Encode/decode time and size of a 10k message mailbox per wire codec
+###
+### usage: python benchmarks/bench_codecs.py [--messages 10000] [--repeat 5]
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import shared.codec as c
+import shared.datatypes as t
+
+
+def old_encode(messages: t.Messages) -> bytes:
+    return json.dumps(messages.to_dict()).encode("utf-8")
+
+def old_decode(data: bytes) -> t.Messages:
+    """What Messages.deserialize did before: parse, re-encode every element, parse it again."""
+    return t.Messages([t.Message.deserialize(json.dumps(m)) for m in json.loads(data)])
+
+
+def build(count: int) -> t.Messages:
+    return t.Messages([
+        t.Message(i, f"user{i % 50}", f"user{(i + 1) % 50}", 1700000000 + i,
+                  f"message preview number {i} with some text"[:50], "FETXT", None, 0)
+        for i in range(count)
+    ])
+
+
+def timed(fn, repeat: int) -> tuple[float, object]:
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="wire codec benchmark")
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    messages = build(args.messages)
+    orjson = c.orjson
+    print(f"{args.messages} message headers, best of {args.repeat}")
+    print(f"{'codec':<28} {'encode ms':>10} {'decode ms':>10} {'bytes':>10}")
+
+    def report(label, encode, decode):
+        enc_ms, data = timed(encode, args.repeat)
+        dec_ms, decoded = timed(lambda: decode(data), args.repeat)
+        assert len(decoded) == args.messages
+        print(f"{label:<28} {enc_ms:>10.1f} {dec_ms:>10.1f} {len(data):>10}")
+
+    report("json, double parse (old)", lambda: old_encode(messages), old_decode)
+
+    c.orjson = None
+    report("json (stdlib)", lambda: messages.encode(c.JSON), lambda d: t.Messages.decode(d, c.JSON))
+    c.orjson = orjson
+
+    if orjson is not None:
+        report("json (orjson)", lambda: messages.encode(c.JSON), lambda d: t.Messages.decode(d, c.JSON))
+    else:
+        print("json (orjson)                not installed")
+
+    if c.MSGPACK is not None:
+        report("msgpack", lambda: messages.encode(c.MSGPACK), lambda d: t.Messages.decode(d, c.MSGPACK))
+    else:
+        print("msgpack                      not installed")
+
+
+if __name__ == "__main__":
+    main()
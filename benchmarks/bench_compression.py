@@ -0,0 +1,103 @@
+### Size ratio and CPU cost of each content coding on typical payloads
+###
+### Text, server logs, CSV, a /fetch JSON answer and random bytes (stand-in for
+### zip / jpeg contents, which are stored and sent as they are).
+###
+### usage: python benchmarks/bench_compression.py [--size 1048576] [--repeat 5]
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import shared.compression as z
+
+WORDS = ("the message was sent to every receiver of the group and read shortly after "
+         "server client upload download file chunk retry offset mailbox cursor").split()
+
+
+def text_sample(size: int, rng: random.Random) -> bytes:
+    out, length = [], 0
+    while length < size:
+        line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 16))).capitalize() + ".\n"
+        out.append(line)
+        length += len(line)
+    return "".join(out).encode()[:size]
+
+def log_sample(size: int, rng: random.Random) -> bytes:
+    out, length, ts = [], 0, 1700000000.0
+    while length < size:
+        ts += rng.random()
+        line = (f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts))},{int(ts % 1 * 1000):03d} INFO    werkzeug: "
+                f"127.0.0.1 - - \"GET /fetch?sender_id=user{rng.randint(0, 99)}&cursor={rng.randint(0, 10**6)} HTTP/1.1\" "
+                f"{rng.choice((200, 200, 200, 304, 404))} -\n")
+        out.append(line)
+        length += len(line)
+    return "".join(out).encode()[:size]
+
+def csv_sample(size: int, rng: random.Random) -> bytes:
+    out, length, i = ["id,sender,receiver,timestamp,size,type\n"], 0, 0
+    while length < size:
+        line = f"{i},user{rng.randint(0, 99)},user{rng.randint(0, 99)},{1700000000 + i * 7},{rng.randint(0, 10**7)},text/plain\n"
+        out.append(line)
+        length += len(line)
+        i += 1
+    return "".join(out).encode()[:size]
+
+def json_sample(size: int, rng: random.Random) -> bytes:
+    messages, length, i = [], 0, 0
+    while length < size:
+        m = {"id": i, "sender_id": f"user{rng.randint(0, 99)}", "receiver_id": "user1", "timestamp": 1700000000 + i,
+             "file_name": text_sample(rng.randint(10, 50), rng).decode(), "file_type": "FETXT",
+             "file_contents": None, "queue_deletion": 0}
+        messages.append(m)
+        length += 150
+        i += 1
+    return json.dumps(messages).encode()
+
+def random_sample(size: int, rng: random.Random) -> bytes:
+    return rng.randbytes(size)
+
+SAMPLES = {
+    "text": text_sample,
+    "log": log_sample,
+    "csv": csv_sample,
+    "json (/fetch)": json_sample,
+    "random (zip/jpeg)": random_sample,
+}
+
+
+def timed(fn, repeat: int) -> tuple[float, object]:
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="content coding benchmark")
+    parser.add_argument("--size", type=int, default=1024 * 1024, help="bytes per sample")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print(f"~{args.size} byte samples, best of {args.repeat}, codings: {', '.join(z.CODINGS)}")
+    print(f"{'sample':<18} {'coding':<6} {'ratio':>7} {'compress MB/s':>14} {'decompress MB/s':>16}")
+    for label, make in SAMPLES.items():
+        data = make(args.size, rng)
+        mb = len(data) / 1024 ** 2
+        for coding in z.CODINGS.values():
+            comp_s, compressed = timed(lambda: coding.compress(data), args.repeat)
+            dec_s, restored = timed(lambda: coding.decompress(compressed), args.repeat)
+            assert restored == data
+            print(f"{label:<18} {coding.name:<6} {len(data) / len(compressed):>6.2f}x "
+                  f"{mb / comp_s:>14.0f} {mb / dec_s:>16.0f}")
+
+
+if __name__ == "__main__":
+    main()
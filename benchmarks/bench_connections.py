@@ -0,0 +1,111 @@
+### Requests/sec of concurrent /fetch and /send_message traffic,
+### per-call connections (old behaviour) vs. the pooled thread-local connections
+###
+### usage: python benchmarks/bench_connections.py [--threads 8] [--requests 500]
+
+import argparse
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'server'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault("FE_RATE_LIMIT", "0")     # measure the database work, not admission.py
+import database as db
+import main_server
+import shared.datatypes as t
+
+USERS = ["alice", "bob", "carol", "dave"]
+
+_opened = threading.local()
+
+
+def unpooled_connection(path=None):
+    """What every database function did before: a fresh connection without the tuning pragmas."""
+    conn = sqlite3.connect(path or db.DB_PATH)
+    _opened.conns = getattr(_opened, "conns", []) + [conn]
+    return conn
+
+def close_unpooled():
+    """Close the per-call connections of the last request, as the old code did after every call"""
+    for conn in getattr(_opened, "conns", []):
+        conn.close()
+    _opened.conns = []
+
+
+def setup_database(path: str, seed_messages: int):
+    db.DB_PATH = path
+    db.create_tables()
+    for name in USERS:
+        db.register_user(t.User(False, name, "secret", False))
+    for i in range(seed_messages):
+        sender, receiver = USERS[i % len(USERS)], USERS[(i + 1) % len(USERS)]
+        db.save_message(t.Message(0, sender, receiver, i, f"seed message {i}", "FETXT", None, False))
+
+
+def worker(requests: int, index: int, barrier: threading.Barrier):
+    client = main_server.app.test_client()
+    user = USERS[index % len(USERS)]
+    barrier.wait()
+    for i in range(requests):
+        if i % 2:
+            response = client.get("/fetch", query_string={"sender_id": user, "signature": "x"})
+        else:
+            response = client.post("/send_message", json={
+                "sender_id": user,
+                "receiver_id": USERS[(index + 1) % len(USERS)],
+                "signature": "x",
+                "message_text": f"benchmark message {i}",
+            })
+        # /fetch streams its answer, the database work happens while the body is read
+        response.data
+        response.close()
+        close_unpooled()
+    db.close_connection()
+
+
+def run(label: str, threads: int, requests: int, seed_messages: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        # the server prints on every request, keep that out of the output
+        with contextlib.redirect_stdout(io.StringIO()):
+            setup_database(os.path.join(tmp, "bench.db"), seed_messages)
+            barrier = threading.Barrier(threads + 1)
+            pool = [threading.Thread(target=worker, args=(requests, i, barrier)) for i in range(threads)]
+            for th in pool:
+                th.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for th in pool:
+                th.join()
+            elapsed = time.perf_counter() - start
+            db.close_connection()
+
+    total = threads * requests
+    print(f"{label:<10} {total:>7} requests in {elapsed:6.2f}s  -> {total / elapsed:8.1f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pooled vs per-call sqlite connections")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=500, help="requests per thread")
+    parser.add_argument("--seed", type=int, default=200, help="messages in the database before the run")
+    args = parser.parse_args()
+
+    print(f"{args.threads} threads x {args.requests} requests, 50% /fetch 50% /send_message")
+
+    pooled = db.get_connection
+    db.get_connection = unpooled_connection
+    try:
+        run("per-call", args.threads, args.requests, args.seed)
+    finally:
+        db.get_connection = pooled
+    run("pooled", args.threads, args.requests, args.seed)
+
+
+if __name__ == "__main__":
+    main()
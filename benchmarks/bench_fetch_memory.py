@@ -0,0 +1,126 @@
+### Peak memory (tracemalloc) of fetching a large mailbox:
+### fetchall() into per-row Message objects with a __dict__ (before) vs. the columnar Messages (after)
+###
+### usage: python benchmarks/bench_fetch_memory.py [--messages 100000]
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'server'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import database as db
+import shared.datatypes as t
+
+TARGET = "alice"
+
+
+class DictMessage:
+    """Message as it was before __slots__: one __dict__ per instance"""
+    def __init__(self, message_id, sender_id, receiver_id, timestamp,
+                 file_name, file_type, file_contents, queue_deletion):
+        self.message_id = message_id
+        self.sender_id = sender_id
+        self.receiver_id = receiver_id
+        self.timestamp = timestamp
+        self.file_name = file_name
+        self.file_type = file_type
+        self.file_contents = file_contents
+        self.queue_deletion = queue_deletion
+
+
+def fetch_before(user: t.User) -> list:
+    """The old fetch_messages_for_user: fetchall() then one object per row, kept in a list"""
+    query = """
+    SELECT id, sender_id, receiver_id, timestamp, file_name, file_type, queue_deletion
+    FROM messages
+    WHERE receiver_id = ?
+    UNION ALL
+    SELECT id, sender_id, receiver_id, timestamp, file_name, file_type, queue_deletion
+    FROM messages
+    WHERE sender_id = ? AND receiver_id <> ?
+    ORDER BY timestamp ASC
+    """
+    rows = db.get_connection().execute(query, (user.name, user.name, user.name)).fetchall()
+    return [
+        DictMessage(row[0], row[1], row[2], row[3], row[4][:50] if row[4] else None, row[5], None, row[6])
+        for row in rows
+    ]
+
+
+def to_dict_before(messages: list) -> list[dict]:
+    return [{
+        "id": m.message_id,
+        "sender_id": m.sender_id,
+        "receiver_id": m.receiver_id,
+        "timestamp": m.timestamp,
+        "file_name": m.file_name,
+        "file_type": m.file_type,
+        "file_contents": m.file_contents,
+        "queue_deletion": m.queue_deletion
+    } for m in messages]
+
+
+def fetch_after(user: t.User) -> t.Messages:
+    return db.fetch_messages_for_user(user)
+
+
+def seed(conn, count: int):
+    senders = [f"user{i}" for i in range(50)]
+    with conn:
+        conn.executemany("""
+            INSERT INTO messages (sender_id, receiver_id, timestamp, file_name, file_type, queue_deletion,
+                                  preview, content_length, content_kind)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, ((senders[i % 50], TARGET, 1700000000 + i, f"message preview number {i}", "FETXT", 0,
+               f"message preview number {i}", len(f"message preview number {i}"), "text")
+              for i in range(count)))
+
+
+def peak(fn) -> tuple[float, float, int]:
+    """Peak traced MiB of one call, and its time in ms from a second, untraced call"""
+    gc.collect()
+    tracemalloc.start()
+    count = len(fn())
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+    start = time.perf_counter()
+    fn()
+    return peak_bytes / 2**20, (time.perf_counter() - start) * 1000, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="peak memory of a large mailbox fetch")
+    parser.add_argument("--messages", type=int, default=100000)
+    args = parser.parse_args()
+
+    user = t.User(True, TARGET, "secret", False)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        db.create_tables()
+        conn = db.get_connection()
+        conn.execute("PRAGMA foreign_keys = OFF")  # the seeded users don't exist
+        seed(conn, args.messages)
+        fetch_after(user)  # warm the page cache and statement cache
+
+        print(f"{args.messages} message headers")
+        print(f"{'':<32} {'peak MiB':>9} {'ms':>8}")
+        for label, fn in (("fetchall + __dict__ objects", lambda: fetch_before(user)),
+                          ("columnar Messages.from_cursor", lambda: fetch_after(user)),
+                          ("before, then to_dict", lambda: to_dict_before(fetch_before(user))),
+                          ("after, then to_dict", lambda: fetch_after(user).to_dict())):
+            mib, ms, count = peak(fn)
+            assert count == args.messages
+            print(f"{label:<32} {mib:>9.1f} {ms:>8.1f}")
+
+        db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
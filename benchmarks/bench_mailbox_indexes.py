@@ -0,0 +1,101 @@
+### Mailbox fetch latency as the messages table grows:
+### the old OR query on an unindexed table vs. the indexed UNION query
+###
+### usage: python benchmarks/bench_mailbox_indexes.py [--rows 1000000]
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'server'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import database as db
+import shared.datatypes as t
+
+OLD_QUERY = """
+SELECT id, sender_id, receiver_id, timestamp, file_name, file_type, queue_deletion
+FROM messages
+WHERE receiver_id = ? OR sender_id = ?
+ORDER BY timestamp ASC
+"""
+
+INDEXES = {
+    "idx_messages_receiver_headers": """CREATE INDEX idx_messages_receiver_headers ON messages
+        (receiver_id, id, sender_id, timestamp, preview, file_type, queue_deletion, content_length, content_kind)""",
+    "idx_messages_sender_headers": """CREATE INDEX idx_messages_sender_headers ON messages
+        (sender_id, id, receiver_id, timestamp, preview, file_type, queue_deletion, content_length, content_kind)""",
+}
+
+TARGET = "alice"            # the user whose mailbox gets fetched
+MAILBOX = 50                # messages sent to / by TARGET, the same at every table size
+POPULATION = 10000          # other users the table is filled with
+
+
+def seed(conn, start: int, stop: int):
+    rnd = random.Random(start)
+
+    def rows():
+        for i in range(start, stop):
+            if i < MAILBOX:
+                sender, receiver = ("bob", TARGET) if i % 2 else (TARGET, "bob")
+            else:
+                sender, receiver = f"u{rnd.randrange(POPULATION)}", f"u{rnd.randrange(POPULATION)}"
+            text = f"message number {i}"
+            yield (sender, receiver, i, text, "FETXT", None, 0, text, len(text), "text")
+
+    with conn:
+        conn.executemany("""
+            INSERT INTO messages (sender_id, receiver_id, timestamp, file_name, file_type, file_contents, queue_deletion,
+                                  preview, content_length, content_kind)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows())
+
+
+def measure(fn, repeat: int) -> float:
+    fn()  # warm the page cache
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mailbox fetch latency vs table size")
+    parser.add_argument("--rows", type=int, default=1000000, help="final table size")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    sizes = [s for s in (10000, 100000, 1000000, 10000000) if s < args.rows] + [args.rows]
+    user = t.User(True, TARGET, "secret", False)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        db.create_tables()
+        conn = db.get_connection()
+        conn.execute("PRAGMA foreign_keys = OFF")  # the seeded users don't exist
+
+        print(f"{'rows':>10} {'mailbox':>8} {'OR, no index':>14} {'UNION, indexed':>16}")
+        seeded = 0
+        for size in sizes:
+            for name in INDEXES:
+                conn.execute(f"DROP INDEX IF EXISTS {name}")
+            seed(conn, seeded, size)
+            seeded = size
+
+            old = measure(lambda: conn.execute(OLD_QUERY, (TARGET, TARGET)).fetchall(), args.repeat)
+
+            for sql in INDEXES.values():
+                conn.execute(sql)
+            new = measure(lambda: db.fetch_messages_for_user(user), args.repeat)
+
+            mailbox = len(db.fetch_messages_for_user(user))
+            print(f"{size:>10} {mailbox:>8} {old:>11.3f} ms {new:>13.3f} ms")
+
+        db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
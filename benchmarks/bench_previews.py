@@ -0,0 +1,76 @@
+### Mailbox fetch time for long text messages:
+### substr(file_name, 1, 50) on the message rows (before) vs. the precomputed
+### preview columns read from the covering header indexes (after)
+###
+### usage: python benchmarks/bench_previews.py [--messages 5000] [--text-size 20000]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'server'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import database as db
+import shared.datatypes as t
+
+TARGET = "alice"
+
+OLD_QUERY = """
+SELECT id, sender_id, receiver_id, timestamp, substr(file_name, 1, 50), file_type, queue_deletion
+FROM messages INDEXED BY idx_old_receiver
+WHERE receiver_id = ?
+ORDER BY id ASC
+"""
+
+
+def seed(conn, count: int, text_size: int):
+    text = ("lorem ipsum dolor sit amet " * (text_size // 27 + 1))[:text_size]
+    with conn:
+        conn.executemany("""
+            INSERT INTO messages (sender_id, receiver_id, timestamp, file_name, file_type, queue_deletion,
+                                  preview, content_length, content_kind)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, ((f"user{i % 50}", TARGET, 1700000000 + i, f"{i} {text}", "FETXT", 0,
+               f"{i} {text}"[:db.PREVIEW_LENGTH], text_size, "text")
+              for i in range(count)))
+        # what the old queries ran on: an index on (receiver_id, id) only
+        conn.execute("CREATE INDEX idx_old_receiver ON messages (receiver_id, id)")
+
+
+def measure(fn, repeat: int) -> float:
+    fn()  # warm the page cache
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mailbox fetch with long text messages")
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--text-size", type=int, default=20000, help="characters per message")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    user = t.User(True, TARGET, "secret", False)
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        db.create_tables()
+        conn = db.get_connection()
+        conn.execute("PRAGMA foreign_keys = OFF")  # the seeded users don't exist
+        seed(conn, args.messages, args.text_size)
+
+        old = measure(lambda: conn.execute(OLD_QUERY, (TARGET,)).fetchall(), args.repeat)
+        new = measure(lambda: db.fetch_messages_for_user(user), args.repeat)
+        print(f"{args.messages} messages of {args.text_size} characters, best of {args.repeat}")
+        print(f"substr(file_name) on the rows   {old:>9.1f} ms")
+        print(f"preview from covering index     {new:>9.1f} ms")
+        db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+### Search latency with the FTS5 index vs. what finding a message took before:
+### download the whole mailbox and scan the 50 character previews
+###
+### usage: python benchmarks/bench_search.py [--messages 1000000] [--users 1000]
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'server'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import database as db
+import shared.datatypes as t
+
+COMMON = ("the a to and of is in for on it you that this with be at we are have can "
+          "meeting report lunch deploy server backup holiday budget review draft").split()
+RARE = 20000  # further words, each one is rarer than the one before (Zipf-like)
+
+
+def seed(conn, count: int, users: int):
+    rnd = random.Random(1)
+    vocabulary = COMMON + [f"w{i}" for i in range(RARE)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+
+    def rows():
+        for i in range(count):
+            text = " ".join(rnd.choices(vocabulary, cum_weights=cum_weights, k=rnd.randint(5, 30)))
+            yield (f"u{rnd.randrange(users)}", f"u{rnd.randrange(users)}", 1700000000 + i, text, "FETXT", 0,
+                   text[:db.PREVIEW_LENGTH], len(text), "text")
+
+    with conn:
+        conn.executemany("""
+            INSERT INTO messages (sender_id, receiver_id, timestamp, file_name, file_type, queue_deletion,
+                                  preview, content_length, content_kind)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows())
+
+
+def measure(fn, repeat: int) -> tuple[float, object]:
+    result = fn()  # warm the page cache
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="full-text search latency")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    user = t.User(True, "u1", "secret", False)
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        db.create_tables()
+        conn = db.get_connection()
+        conn.execute("PRAGMA foreign_keys = OFF")  # the seeded users don't exist
+        started = time.perf_counter()
+        seed(conn, args.messages, args.users)
+        print(f"{args.messages} messages, {args.users} users, seeded and indexed in {time.perf_counter() - started:.1f}s")
+
+        # before: the whole mailbox, matched against the previews (all the client ever had)
+        def scan(word):
+            return [m for m in db.fetch_messages_for_user(user) if word in (m.file_name or "")]
+
+        mailbox = len(db.fetch_messages_for_user(user))
+        print(f"mailbox of {user.name}: {mailbox} messages")
+        print(f"{'query':<22} {'fetch + scan':>14} {'FTS5 search':>13} {'hits':>6}")
+        for query in ("meeting", "w150", "w2000 w30", "w12*"):
+            old, _ = measure(lambda: scan(query.split()[0].rstrip("*")), args.repeat)
+            new, (messages, _) = measure(lambda: db.search_messages(user, query, 20), args.repeat)
+            print(f"{query:<22} {old:>11.2f} ms {new:>10.2f} ms {len(messages):>6}")
+        db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
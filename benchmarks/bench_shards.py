@@ -0,0 +1,85 @@
+### Message inserts/sec from concurrent senders by number of shard files:
+### every shard has its own write lock, WAL, writer thread and message ids
+### (shards.allocate_ids), so commits of different shards run side by side.
+### The gain depends on the disk (fsyncs in parallel) and the CPUs available
+###
+### usage: python benchmarks/bench_shards.py [--shards 1,2,4,8] [--threads 32] [--messages 200]
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'server'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import database as db
+import shards
+import writer
+import shared.datatypes as t
+
+
+def run(count: int, threads: int, messages: int, users: int, directory: str | None) -> float:
+    with tempfile.TemporaryDirectory(dir=directory) as tmp, contextlib.redirect_stdout(io.StringIO()):
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        shards.SHARDS = count
+        shards.route_cache.clear()
+        db.create_tables()
+        names = [f"user{i}" for i in range(users)]
+        for name in names:
+            db.register_user(t.User(False, name, "secret", False))
+
+        barrier = threading.Barrier(threads + 1)
+
+        def sender(index):
+            rnd = random.Random(index)
+            barrier.wait()
+            for i in range(messages):
+                message = t.Message(0, names[index % users], rnd.choice(names), i, f"message {index}/{i}", "FETXT", None, False)
+                assert db.save_message(message) is not None
+            db.close_connection()
+
+        pool = [threading.Thread(target=sender, args=(i,)) for i in range(threads)]
+        for th in pool:
+            th.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for th in pool:
+            th.join()
+        elapsed = time.perf_counter() - start
+
+        stored = sum(conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] for conn in db.shard_connections())
+        writer.close_writer()
+        db.close_connection()
+
+    total = threads * messages
+    assert stored == total, f"{count} shards: {stored} of {total} messages stored"
+    return total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="concurrent write throughput vs shard count")
+    parser.add_argument("--shards", default="1,2,4,8", help="comma separated shard counts")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--messages", type=int, default=200, help="messages per thread")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--dir", default=None, help="where to put the database files (default: the temp dir, "
+                                                     "use a directory on the disk you deploy on)")
+    args = parser.parse_args()
+
+    counts = [int(c) for c in args.shards.split(",")]
+    print(f"{args.threads} threads x {args.messages} messages to {args.users} receivers, "
+          f"writer synchronous={writer.SYNCHRONOUS}, {os.cpu_count()} CPU(s)")
+    base = None
+    for count in counts:
+        rate = run(count, args.threads, args.messages, args.users, args.dir)
+        base = base or rate
+        print(f"{count:>3} shard(s) {rate:10.1f} inserts/s  x{rate / base:.2f}")
+
+
+if __name__ == "__main__":
+    main()
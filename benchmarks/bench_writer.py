@@ -0,0 +1,88 @@
+### Message inserts/sec from concurrent senders:
+### one transaction per save_message vs. the group-committing writer thread
+###
+### usage: python benchmarks/bench_writer.py [--threads 16] [--messages 500]
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'server'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import database as db
+import writer
+import shared.datatypes as t
+
+INSERT = """
+INSERT INTO messages (sender_id, receiver_id, timestamp, file_name, file_type, blob_hash, blob_size, queue_deletion)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def insert_per_call(message: t.Message):
+    """What save_message did before: its own transaction and commit for every message."""
+    conn = db.get_connection()
+    conn.execute(INSERT, (message.sender_id, message.receiver_id, message.timestamp,
+                          message.file_name, message.file_type, None, None, False))
+    conn.commit()
+
+
+def run(label: str, save, threads: int, messages: int, synchronous: str):
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        db.PRAGMAS = tuple((k, synchronous if k == "synchronous" else v) for k, v in db.PRAGMAS)
+        db.create_tables()
+        db.register_user(t.User(False, "alice", "secret", False))
+        db.register_user(t.User(False, "bob", "secret", False))
+
+        barrier = threading.Barrier(threads + 1)
+
+        def sender(index):
+            barrier.wait()
+            for i in range(messages):
+                save(t.Message(0, "alice", "bob", i, f"message {index}/{i}", "FETXT", None, False))
+            db.close_connection()
+
+        pool = [threading.Thread(target=sender, args=(i,)) for i in range(threads)]
+        for th in pool:
+            th.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for th in pool:
+            th.join()
+        elapsed = time.perf_counter() - start
+
+        count = db.get_connection().execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        writer.close_writer()
+        db.close_connection()
+
+    total = threads * messages
+    assert count == total, f"{label}: {count} of {total} messages stored"
+    print(f"{label:<32} {total:>7} inserts in {elapsed:6.2f}s  -> {total / elapsed:9.1f} inserts/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="per-call commits vs group commit")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=500, help="messages per thread")
+    args = parser.parse_args()
+
+    print(f"{args.threads} threads x {args.messages} messages")
+    defaults = db.PRAGMAS
+    try:
+        run("per-call, synchronous=NORMAL", insert_per_call, args.threads, args.messages, "NORMAL")
+        db.PRAGMAS = defaults
+        run("per-call, synchronous=FULL", insert_per_call, args.threads, args.messages, "FULL")
+        db.PRAGMAS = defaults
+        run(f"group commit, synchronous={writer.SYNCHRONOUS}", db.save_message, args.threads, args.messages, "NORMAL")
+    finally:
+        db.PRAGMAS = defaults
+
+
+if __name__ == "__main__":
+    main()
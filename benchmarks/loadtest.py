@@ -0,0 +1,131 @@
+### Latency under many concurrent connections: threaded (werkzeug) vs asgi mode,
+### one server process vs --workers N (prefork.py)
+###
+### Starts the server in each mode on a temporary database, then opens
+### --concurrency connections at once and keeps that many requests in flight
+### (mixed /fetch and /send_message) until --requests have completed.
+###
+### usage: python benchmarks/loadtest.py [--concurrency 1000] [--requests 10000] [--modes threaded asgi] [--workers 1 4 16]
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+SERVER = os.path.join(os.path.dirname(__file__), '..', 'server')
+sys.path.append(SERVER)
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import database as db
+import shared.datatypes as t
+
+USERS = ["alice", "bob", "carol", "dave"]
+REQUEST_TIMEOUT = 60
+
+
+def prepare_database(path: str):
+    db.DB_PATH = path
+    db.create_tables()
+    for name in USERS:
+        db.register_user(t.User(False, name, "secret", False))
+    for i in range(100):
+        db.save_message(t.Message(0, USERS[i % 4], USERS[(i + 1) % 4], i, f"seed {i}", "FETXT", None, False))
+    db.close_connection()
+
+
+def start_server(mode: str, port: int, tmp: str, workers: int = 1) -> subprocess.Popen:
+    # FE_RATE_LIMIT=0: every request comes from a handful of senders, measure the server, not admission.py
+    env = dict(os.environ, FE_DB_PATH=os.path.join(tmp, "load.db"), FE_BLOB_DIR=os.path.join(tmp, "blobs"), FE_RATE_LIMIT="0")
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(SERVER, "main_server.py"), "--mode", mode, "--port", str(port), "--workers", str(workers)],
+        cwd=tmp, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/healthcheck", timeout=1)
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"server in {mode} mode didn't come up")
+
+
+def build_request(i: int, port: int) -> bytes:
+    user = USERS[i % len(USERS)]
+    if i % 2:
+        path = f"/fetch?sender_id={user}&signature=x&cursor=90"
+        return f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nConnection: close\r\n\r\n".encode()
+    body = json.dumps({"sender_id": user, "receiver_id": USERS[(i + 1) % 4], "signature": "x", "message_text": f"load {i}"})
+    return (f"POST /send_message HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nConnection: close\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n{body}").encode()
+
+
+async def one_request(i: int, port: int) -> tuple[float, bool]:
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), REQUEST_TIMEOUT)
+        writer.write(build_request(i, port))
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), REQUEST_TIMEOUT)
+        writer.close()
+        ok = response.startswith(b"HTTP/1.1 200") or response.startswith(b"HTTP/1.0 200")
+    except (OSError, asyncio.TimeoutError):
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+async def load(port: int, concurrency: int, requests: int):
+    latencies, errors = [], 0
+    counter = iter(range(requests))
+
+    async def client():
+        nonlocal errors
+        for i in counter:
+            latency, ok = await one_request(i, port)
+            latencies.append(latency)
+            errors += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100)[p - 1] if len(values) > 1 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="p50/p99 latency per server mode")
+    parser.add_argument("--concurrency", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asgi"])
+    parser.add_argument("--workers", nargs="+", type=int, default=[1], help="worker process counts to compare")
+    parser.add_argument("--port", type=int, default=26900)
+    args = parser.parse_args()
+
+    print(f"{args.concurrency} concurrent connections, {args.requests} requests (50% /fetch?cursor, 50% /send_message)")
+    print(f"{os.cpu_count()} CPU(s)")
+    print(f"{'mode':<10} {'workers':>7} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'errors':>7}")
+    for mode in args.modes:
+        for workers in args.workers:
+            with tempfile.TemporaryDirectory() as tmp:
+                prepare_database(os.path.join(tmp, "load.db"))
+                proc = start_server(mode, args.port, tmp, workers)
+                try:
+                    latencies, errors, elapsed = asyncio.run(load(args.port, args.concurrency, args.requests))
+                finally:
+                    proc.terminate()
+                    proc.wait(timeout=60)
+            ms = [l * 1000 for l in latencies]
+            print(f"{mode:<10} {workers:>7} {len(ms) / elapsed:>8.1f} {percentile(ms, 50):>9.1f} "
+                  f"{percentile(ms, 99):>9.1f} {max(ms):>9.1f} {errors:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,176 @@
 import click
 import requests
+import base64
+import email.message
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+from shared import signature as s
+from shared import codec
+from shared import compression
 from config.manager import ConfigManager
 
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+FETCH_CHUNK_SIZE = 64 * 1024    # read size of a streamed /fetch
+UPLOAD_RETRIES = 5  # attempts per chunk before giving up, resuming from the server's offset each time
+READ_BATCH_SIZE = 500   # messages per /read_many request
+CONCURRENCY = 8     # parallel requests for multi-recipient sends and bulk reads (config: "concurrency")
+RETRIES = 3         # retries of failed connections and 429/502/503/504 answers, with exponential backoff
+RETRY_BACKOFF = 0.5 # seconds, doubled with every retry (a Retry-After from the server wins)
+
 class FeApiClient:
-    def __init__(self, config_manager=None):
+    def __init__(self, config_manager=None, concurrency=None):
         if config_manager is None:
             config_manager = ConfigManager()
         self.config = config_manager.config
         self.base_url = f"http://{self.config['server_ip']}:{self.config['server_port']}"
+        # pending uploads, so a rerun of an interrupted `fe send` resumes instead of starting over
+        self.uploads_path = os.path.join(os.path.dirname(config_manager.config_path), "uploads.json")
+        self.concurrency = max(1, int(concurrency or self.config.get("concurrency", CONCURRENCY)))
+        self.session = new_session(self.concurrency)
+        # the server's rate limits are per sender, also for requests that carry it only in the body
+        self.session.headers["X-Fe-Sender"] = self.config.get("sender_name", "unknown")
+        # coding for request bodies, gzip until the server's Accept-Encoding tells otherwise
+        self.body_coding = compression.GZIP
+        self.session.hooks["response"].append(self._learn_codings)
+
+    def _learn_codings(self, response, *args, **kwargs):
+        accepted = response.headers.get("Accept-Encoding")
+        if accepted is not None:
+            self.body_coding = compression.negotiate(accepted)
+
+    def post_json(self, url, data, **kwargs):
+        """
+        POST data as JSON, bodies of MIN_SIZE and more are compressed.
+        A server that doesn't take compressed bodies (415) gets it again uncompressed.
+        """
+        body = json.dumps(data).encode("utf-8")
+        headers = {"Content-Type": codec.JSON.mimetype}
+        coding = self.body_coding
+        if coding is not None and len(body) >= compression.MIN_SIZE:
+            response = self.session.post(url, data=coding.compress(body),
+                                         headers={**headers, "Content-Encoding": coding.name}, **kwargs)
+            if response.status_code != 415:
+                return response
+            self.body_coding = None
+        return self.session.post(url, data=body, headers=headers, **kwargs)
+
+    def run_parallel(self, fn, items, label=None):
+        """
+        Call fn(item) for every item on up to `concurrency` threads, sharing the session's
+        keep-alive connections. Returns [(item, result or the exception it raised)] in the
+        order of items. With a label a progress bar is shown on stderr.
+        """
+        items = list(items)
+
+        def call(item):
+            try:
+                return item, fn(item)
+            except Exception as e:
+                return item, e
+
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, max(1, len(items)))) as pool:
+            results = pool.map(call, items)
+            if label is None or len(items) < 2:
+                return list(results)
+            with click.progressbar(results, length=len(items), label=label, file=sys.stderr) as bar:
+                return list(bar)
+
+    def sign(self, key):
+        return s.sign_message(self.config.get("sender_name", "unknown"), key, self.config.get("auth_token", "unknown"))
 
     def healthcheck(self):
         url = f"{self.base_url}/healthcheck"
-        response = requests.get(url)
+        response = self.session.get(url)
         response.raise_for_status()
         return response.text
 
-    def fetch(self, signature=None, sender_id=None):
+    def fetch(self, signature=None, sender_id=None, cursor=None, limit=None, stream=False):
+        """
+        Without a cursor: (the whole mailbox, cursor to sync on from), with stream=True the
+        mailbox is an iterator that yields every message as soon as it has arrived.
+        With a cursor (opaque, from an earlier answer, 0 for the start): one page of newer
+        messages, returned as (messages, next_cursor, more).
+        """
         url = f"{self.base_url}/fetch"
         data = {
             "signature": signature or "unknown",
             "sender_id": sender_id or "unknown",
         }
-        response = requests.get(url, json=data)
+        headers = {"Accept": codec.accept_header()}
+        if cursor is None and stream:
+            return self._fetch_stream(url, data)
+        if cursor is None:
+            response = self.session.get(url, params=data, headers=headers)
+            response.raise_for_status()
+            return decode(response), response.headers["X-Fe-Cursor"]
+
+        data["cursor"] = cursor
+        if limit:
+            data["limit"] = limit
+        response = self.session.get(url, params=data, headers=headers)
+        response.raise_for_status()
+        return decode(response), response.headers["X-Fe-Cursor"], response.headers.get("X-Fe-More") == "1"
+
+    def search(self, query, limit=None, offset=0):
+        """
+        One page of the user's messages matching query, best match first.
+        Returns (messages, more), every message has a "snippet" of the matching text.
+        """
+        params = {
+            "signature": self.sign("SRCH"),
+            "sender_id": self.config.get("sender_name", "unknown"),
+            "q": query,
+            "offset": offset,
+        }
+        if limit:
+            params["limit"] = limit
+        response = self.session.get(f"{self.base_url}/search", params=params, headers={"Accept": codec.accept_header()})
         response.raise_for_status()
-        return response.json()
+        return decode(response), response.headers.get("X-Fe-More") == "1"
+
+    def _fetch_stream(self, url, data):
+        response = self.session.get(url, params=data, headers={"Accept": codec.JSON.mimetype}, stream=True)
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+        return self._iter_stream(response), response.headers["X-Fe-Cursor"]
+
+    def _iter_stream(self, response):
+        # the server streams JSON, the array is parsed while it is still arriving
+        with response:
+            if codec.for_content_type(response.headers.get("Content-Type")) is not codec.JSON:
+                yield from decode(response)
+                return
+            yield from codec.iter_json_array(response.iter_content(chunk_size=FETCH_CHUNK_SIZE))
+
+    def wait(self, signature=None, sender_id=None, cursor=0, timeout=30):
+        """
+        Long-poll for messages newer than cursor. Returns (messages, next_cursor, more),
+        or None if the server asks to come back later (Retry-After seconds are slept first).
+        """
+        url = f"{self.base_url}/wait"
+        data = {
+            "signature": signature or "unknown",
+            "sender_id": sender_id or "unknown",
+            "cursor": cursor,
+            "timeout": timeout
+        }
+        response = self.session.get(url, params=data, headers={"Accept": codec.accept_header()}, timeout=timeout + 15)
+        if response.status_code == 503:
+            time.sleep(float(response.headers.get("Retry-After", 5)))
+            return None
+        response.raise_for_status()
+        return decode(response), response.headers["X-Fe-Cursor"], response.headers.get("X-Fe-More") == "1"
 
     def read(self, signature=None, sender_id=None, message_id=None):
         url = f"{self.base_url}/read"
@@ -32,10 +179,118 @@ class FeApiClient:
             "sender_id": sender_id or "unknown",
             "message_id": message_id or "-1"
         }
-        response = requests.get(url, json=data)
+        response = self.session.get(url, json=data)
         response.raise_for_status()
         return response.json()
 
+    def read_many(self, sender_id, dest_dir, message_ids=None, unread=False):
+        """
+        Read several messages in one request per READ_BATCH_SIZE ids, or all unread ones.
+        Bodies are saved like download() does. Yields (message_id, result) as they arrive,
+        result is ("text", text), ("file", path) or an exception.
+        Raises requests.HTTPError with status 404 if the server has no /read_many.
+        """
+        url = f"{self.base_url}/read_many"
+        message_ids = [int(message_id) for message_id in message_ids or []]
+        after = 0
+        while True:
+            if unread:
+                data = {"unread": True, "after": after, "limit": READ_BATCH_SIZE, "signature": self.sign("UNRD")}
+            else:
+                batch, message_ids = message_ids[:READ_BATCH_SIZE], message_ids[READ_BATCH_SIZE:]
+                if not batch:
+                    return
+                data = {"message_ids": batch, "signature": self.sign(s.read_many_key(batch))}
+            data["sender_id"] = sender_id or "unknown"
+
+            count = 0
+            with self.post_json(url, data, stream=True) as response:
+                response.raise_for_status()
+                for line in response.iter_lines(chunk_size=FETCH_CHUNK_SIZE):
+                    if not line:
+                        continue
+                    entry = codec.JSON.loads(line)
+                    count += 1
+                    after = entry["id"]
+                    yield entry["id"], self._save_entry(entry, sender_id, dest_dir)
+            if unread and count < READ_BATCH_SIZE:
+                return
+
+    def _save_entry(self, entry, sender_id, dest_dir):
+        message_id = entry["id"]
+        if entry["status"] != 200:
+            return LookupError(f"message {message_id} not found")
+        if entry.get("download"):
+            # too large to be inlined
+            try:
+                return self.download(sender_id, message_id, dest_dir, signature=self.sign(str(message_id)))
+            except requests.RequestException as e:
+                return e
+        if entry["file_contents"] is None:
+            return "text", entry["file_name"] or ""
+
+        message_dir = os.path.join(dest_dir, str(message_id))
+        part_path = os.path.join(message_dir, ".part")
+        path = os.path.join(message_dir, os.path.basename(entry["file_name"] or str(message_id)))
+        os.makedirs(message_dir, exist_ok=True)
+        with open(part_path, "wb") as f:
+            f.write(base64.b64decode(entry["file_contents"]))
+        os.replace(part_path, path)
+        return "file", path
+
+    def download(self, sender_id, message_id, dest_dir, signature=None):
+        """
+        Stream a message's contents. Files are written to dest_dir/<message_id>/<file_name>,
+        resuming a partial download with a Range request and skipping unchanged ones via ETag.
+        Returns ("text", text) for text messages and ("file", path) for files.
+        """
+        url = f"{self.base_url}/download"
+        params = {
+            "signature": signature or "unknown",
+            "sender_id": sender_id or "unknown",
+            "message_id": message_id
+        }
+        message_dir = os.path.join(dest_dir, str(message_id))
+        part_path = os.path.join(message_dir, ".part")
+        etag_path = os.path.join(message_dir, ".etag")
+
+        headers = {}
+        saved = _read_download_state(message_dir, etag_path)
+        if saved:
+            headers["If-None-Match"] = saved[0]
+        elif os.path.exists(part_path):
+            # contents of a message never change, resume where the last attempt stopped
+            headers["Range"] = f"bytes={os.path.getsize(part_path)}-"
+
+        with self.session.get(url, params=params, headers=headers, stream=True) as response:
+            if response.status_code == 304:
+                return "file", saved[1]
+            if response.status_code == 416:
+                # stale partial file
+                os.unlink(part_path)
+                return self.download(sender_id, message_id, dest_dir, signature)
+            response.raise_for_status()
+
+            disposition = response.headers.get("Content-Disposition")
+            if not disposition:
+                return "text", response.text
+
+            msg = email.message.Message()
+            msg["Content-Disposition"] = disposition
+            file_name = os.path.basename(msg.get_filename() or str(message_id))
+
+            os.makedirs(message_dir, exist_ok=True)
+            mode = "ab" if response.status_code == 206 else "wb"
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+
+            path = os.path.join(message_dir, file_name)
+            os.replace(part_path, path)
+            with open(etag_path, "w") as f:
+                f.write(f"{response.headers.get('ETag', '')}\n{file_name}")
+            return "file", path
+
     def send_message(self, sender_id, receiver_id, message_text, signature=None):
         url = f"{self.base_url}/send_message"
         data = {
@@ -44,25 +299,182 @@ class FeApiClient:
             "receiver_id": receiver_id or "unknown",
             "message_text": message_text or "no content"
         }
-        response = requests.post(url, json=data)
+        response = self.post_json(url, data)
+        response.raise_for_status()
+        return response.json()
+
+    def send_many(self, sender_id, receiver_ids, message_text, signature=None):
+        """Send one text message to several receivers in a single request."""
+        url = f"{self.base_url}/send_many"
+        data = {
+            "signature": signature or "unknown",
+            "sender_id": sender_id or "unknown",
+            "receiver_ids": list(receiver_ids),
+            "message_text": message_text or "no content"
+        }
+        response = self.post_json(url, data)
         response.raise_for_status()
         return response.json()
 
-    def send_file(self, sender_id, receiver_id, file_path, signature=None):
-        url = f"{self.base_url}/send_file"
-        import mimetypes, base64
-        file_name = file_path.split("/")[-1]
+    def send_file(self, sender_id, receiver_ids, file_path):
+        """
+        Upload a file in chunks for one receiver or a list of receivers (uploaded once),
+        resuming an earlier interrupted upload of it if there is one.
+        """
+        if isinstance(receiver_ids, str):
+            receiver_ids = [receiver_ids]
+        file_name = os.path.basename(file_path)
         file_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+        file_size, sha256 = file_digest(file_path)
+        pending_key = f"{self.base_url}|{sender_id}|{','.join(receiver_ids)}|{sha256}"
+
+        upload = self._resume_upload(self._load_pending().get(pending_key), sender_id)
+        if upload is None:
+            upload = self._start_upload(sender_id, receiver_ids, file_name, file_type, file_size, sha256)
+            self._save_pending(pending_key, upload["upload_id"])
+
+        upload_id, chunk_size, offset = upload["upload_id"], upload["chunk_size"], upload["offset"]
+        params = {"sender_id": sender_id, "signature": self.sign(upload_id)}
+        url = f"{self.base_url}/upload/{upload_id}"
+        # chunks of text, CSV, logs, ... go out compressed, zip / jpeg / pdf / ... as they are
+        compress = compression.worth_compressing(file_name, file_type)
+
         with open(file_path, "rb") as f:
-            file_content = base64.b64encode(f.read()).decode()
+            failures = 0
+            while offset < file_size:
+                f.seek(offset)
+                chunk = f.read(chunk_size)
+                coding = self.body_coding if compress and len(chunk) >= compression.MIN_SIZE else None
+                headers = {"Content-Encoding": coding.name} if coding else {}
+                try:
+                    response = self.session.put(url, params={**params, "offset": offset},
+                                                data=coding.compress(chunk) if coding else chunk, headers=headers)
+                    if response.status_code == 409:
+                        # server has a different offset (e.g. lost ack), continue from there
+                        offset = response.json()["offset"]
+                        continue
+                    if response.status_code == 415 and coding:
+                        # server doesn't take compressed chunks
+                        self.body_coding, compress = None, False
+                        continue
+                    response.raise_for_status()
+                    offset = response.json()["offset"]
+                    failures = 0
+                except requests.ConnectionError:
+                    failures += 1
+                    if failures >= UPLOAD_RETRIES:
+                        raise
+                    offset = self._resume_upload(upload_id, sender_id)["offset"]
+
+        response = self.session.post(f"{url}/finish", params=params)
+        response.raise_for_status()
+        self._save_pending(pending_key, None)
+        return response.json()
+
+    def _start_upload(self, sender_id, receiver_ids, file_name, file_type, file_size, sha256):
         data = {
-            "signature": signature or "unknown",
+            "signature": self.sign(s.upload_key(file_name, file_size, sha256)),
             "sender_id": sender_id or "unknown",
-            "receiver_id": receiver_id or "unknown",
+            "receiver_id": receiver_ids[0],
+            "receiver_ids": receiver_ids,
             "file_name": file_name,
             "file_type": file_type,
-            "file_content": file_content
+            "file_size": file_size,
+            "sha256": sha256
         }
-        response = requests.post(url, json=data)
+        response = self.session.post(f"{self.base_url}/upload/start", json=data)
+        response.raise_for_status()
+        return response.json()
+
+    def _resume_upload(self, upload_id, sender_id):
+        """State of an existing upload session, None if the server doesn't know it (anymore)."""
+        if not upload_id:
+            return None
+        params = {"sender_id": sender_id, "signature": self.sign(upload_id)}
+        response = self.session.get(f"{self.base_url}/upload/{upload_id}", params=params)
+        if response.status_code == 404:
+            return None
         response.raise_for_status()
         return response.json()
+
+    def _load_pending(self):
+        try:
+            with open(self.uploads_path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_pending(self, key, upload_id):
+        pending = self._load_pending()
+        if upload_id is None:
+            pending.pop(key, None)
+        else:
+            pending[key] = upload_id
+        with open(self.uploads_path, "w") as f:
+            json.dump(pending, f, indent=4)
+
+
+class AdmissionRetry(Retry):
+    """
+    Also retries 429 and 503 answers that come with Retry-After for every method:
+    the server sends those when it turns a request away before doing any of its work
+    (rate limit, too many requests in flight), so a POST can't be applied twice.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code in (429, 503) and has_retry_after and self.total:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def new_session(pool_size=CONCURRENCY):
+    """
+    Session with keep-alive connections (up to pool_size per host) and retries with backoff.
+    Connection failures and admission rejections (429/503 with Retry-After) are retried
+    for every method (nothing was done on the server), other 502/503/504 answers only for
+    idempotent methods, so a message is never sent twice.
+    """
+    retry = AdmissionRetry(
+        total=RETRIES,
+        connect=RETRIES,
+        read=RETRIES,
+        status=RETRIES,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD", "PUT", "OPTIONS"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,  # the last answer is returned, raise_for_status reports it
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    # responses: requests already sends Accept-Encoding "gzip, deflate" plus zstd when
+    # urllib3 can decode it, and decodes compressed bodies (also streamed ones) itself
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def decode(response):
+    """Body of a response in whichever codec the server chose."""
+    return (codec.for_content_type(response.headers.get("Content-Type")) or codec.JSON).loads(response.content)
+
+def _read_download_state(message_dir, etag_path):
+    """(etag, path) of a completed earlier download that is still on disk, else None."""
+    try:
+        with open(etag_path, "r") as f:
+            etag, file_name = f.read().split("\n", 1)
+    except (FileNotFoundError, ValueError):
+        return None
+    path = os.path.join(message_dir, file_name)
+    if not etag or not os.path.exists(path):
+        return None
+    return etag, path
+
+def file_digest(file_path, block_size=1024 * 1024):
+    """Size and SHA-256 hex digest of a file, read in blocks."""
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha256.update(block)
+            size += len(block)
+    return size, sha256.hexdigest()
@@ -6,32 +6,120 @@ from shared import signature as s
 from tabulate import tabulate
 from datetime import datetime, timezone
 from api.client import FeApiClient
-from config.manager import ConfigManager
+from config.manager import ConfigManager, StateManager
+from storage.cache import MessageCache
+
+CACHE_BATCH_SIZE = 500  # streamed headers written to the local cache per transaction
 
 @click.command()
-def fetch():
-    """Fetch unread messages from the server."""
+@click.option('--all', 'fetch_all', is_flag=True, help="Show the whole mailbox instead of only new messages.")
+@click.option('--offline', is_flag=True, help="Show the locally cached mailbox without contacting the server.")
+def fetch(fetch_all, offline):
+    """Fetch new messages from the server."""
     try:
         config = ConfigManager().config
+        cache = MessageCache.from_config(config)
+        if offline:
+            print_messages_table(cache.headers())
+            return
+
         sender_id = config.get("sender_name", "unknown")
         key = "FTCH"
         secret = config.get("auth_token", "unknown")
         signature = s.sign_message(sender_id, key, secret)
         client = FeApiClient()
-        result = client.fetch(signature=signature, sender_id=sender_id)
-        click.echo(f"Fetched messages successfully!")
-        print_messages_table(result)
+
+        # the cursor is the server's position after the last message seen, kept per server and user.
+        # fetched headers go to the local cache, so only new ones are ever downloaded
+        state = StateManager()
+        cursor_key = f"cursor:{client.base_url}:{sender_id}"
+        cursor = None if cache.is_empty() else state.get(cursor_key)
+
+        # new rows are printed as they arrive, --all prints the whole cached mailbox at the end
+        table = None if fetch_all else TableStream()
+        fetched = 0
+
+        # first sync: the whole mailbox as one streamed response, saved to the cache in batches
+        if cursor is None:
+            batch = []
+            messages, cursor = client.fetch(signature=signature, sender_id=sender_id, stream=True)
+            for msg in messages:
+                batch.append(msg)
+                if table is not None:
+                    table.row(msg)
+                if len(batch) >= CACHE_BATCH_SIZE:
+                    cache.add_headers(batch)
+                    fetched += len(batch)
+                    batch = []
+            cache.add_headers(batch)
+            fetched += len(batch)
+
+        # everything newer than the cursor, page by page
+        more = True
+        while more:
+            page, cursor, more = client.fetch(signature=signature, sender_id=sender_id, cursor=cursor)
+            cache.add_headers(page)
+            fetched += len(page)
+            if table is not None:
+                for msg in page:
+                    table.row(msg)
+        state.set(cursor_key, cursor)
+
+        if table is not None:
+            table.close()
+        click.echo(f"Fetched {fetched} new messages successfully!")
+        if fetch_all:
+            print_messages_table(cache.headers())
     except Exception as e:
         click.echo(f"Fetch failed: {e}", err=True)
 
 def print_messages_table(messages):
     """Zeigt Nachrichten als Tabelle im Terminal an."""
     table = [
-        [unix_to_iso(msg.get("timestamp")), msg.get("sender_id"), msg.get("file_name")]
+        [msg.get("id"), unix_to_iso(msg.get("timestamp")), msg.get("sender_id"), msg.get("file_name"), format_size(msg)]
         for msg in messages
     ]
-    headers = ["Timestamp", "Sender ID", "Message"]
+    headers = ["ID", "Timestamp", "Sender ID", "Message", "Size"]
     click.echo(tabulate(table, headers, tablefmt="grid"))
 
+class TableStream:
+    """Prints the same grid as print_messages_table, one row at a time with fixed column widths."""
+    WIDTHS = (6, 20, 12, 50, 14)
+
+    def __init__(self):
+        self.rows = 0
+
+    def _line(self, fill="-"):
+        return "+" + "+".join(fill * (width + 2) for width in self.WIDTHS) + "+"
+
+    def _cells(self, cells):
+        return "|" + "|".join(f" {str(cell):<{width}} " for cell, width in zip(cells, self.WIDTHS)) + "|"
+
+    def row(self, msg):
+        if self.rows == 0:
+            click.echo(self._line())
+            click.echo(self._cells(["ID", "Timestamp", "Sender ID", "Message", "Size"]))
+            click.echo(self._line("="))
+        else:
+            click.echo(self._line())
+        click.echo(self._cells([msg.get("id"), unix_to_iso(msg.get("timestamp")), msg.get("sender_id"), msg.get("file_name"), format_size(msg)]))
+        self.rows += 1
+
+    def close(self):
+        if self.rows:
+            click.echo(self._line())
+
+def format_size(msg):
+    """Size of a message from its header, "file" marks attachments. Empty if the server didn't send it."""
+    size = msg.get("content_length")
+    if size is None:
+        return ""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            break
+        size /= 1024
+    text = f"{size} B" if unit == "B" else f"{size:.1f} {unit}"
+    return f"{text} file" if msg.get("content_kind") == "file" else text
+
 def unix_to_iso(timestamp):
     return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat().replace('+00:00', 'Z')
\ No newline at end of file
@@ -13,7 +13,9 @@ def init():
         "server_port": 26834,
         "sender_name": "",
         "auth_token": "",
-        "storage_path": os.path.join(config_dir, "messages")
+        "storage_path": os.path.join(config_dir, "messages"),
+        "cache_max_bytes": 512 * 1024 * 1024,
+        "concurrency": 8
     }
     with open(config_path, "w") as f:
         json.dump(default_config, f, indent=4)
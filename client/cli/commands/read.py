@@ -1,24 +1,88 @@
 import click
+import requests
 from api.client import FeApiClient
 from config.manager import ConfigManager
+from storage.cache import MessageCache
 import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
 from shared import signature as s
 
 @click.command()
-@click.argument('message_id', required=True)
-def read(message_id):
-    """Read a message by its ID. Usage: fe read <message_id>"""
+@click.argument('message_ids', nargs=-1)
+@click.option('--all-unread', is_flag=True, help="Read every message you haven't read yet.")
+@click.option('-j', '--concurrency', type=int, default=None, help="Parallel downloads when the server can't read in batches (default: config 'concurrency' or 8).")
+def read(message_ids, all_unread, concurrency):
+    """Read one or more messages by their ID. Usage: fe read <message_id> [<message_id> ...] | fe read --all-unread"""
+    if not message_ids and not all_unread:
+        raise click.UsageError("give one or more message ids or --all-unread")
     try:
         config = ConfigManager().config
         sender_id = config.get("sender_name", "unknown")
-        key = message_id
-        secret = config.get("auth_token", "unknown")
-        signature = s.sign_message(sender_id, key, secret)
-        client = FeApiClient()
-        result = client.read(signature=signature, sender_id=sender_id, message_id=message_id)
-        click.echo(f"Read message successfully!")
-        click.echo(result)
+        # served from the local cache if it was read before, downloaded into it otherwise
+        cache = MessageCache.from_config(config)
+        results = {message_id: cache.get_body(message_id) for message_id in message_ids}
+        missing = [message_id for message_id, cached in results.items() if not cached]
+        client = FeApiClient(concurrency=concurrency)
+        if all_unread:
+            results.update(read_batched(client, cache, sender_id, unread=True))
+        elif len(missing) == 1:
+            results.update(read_each(client, cache, sender_id, missing))
+        elif missing:
+            try:
+                results.update(read_batched(client, cache, sender_id, message_ids=missing))
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                # server without /read_many
+                results.update(read_each(client, cache, sender_id, missing))
     except Exception as e:
-        click.echo(f"Read failed: {e}", err=True)
\ No newline at end of file
+        click.echo(f"Read failed: {e}", err=True)
+        return
+
+    if all_unread and not results:
+        click.echo("No unread messages.")
+    for message_id, result in results.items():
+        if len(results) > 1:
+            click.echo(f"--- message {message_id} ---")
+        if isinstance(result, Exception):
+            click.echo(f"Read failed: {result}", err=True)
+            continue
+        kind, body = result
+        click.echo(f"Read message successfully!")
+        if kind == "text":
+            click.echo(body)
+        else:
+            click.echo(f"Saved file to {body}")
+
+def read_batched(client, cache, sender_id, message_ids=None, unread=False):
+    """All messages in one /read_many round trip per batch, bodies go to the cache."""
+    results = {}
+    for message_id, result in client.read_many(sender_id, cache.storage_path, message_ids=message_ids, unread=unread):
+        results[str(message_id)] = result
+        store(cache, str(message_id), result)
+    return results
+
+def read_each(client, cache, sender_id, message_ids):
+    """One /download per message, in parallel."""
+    secret = client.config.get("auth_token", "unknown")
+    results = {}
+
+    def download(message_id):
+        signature = s.sign_message(sender_id, message_id, secret)  # key is the message_id
+        return client.download(sender_id, message_id, cache.storage_path, signature=signature)
+
+    label = f"Downloading {len(message_ids)} messages"
+    for message_id, result in client.run_parallel(download, message_ids, label=label):
+        results[message_id] = result
+        store(cache, message_id, result)
+    return results
+
+def store(cache, message_id, result):
+    if isinstance(result, Exception):
+        return
+    kind, body = result
+    if kind == "text":
+        cache.put_text(message_id, body)
+    else:
+        cache.put_file(message_id, body)
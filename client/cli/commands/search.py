@@ -0,0 +1,32 @@
+import click
+from tabulate import tabulate
+from api.client import FeApiClient
+from commands.fetch import unix_to_iso, format_size
+
+PAGE_SIZE = 20
+
+@click.command()
+@click.argument('words', nargs=-1, required=True)
+@click.option('-n', '--limit', type=int, default=PAGE_SIZE, help=f"Results per page (default {PAGE_SIZE}, at most 100).")
+@click.option('-p', '--page', type=int, default=1, help="Page of the results to show, starting at 1.")
+def search(words, limit, page):
+    """Search your messages by text and file name. Usage: fe search <word> [<word>...]  (word* matches a prefix)"""
+    query = " ".join(words)
+    try:
+        client = FeApiClient()
+        results, more = client.search(query, limit=limit, offset=(max(page, 1) - 1) * limit)
+    except Exception as e:
+        click.echo(f"Search failed: {e}", err=True)
+        return
+
+    if not results:
+        click.echo(f"No messages match '{query}'.")
+        return
+    table = [
+        [msg.get("id"), unix_to_iso(msg.get("timestamp")), msg.get("sender_id"), msg.get("receiver_id"),
+         msg.get("snippet"), format_size(msg)]
+        for msg in results
+    ]
+    click.echo(tabulate(table, ["ID", "Timestamp", "Sender ID", "Receiver ID", "Match", "Size"], tablefmt="grid"))
+    if more:
+        click.echo(f"More results: fe search {query} --page {page + 1}")
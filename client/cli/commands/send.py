@@ -1,4 +1,5 @@
 import click
+import requests
 from api.client import FeApiClient
 from config.manager import ConfigManager
 
@@ -10,7 +11,8 @@ from shared import signature as s
 @click.command()
 @click.argument('recipients', required=True)
 @click.argument('message', required=True)
-def send(recipients, message):
+@click.option('-j', '--concurrency', type=int, default=None, help="Parallel requests when sending to recipients one by one (default: config 'concurrency' or 8).")
+def send(recipients, message, concurrency):
     """Send a message or file to one or more recipients. Usage: fe send [recipient1,recipient2] <message> <message> can be a file path or a quoted string."""
     recipients_list = [r.strip() for r in recipients.split(',') if r.strip()]
     config = ConfigManager().config
@@ -18,19 +20,50 @@ def send(recipients, message):
     key = message[:32] # server rule for send command
     secret = config.get("auth_token", "unknown")
     signature = s.sign_message(sender_id, key, secret)
-    client = FeApiClient()
+    client = FeApiClient(concurrency=concurrency)
 
-    if os.path.isfile(message):
+    if len(recipients_list) > 1:
+        # one request (and for files one upload) for all recipients
+        what = f"file '{message}'" if os.path.isfile(message) else "message"
+        try:
+            if os.path.isfile(message):
+                result = client.send_file(sender_id, recipients_list, message)
+            else:
+                result = client.send_many(sender_id, recipients_list, message, signature)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404 or os.path.isfile(message):
+                click.echo(f"Failed to send {what} to {', '.join(recipients_list)}: {e}", err=True)
+                return
+            # server without /send_many: one request per recipient, in parallel
+            send_each(client, sender_id, recipients_list, message, signature)
+            return
+        except Exception as e:
+            click.echo(f"Failed to send {what} to {', '.join(recipients_list)}: {e}", err=True)
+            return
+        for recipient, outcome in result.get("results", {}).items():
+            if outcome.get("status") == 200:
+                click.echo(f"Sent {what} to {recipient} (message id {outcome.get('message_id')})")
+            else:
+                click.echo(f"Failed to send {what} to {recipient}: {outcome.get('message')}", err=True)
+    elif os.path.isfile(message):
         for recipient in recipients_list:
             try:
-                result = client.send_file(sender_id, recipient, message, signature)
+                result = client.send_file(sender_id, recipient, message)
                 click.echo(f"Sent file '{message}' to {recipient}: {result}")
             except Exception as e:
                 click.echo(f"Failed to send file to {recipient}: {e}", err=True)
     else:
-        for recipient in recipients_list:
-            try:
-                result = client.send_message(sender_id, recipient, message, signature)
-                click.echo(f"Sent message to {recipient}: {result}")
-            except Exception as e:
-                click.echo(f"Failed to send message to {recipient}: {e}", err=True)
\ No newline at end of file
+        send_each(client, sender_id, recipients_list, message, signature)
+
+
+def send_each(client, sender_id, recipients_list, message, signature):
+    results = client.run_parallel(
+        lambda recipient: client.send_message(sender_id, recipient, message, signature),
+        recipients_list,
+        label=f"Sending to {len(recipients_list)} recipients"
+    )
+    for recipient, result in results:
+        if isinstance(result, Exception):
+            click.echo(f"Failed to send message to {recipient}: {result}", err=True)
+        else:
+            click.echo(f"Sent message to {recipient}: {result}")
@@ -0,0 +1,50 @@
+import click
+import sys
+import os
+import time
+import requests
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+from shared import signature as s
+from api.client import FeApiClient
+from config.manager import ConfigManager, StateManager
+from storage.cache import MessageCache
+from commands.fetch import unix_to_iso
+
+RETRY_DELAY = 5  # seconds to wait after a failed poll
+
+@click.command()
+@click.option('--timeout', default=30, show_default=True, help="Seconds each long-poll waits on the server.")
+def watch(timeout):
+    """Wait for new messages and print them as they arrive. Stop with Ctrl+C."""
+    config = ConfigManager().config
+    sender_id = config.get("sender_name", "unknown")
+    key = "WAIT"
+    secret = config.get("auth_token", "unknown")
+    signature = s.sign_message(sender_id, key, secret)
+    client = FeApiClient()
+    cache = MessageCache.from_config(config)
+
+    # shares the cursor with `fe fetch`, messages shown here count as fetched
+    state = StateManager()
+    cursor_key = f"cursor:{client.base_url}:{sender_id}"
+    cursor = 0 if cache.is_empty() else state.get(cursor_key, 0)
+
+    click.echo(f"Watching for new messages for {sender_id}...")
+    try:
+        while True:
+            try:
+                result = client.wait(signature=signature, sender_id=sender_id, cursor=cursor, timeout=timeout)
+            except requests.RequestException as e:
+                click.echo(f"Watch failed: {e}, retrying in {RETRY_DELAY}s", err=True)
+                time.sleep(RETRY_DELAY)
+                continue
+            if result is None:
+                continue
+
+            messages, cursor, _ = result
+            cache.add_headers(messages)
+            state.set(cursor_key, cursor)
+            for msg in messages:
+                click.echo(f"[{msg.get('id')}] {unix_to_iso(msg.get('timestamp'))} {msg.get('sender_id')}: {msg.get('file_name')}")
+    except KeyboardInterrupt:
+        pass
@@ -19,3 +19,30 @@ class ConfigManager:
 
     def get(self, key, default=None):
         return self._config.get(key, default)
+
+
+class StateManager:
+    """Small client state that isn't configuration (e.g. sync cursors), kept next to the config file."""
+
+    def __init__(self, config_path=None):
+        if config_path is None:
+            config_path = os.path.expanduser("~/.fe/config.json")
+        self.state_path = os.path.join(os.path.dirname(config_path), "state.json")
+
+    def load(self):
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def set(self, key, value):
+        state = self.load()
+        state[key] = value
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=4)
+        os.replace(tmp_path, self.state_path)
@@ -4,6 +4,8 @@ from commands.ping import ping
 from commands.fetch import fetch
 from commands.read import read
 from commands.send import send
+from commands.search import search
+from commands.watch import watch
 
 BANNER = r"""
             ______                  ______                                 
@@ -31,6 +33,8 @@ main.add_command(ping)
 main.add_command(fetch)
 main.add_command(read)
 main.add_command(send)
+main.add_command(search)
+main.add_command(watch)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,138 @@
+import os
+import shutil
+import sqlite3
+import time
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+class MessageCache:
+    """
+    Local store under the configured storage_path.
+    Keeps the headers of every fetched message (for offline listing) and the
+    bodies of read messages, text inline and files on disk next to it.
+    Bodies are evicted least recently used first once they exceed max_bytes.
+    """
+
+    def __init__(self, storage_path, max_bytes=DEFAULT_MAX_BYTES):
+        self.storage_path = os.path.expanduser(storage_path)
+        self.max_bytes = max_bytes
+        os.makedirs(self.storage_path, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(self.storage_path, "cache.db"))
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        with self.conn:
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                sender_id TEXT,
+                receiver_id TEXT,
+                timestamp INTEGER,
+                file_name TEXT,
+                file_type TEXT,
+                queue_deletion INTEGER,
+                content_length INTEGER,
+                content_kind TEXT
+            )
+            """)
+            # caches created before the size columns existed
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(messages)")}
+            for column, kind in (("content_length", "INTEGER"), ("content_kind", "TEXT")):
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE messages ADD COLUMN {column} {kind}")
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS bodies (
+                message_id INTEGER PRIMARY KEY,
+                kind TEXT,
+                text TEXT,
+                path TEXT,
+                size INTEGER,
+                last_access REAL
+            )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_bodies_last_access ON bodies (last_access)")
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get("storage_path", "~/.fe/messages"), config.get("cache_max_bytes", DEFAULT_MAX_BYTES))
+
+    def close(self):
+        self.conn.close()
+
+    ## headers
+
+    def add_headers(self, messages):
+        with self.conn:
+            self.conn.executemany("""
+            INSERT OR REPLACE INTO messages (id, sender_id, receiver_id, timestamp, file_name, file_type, queue_deletion,
+                                             content_length, content_kind)
+            VALUES (:id, :sender_id, :receiver_id, :timestamp, :file_name, :file_type, :queue_deletion,
+                    :content_length, :content_kind)
+            """, ({"content_length": None, "content_kind": None, **msg} for msg in messages))
+
+    def headers(self):
+        c = self.conn.execute("""
+        SELECT id, sender_id, receiver_id, timestamp, file_name, file_type, queue_deletion, content_length, content_kind
+        FROM messages
+        ORDER BY timestamp ASC, id ASC
+        """)
+        columns = [col[0] for col in c.description]
+        return [dict(zip(columns, row)) for row in c]
+
+    def is_empty(self):
+        """True if no headers are cached, without reading them all."""
+        return self.conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is None
+
+    ## bodies
+
+    def message_dir(self, message_id):
+        return os.path.join(self.storage_path, str(message_id))
+
+    def get_body(self, message_id):
+        """("text", text) or ("file", path) of a cached body, None on a miss."""
+        row = self.conn.execute("SELECT kind, text, path FROM bodies WHERE message_id = ?", (message_id,)).fetchone()
+        if row is None:
+            return None
+        kind, text, path = row
+        if kind == "file" and not os.path.exists(path):
+            self._delete_body(message_id)
+            return None
+        with self.conn:
+            self.conn.execute("UPDATE bodies SET last_access = ? WHERE message_id = ?", (time.time(), message_id))
+        return (kind, text) if kind == "text" else (kind, path)
+
+    def put_text(self, message_id, text):
+        self._put(message_id, "text", text, None, len(text.encode("utf-8")))
+
+    def put_file(self, message_id, path):
+        self._put(message_id, "file", None, path, os.path.getsize(path))
+
+    def size(self):
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+
+    def _put(self, message_id, kind, text, path, size):
+        with self.conn:
+            self.conn.execute("""
+            INSERT OR REPLACE INTO bodies (message_id, kind, text, path, size, last_access)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """, (message_id, kind, text, path, size, time.time()))
+        self.evict(keep=message_id)
+
+    def evict(self, keep=None):
+        """Drop least recently used bodies until the cache fits max_bytes (never the one just stored)."""
+        total = self.size()
+        if total <= self.max_bytes:
+            return
+        rows = self.conn.execute("""
+        SELECT message_id, size FROM bodies
+        WHERE message_id IS NOT ?
+        ORDER BY last_access ASC
+        """, (keep,)).fetchall()
+        for message_id, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._delete_body(message_id)
+            total -= size
+
+    def _delete_body(self, message_id):
+        with self.conn:
+            self.conn.execute("DELETE FROM bodies WHERE message_id = ?", (message_id,))
+        shutil.rmtree(self.message_dir(message_id), ignore_errors=True)
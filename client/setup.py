@@ -12,6 +12,8 @@ setup(
             "fe fetch=cli.commands.fetch:fetch",
             "fe read=cli.commands.read:read",
             "fe send=cli.commands.send:send",
+            "fe watch=cli.commands.watch:watch",
+            "fe search=cli.commands.search:search",
         ]
     },
 )
@@ -0,0 +1,121 @@
+### Admission control: per-client rate limits and request body limits
+###
+### check() runs first thing for every request (a before_request hook) and only looks
+### at the route, the sender and the Content-Length header: a rejected request costs
+### no body parsing and no database work.
+###   - bodies above the endpoint's limit get 413
+###   - a token bucket per (sender, endpoint) allows `burst` requests at once and `rate`
+###     per second after that, beyond it 429 with Retry-After (seconds until a token is back)
+### The bucket key is the sender_id of the query string or the X-Fe-Sender header (the CLI
+### sends both) together with the client address: the sender isn't verified at this point,
+### so a client claiming someone else's name only drains buckets of its own address.
+### Buckets live in each process: with --workers N every worker grants the full rate.
+### The global cap on requests in flight is enforced by the servers themselves
+### (serving.py, asgi.py) before a request is even read, 503 with Retry-After.
+###
+### Configured with environment variables:
+###   FE_RATE_LIMIT      default "rate:burst" of every endpoint (default 20:60, 0 = unlimited)
+###   FE_RATE_LIMITS     per endpoint, e.g. "/send_message=5:20,/fetch=2:10"
+###   FE_MAX_BODY        request body bytes of every endpoint but the upload chunks (default 16 MiB)
+###   FE_MAX_IN_FLIGHT   requests admitted at once per process (default: the server mode's own)
+
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+import uploads
+
+MAX_KEYS = 100000   # buckets kept, the least recently used one is dropped (= full again)
+UNLIMITED = None
+
+
+def _parse_limit(value: str) -> tuple[float, float] | None:
+    rate, _, burst = value.partition(":")
+    rate = float(rate)
+    if rate <= 0:
+        return UNLIMITED
+    return rate, float(burst or max(rate, 1))
+
+def _parse_limits(value: str) -> dict:
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        endpoint, _, limit = item.partition("=")
+        limits[endpoint.strip()] = _parse_limit(limit)
+    return limits
+
+DEFAULT_RATE = _parse_limit(os.environ.get("FE_RATE_LIMIT", "20:60"))
+# (requests per second, burst) by route, UNLIMITED for none
+RATE_LIMITS = {
+    "/healthcheck": UNLIMITED,
+    "/metrics": UNLIMITED,
+    "/wait": (2, 10),                       # a long-poll comes back by itself, loops don't need more
+    "/send_file": (2, 10),                  # whole files in one body
+    "/download": (50, 200),                 # `fe read` downloads in parallel
+    "/upload/<upload_id>": (50, 200),       # one request per chunk
+    **_parse_limits(os.environ.get("FE_RATE_LIMITS", "")),
+}
+
+MAX_BODY = int(os.environ.get("FE_MAX_BODY", 16 * 1024 ** 2))
+BODY_LIMITS = {
+    "/upload/<upload_id>": 2 * uploads.CHUNK_SIZE,  # a chunk, compressed chunks can be a little larger
+}
+
+MAX_IN_FLIGHT = int(os.environ.get("FE_MAX_IN_FLIGHT", 0)) or None
+
+
+class TokenBuckets:
+    """Token buckets by key, refilled lazily whenever a key is used."""
+
+    def __init__(self, max_keys: int = MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets: OrderedDict = OrderedDict()     # key -> (tokens, time of last refill)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate: float, burst: float) -> float:
+        """Take a token for key. Returns 0 if there was one, else the seconds until there is"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+buckets = TokenBuckets()
+
+
+def body_limit(endpoint: str | None) -> int:
+    return BODY_LIMITS.get(endpoint, MAX_BODY)
+
+def max_body() -> int:
+    """The largest body any endpoint takes"""
+    return max(MAX_BODY, *BODY_LIMITS.values())
+
+def check(endpoint: str | None, sender, content_length: int | None) -> tuple[int, int | None, str] | None:
+    """
+    None if the request may go on, else (status, Retry-After seconds or None, message).
+    endpoint is the route (e.g. "/upload/<upload_id>"), None for unknown URLs (not limited).
+    """
+    if endpoint is None:
+        return None
+    if content_length is not None and content_length > body_limit(endpoint):
+        metrics.REJECTED_REQUESTS.inc(1, "body_size", endpoint)
+        return 413, None, f"request body above {body_limit(endpoint)} bytes"
+
+    limit = RATE_LIMITS.get(endpoint, DEFAULT_RATE)
+    if limit is UNLIMITED:
+        return None
+    wait = buckets.take((sender, endpoint), *limit)
+    if wait:
+        metrics.REJECTED_REQUESTS.inc(1, "rate", endpoint)
+        return 429, max(1, math.ceil(wait)), f"more than {limit[0]:g} requests per second to {endpoint}, slow down"
+    return None
@@ -0,0 +1,317 @@
+### Asyncio server mode: ASGI adapter in front of the Flask app
+###
+### The event loop owns all sockets, so thousands of idle or slow clients
+### cost no threads. Requests are handed to a bounded executor that runs the
+### Flask view (and with it the blocking sqlite work) on a fixed set of
+### threads, the response body is streamed back through a small queue so a
+### slow reader pauses its handler instead of buffering everything.
+### A long-poll parks on the event loop: its view answers with PARK_HEADER instead
+### of blocking, the adapter waits for the notification hub and dispatches the
+### request again, so waiting clients hold no executor thread.
+
+import asyncio
+import logging
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import database as db
+import metrics
+import notify
+
+EXECUTOR_THREADS = 32       # threads running request handlers and their DB work
+MAX_PENDING = 2048          # admitted requests (running + queued), beyond that answer 503
+BODY_QUEUE_SIZE = 8         # response chunks buffered per request before its handler waits
+SPOOL_SIZE = 1024 * 1024    # request bodies above this are spooled to disk
+SHUTDOWN_GRACE = 30         # seconds to let admitted requests finish on shutdown
+
+# environ key telling views that they may park, a parking view answers with PARK_HEADER
+# ("<notify.hub version> <receiver>") and keeps its deadline (time.monotonic()) under PARK_DEADLINE.
+# The request is dispatched again with the same "fe." environ keys once a message is
+# published for the receiver, the deadline passes or notify.poll_interval seconds went by
+PARKING = "fe.park"
+PARK_HEADER = "X-Fe-Park"
+PARK_DEADLINE = "fe.park_deadline"
+
+log = logging.getLogger("fe.asgi")
+
+
+class _Disconnected(Exception):
+    pass
+
+
+class AsgiAdapter:
+    def __init__(self, wsgi_app, threads: int = EXECUTOR_THREADS, max_pending: int = MAX_PENDING,
+                 max_body: int | None = None):
+        self.wsgi_app = wsgi_app
+        self.max_pending = max_pending
+        self.max_body = max_body    # the app checks its own per-route limits, this bounds what is read at all
+        self.pending = 0
+        self.closing = False
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="fe-asgi")
+        self._idle: asyncio.Event | None = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    ## lifespan: graceful shutdown waits for admitted requests, then closes the executor
+
+    async def _lifespan(self, receive, send):
+        while True:
+            event = await receive()
+            if event["type"] == "lifespan.startup":
+                self._idle = asyncio.Event()
+                self._idle.set()
+                await send({"type": "lifespan.startup.complete"})
+            elif event["type"] == "lifespan.shutdown":
+                self.closing = True
+                try:
+                    await asyncio.wait_for(self._idle.wait(), SHUTDOWN_GRACE)
+                except asyncio.TimeoutError:
+                    log.warning("ASGI: shutting down with %d requests still running", self.pending)
+                await asyncio.get_running_loop().run_in_executor(None, self._shutdown_executor)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _shutdown_executor(self):
+        # every executor thread closes its pooled connection before it goes away
+        for _ in range(self.executor._max_workers):
+            self.executor.submit(db.close_connection)
+        self.executor.shutdown(wait=True)
+
+    ## requests
+
+    async def _http(self, scope, receive, send):
+        if self.closing or self.pending >= self.max_pending:
+            # backpressure: reject right away instead of queueing without bound
+            metrics.REJECTED_REQUESTS.inc(1, "in_flight", "")
+            await _send_simple(send, 503, b"server busy, retry later", [(b"retry-after", b"1")])
+            return
+        length = _content_length(scope)
+        if self.max_body is not None and length is not None and length > self.max_body:
+            metrics.REJECTED_REQUESTS.inc(1, "body_size", "")
+            await _send_simple(send, 413, b"request body too large")
+            return
+
+        self.pending += 1
+        if self._idle is not None:
+            self._idle.clear()
+        try:
+            body = await _read_body(receive, self.max_body)
+            if body is None:
+                return
+            if body is _TOO_LARGE:
+                metrics.REJECTED_REQUESTS.inc(1, "body_size", "")
+                await _send_simple(send, 413, b"request body too large")
+                return
+            environ = _environ(scope, body)
+            environ[PARKING] = True
+            while (parked := await self._run(environ, send)) is not None:
+                if not await self._park(environ, *parked, receive):
+                    return
+                keep = {key: value for key, value in environ.items() if key.startswith("fe.")}
+                environ = {**_environ(scope, tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)), **keep}
+        finally:
+            self.pending -= 1
+            if self.pending == 0 and self._idle is not None:
+                self._idle.set()
+
+    async def _park(self, environ, version: int, receiver_id: str, receive) -> bool:
+        """Wait for the parked request's next dispatch, False if the client went away"""
+        remaining = environ[PARK_DEADLINE] - time.monotonic()
+        if remaining <= 0 or self.closing:
+            return True
+        waiting = asyncio.ensure_future(
+            notify.hub.wait_async(receiver_id, version, min(remaining, notify.poll_interval or remaining))
+        )
+        disconnect = asyncio.ensure_future(receive())   # the body is read, the next event is the disconnect
+        try:
+            await asyncio.wait((waiting, disconnect), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (waiting, disconnect):
+                task.cancel()
+        return not (disconnect.done() and not disconnect.cancelled())
+
+    async def _run(self, environ, send) -> tuple[int, str] | None:
+        """Run the app and send its response, (version, receiver) instead if the view parks"""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        # bounds the chunks in flight per request, a slow reader pauses its handler thread
+        slots = threading.BoundedSemaphore(BODY_QUEUE_SIZE)
+        cancelled = threading.Event()
+        body = environ["wsgi.input"]
+
+        def put(item):
+            # called from the handler thread, never waits for the event loop unless the queue is full
+            while not slots.acquire(timeout=1):
+                if cancelled.is_set():
+                    raise _Disconnected()
+            if cancelled.is_set():
+                raise _Disconnected()
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        def handle():
+            result = None
+            try:
+                def start_response(status, headers, exc_info=None):
+                    put(("start", status, headers))
+                    return lambda data: put(("body", data))
+
+                result = self.wsgi_app(environ, start_response)
+                for chunk in result:
+                    if chunk:
+                        put(("body", chunk))
+                put(("end",))
+            except _Disconnected:
+                pass
+            except Exception as e:
+                if not cancelled.is_set():
+                    put(("error", e))
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+                body.close()
+
+        loop.run_in_executor(self.executor, handle)
+        started = False
+        parked = None
+        try:
+            while True:
+                item = await queue.get()
+                slots.release()
+                if parked is not None:
+                    if item[0] in ("end", "error"):
+                        return parked
+                elif item[0] == "start":
+                    status, headers = item[1], item[2]
+                    park = next((v for k, v in headers if k.lower() == PARK_HEADER.lower()), None)
+                    if park is not None:
+                        version, receiver_id = park.split(" ", 1)
+                        parked = int(version), receiver_id
+                        continue
+                    await send({
+                        "type": "http.response.start",
+                        "status": int(status.split(" ", 1)[0]),
+                        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+                    })
+                    started = True
+                elif item[0] == "body":
+                    await send({"type": "http.response.body", "body": item[1], "more_body": True})
+                elif item[0] == "end":
+                    await send({"type": "http.response.body", "body": b"", "more_body": False})
+                    break
+                else:
+                    log.error("ASGI: request failed: %r", item[1])
+                    if not started:
+                        await _send_simple(send, 500, b"internal server error")
+                    break
+        finally:
+            # client went away or we're done: a handler still running stops at its next chunk
+            cancelled.set()
+
+
+_TOO_LARGE = object()
+
+def _content_length(scope) -> int | None:
+    for name, value in scope["headers"]:
+        if name == b"content-length":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+async def _read_body(receive, limit: int | None = None):
+    """
+    Collect the request body into a spooled temp file (memory for small bodies).
+    Returns None if the client disconnected first, _TOO_LARGE once it grows past limit
+    (chunked bodies have no Content-Length to check up front).
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    while True:
+        event = await receive()
+        if event["type"] == "http.disconnect":
+            body.close()
+            return None
+        body.write(event.get("body", b""))
+        if limit is not None and body.tell() > limit:
+            body.close()
+            return _TOO_LARGE
+        if not event.get("more_body", False):
+            break
+    body.seek(0)
+    return body
+
+async def _send_simple(send, status: int, text: bytes, headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/plain"), (b"content-length", str(len(text)).encode())] + list(headers),
+    })
+    await send({"type": "http.response.body", "body": text})
+
+def _environ(scope, body) -> dict:
+    """Translate an ASGI http scope into a WSGI environ (PEP 3333)."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            key = name
+        else:
+            key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def serve(app, host: str, port: int, threads: int = EXECUTOR_THREADS, fd: int | None = None,
+          max_pending: int = MAX_PENDING, max_body: int | None = None):
+    """
+    Run the app in asyncio mode until interrupted (requires uvicorn).
+    fd: an inherited listening socket to accept on instead of binding host:port (prefork.py)
+    max_pending: requests admitted at once (running or queued), 503 beyond
+    max_body: bodies above it get 413 before they are read
+    """
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("ERROR: the asgi server mode requires uvicorn (pip install uvicorn)")
+
+    log.info("## Serving on %s:%d in asgi mode with %d executor threads ##", host, port, threads)
+    config = uvicorn.Config(
+        AsgiAdapter(app, threads=threads, max_pending=max_pending, max_body=max_body),
+        host=host,
+        port=port,
+        lifespan="on",
+        backlog=4096,
+        timeout_graceful_shutdown=SHUTDOWN_GRACE,
+        access_log=False,
+        log_config=None,    # uvicorn logs go through the queue handler of logs.py too
+    )
+    sockets = [socket.socket(fileno=fd)] if fd is not None else None
+    uvicorn.Server(config).run(sockets=sockets)
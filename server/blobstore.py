@@ -0,0 +1,176 @@
+### Content-addressed on-disk store for message file contents
+###
+### Blobs are keyed by the SHA-256 of their bytes and live at
+### <BLOB_DIR>/<first two hex chars>/<hex digest>. The same content is only
+### ever stored once, no matter how many messages reference it.
+###
+### Compressible contents are stored compressed, the coding is appended to the
+### file name (<hex digest>.zst / .gz) and recorded as blob_codec in the
+### message rows. The digest is always the one of the uncompressed bytes.
+
+import hashlib
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import shared.compression as z
+
+BLOB_DIR = os.environ.get("FE_BLOB_DIR", "fe_blobs")
+
+# coding for blobs at rest: "zstd", "gzip" or "off", default the best one available
+AT_REST = z.by_name(os.environ.get("FE_COMPRESS_AT_REST", z.PREFERRED.name))
+MAX_COMPRESS_SIZE = 64 * 1024 ** 2  # larger files are stored as they are, compressing them would hold up the request
+MIN_SAVING = 0.1                    # keep the compressed blob only if it is at least 10% smaller
+COPY_SIZE = 1024 * 1024
+
+
+def path_for(digest: str, codec: str | None = None) -> str:
+    suffix = z.CODINGS[codec].suffix if codec else ""
+    return os.path.join(BLOB_DIR, digest[:2], digest + suffix)
+
+def exists(digest: str) -> bool:
+    return _stored(digest) is not None
+
+def coding_for(file_name: str | None, file_type: str | None, size: int) -> z.Coding | None:
+    """
+    Coding to store new contents with, None to store them as they are:
+    small, huge and already compressed contents (zip, jpeg, pdf, ...) aren't compressed.
+    """
+    if AT_REST is None or size < z.MIN_SIZE or size > MAX_COMPRESS_SIZE:
+        return None
+    if not z.worth_compressing(file_name, file_type):
+        return None
+    return AT_REST
+
+def put(data: bytes, coding: z.Coding | None = None) -> tuple[str, int, str | None]:
+    """
+    Store data (if not already present) and return (sha256 hex digest, size, codec the blob is stored with).
+    The file is written to a temp file first and renamed into place, so a
+    blob is either complete or absent.
+    """
+    digest, size = hashlib.sha256(data).hexdigest(), len(data)
+    stored = _stored(digest)
+    if stored is not None:
+        return digest, size, stored or None
+
+    codec = None
+    if coding is not None:
+        compressed = coding.compress(data)
+        if len(compressed) <= len(data) * (1 - MIN_SAVING):
+            data, codec = compressed, coding.name
+
+    path = path_for(digest, codec)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return digest, size, codec
+
+def put_file(src_path: str, digest: str, coding: z.Coding | None = None) -> str | None:
+    """
+    Move an already hashed file (same filesystem) into the store under digest,
+    compressed with coding if that saves enough. Returns the codec the blob is stored with.
+    If the content is already stored the source file is just removed.
+    """
+    stored = _stored(digest)
+    if stored is not None:
+        os.unlink(src_path)
+        return stored or None
+
+    codec = None
+    if coding is not None:
+        tmp_path = _compress_file(src_path, coding)
+        if os.path.getsize(tmp_path) <= os.path.getsize(src_path) * (1 - MIN_SAVING):
+            os.unlink(src_path)
+            src_path, codec = tmp_path, coding.name
+        else:
+            os.unlink(tmp_path)
+
+    path = path_for(digest, codec)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(src_path, path)
+    return codec
+
+def _compress_file(src_path: str, coding: z.Coding) -> str:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(src_path), prefix=".tmp-")
+    try:
+        encoder = coding.encoder()
+        with open(src_path, "rb") as src, os.fdopen(fd, "wb") as dst:
+            while block := src.read(COPY_SIZE):
+                dst.write(encoder.compress(block))
+            dst.write(encoder.finish())
+            dst.flush()
+            os.fsync(dst.fileno())
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path
+
+def _stored(digest: str) -> str | None:
+    """
+    Codec of an already stored blob ("" if uncompressed), None if it isn't stored.
+    Its mtime is refreshed, so the orphan sweep (which only removes blobs older than a
+    grace period) leaves it alone until the message referencing it again is saved
+    """
+    for codec in ("", *z.CODINGS):
+        try:
+            os.utime(path_for(digest, codec))
+            return codec
+        except FileNotFoundError:
+            continue
+    return None
+
+def get(digest: str, codec: str | None = None) -> bytes | None:
+    """
+    Read a whole blob (uncompressed), None if it doesn't exist.
+    """
+    try:
+        with open_blob(digest, codec) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def open_blob(digest: str, codec: str | None = None):
+    """
+    Binary file-like object with the uncompressed contents of a blob.
+    """
+    f = open(path_for(digest, codec), "rb")
+    return z.DecodingReader(f, z.CODINGS[codec]) if codec else f
+
+def digests():
+    """
+    Digests of all stored blobs (partial uploads and temp files are skipped).
+    """
+    for prefix in os.listdir(BLOB_DIR) if os.path.isdir(BLOB_DIR) else ():
+        directory = os.path.join(BLOB_DIR, prefix)
+        if len(prefix) != 2 or not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            digest = name.split(".", 1)[0]
+            if len(digest) == 64 and not name.startswith("."):
+                yield digest
+
+def delete(digest: str, older_than: float) -> bool:
+    """
+    Remove a blob (in whichever coding it is stored) unless it was written or reused
+    after older_than (unix time). Returns True if it was removed.
+    """
+    removed = False
+    for codec in (None, *z.CODINGS):
+        path = path_for(digest, codec)
+        try:
+            if os.path.getmtime(path) >= older_than:
+                continue
+            os.unlink(path)
+            removed = True
+        except FileNotFoundError:
+            continue
+    return removed
@@ -1,88 +1,155 @@
 ### Handles database connection and crud updates
 
+import heapq
+import itertools
+import logging
 import sqlite3
+import threading
+from operator import itemgetter
+from typing import Iterator
 
 import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import shared.datatypes as t
+import migrations
+import blobstore
+import notify
+import writer
+import cache
+import metrics
+import shards
+
+DB_PATH = os.environ.get("FE_DB_PATH", "fe_data.db")
+
+log = logging.getLogger("fe.db")
+
+# connection tuning, applied once to every pooled connection
+PRAGMAS = (
+    ("auto_vacuum", "INCREMENTAL"), # new files only, migrations.migrate converts existing ones
+    ("journal_mode", "WAL"),        # readers don't block the writer and vice versa
+    ("synchronous", "FULL"),        # fsync every commit: NORMAL in WAL mode can lose the last commits on power loss
+    ("cache_size", -16000),         # page cache in KiB (negative) per connection
+    ("mmap_size", 268435456),       # 256 MiB memory mapped reads
+    ("busy_timeout", 5000),         # wait for the write lock instead of failing
+    ("foreign_keys", "ON"),
+)
+STATEMENT_CACHE_SIZE = 128
+
+# users and their keys are read on every request but almost never change.
+# register_user and invalidate_user drop entries, the TTL bounds staleness across processes
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 60
+user_cache = cache.TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+metrics.Callback("fe_user_cache_hits_total", "User lookups answered from the cache", lambda: user_cache.stats()["hits"], "counter")
+metrics.Callback("fe_user_cache_misses_total", "User lookups that went to the database", lambda: user_cache.stats()["misses"], "counter")
+metrics.Callback("fe_user_cache_hit_rate", "Share of user lookups answered from the cache", lambda: user_cache.stats()["hit_rate"])
+metrics.Callback("fe_user_cache_entries", "Users currently cached", lambda: user_cache.stats()["size"])
+
+# one persistent connection per worker thread and database file
+_local = threading.local()
+
+
+## Connection pool
+def get_connection(path: str | None = None) -> sqlite3.Connection:
+    """
+    Return the connection to path (default: the main database) owned by the calling thread,
+    opening it on first use. Connections are kept open for the lifetime of the thread.
+    """
+    conns = getattr(_local, "conns", None)
+    if conns is None or _local.path != DB_PATH:
+        close_connection()
+        conns = _local.conns = {}
+        _local.path = DB_PATH
+
+    path = path or DB_PATH
+    conn = conns.get(path)
+    if conn is None:
+        conn = conns[path] = open_connection(path)
+    return conn
+
+def open_connection(path: str | None = None, **kwargs) -> sqlite3.Connection:
+    """
+    Open a new, tuned connection that isn't part of the pool.
+    """
+    path = path or DB_PATH
+    conn = sqlite3.connect(path, cached_statements=STATEMENT_CACHE_SIZE, **kwargs)
+    for name, value in PRAGMAS:
+        conn.execute(f"PRAGMA {name} = {value}")
+    if path != DB_PATH:
+        # the users are in the main database, save_message checks the receiver itself
+        conn.execute("PRAGMA foreign_keys = OFF")
+    return conn
+
+def close_connection():
+    """
+    Close the connections owned by the calling thread (if any).
+    """
+    conns = getattr(_local, "conns", None)
+    if conns:
+        for conn in conns.values():
+            conn.close()
+    _local.conns = None
+
+def shard_connections() -> list[sqlite3.Connection]:
+    """The calling thread's connections to every file holding messages"""
+    return [get_connection(path) for path in shards.paths()]
 
 
 ## Healthcheck for database connection 
 def healthcheck():
-    print("## DATABASE HEALTHCHECK ##")
+    log.info("## DATABASE HEALTHCHECK ##")
     #if (conn == None or c == None):
     #    print("ERROR: Connection or database cursor not initialized.")
     #else:
     #    print("SUCCESS: Database connection successful")
 
-## Create the database tables
+## Create the database tables and bring the schema up to date
 def create_tables():
 
-    print("## CREATING DATABASE TABLES ##")
-
-
-    # establish DB connection
-    conn = sqlite3.connect("fe_data.db")  # Creates the file if it doesn't exist
-    c = conn.cursor()
-
-    # foreign key support
-    c.execute("PRAGMA foreign_keys = ON")
-
-    # User table
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        username TEXT PRIMARY KEY,
-        accesskey TEXT,
-        op INTEGER
-    )
-    """)
-
-    # Messages table
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY,
-        sender_id TEXT,
-        receiver_id TEXT,
-        timestamp INTEGER,
-        file_name TEXT,
-        file_type TEXT,
-        file_contents BLOB,
-        queue_deletion INTEGER,
-        FOREIGN KEY(sender_id) REFERENCES users(username),
-        FOREIGN KEY(receiver_id) REFERENCES users(username)
-    )
-    """)
-
-    conn.commit()  # Save changes
+    log.info("## CREATING DATABASE TABLES ##")
 
-    conn.close() # close connection
+    # establish DB connection, creates the file if it doesn't exist
+    version = migrations.migrate(get_connection())
+    shards.setup(get_connection())
 
-    print("SUCCESS: Table creation successful")
+    log.info("SUCCESS: Table creation successful (schema version %d)", version)
 
+@metrics.timed_db
 def fetch_user(username: str) -> t.User | None:
     """
     Fetch a user by username.
     Returns a User object if found, else None.
     """
-    conn = sqlite3.connect("fe_data.db")
-    c = conn.cursor()
-
-    query = """
-    SELECT username, accesskey, op
-    FROM users
-    WHERE username = ?
-    """
-
-    c.execute(query, (username,))
-    row = c.fetchone()
-    conn.close()
+    # the cache holds the row (or None for unknown users), every caller gets a fresh User
+    row = user_cache.get(username)
+    if row is cache.MISSING:
+        conn = get_connection()
+        c = conn.cursor()
+
+        query = """
+        SELECT username, accesskey, op
+        FROM users
+        WHERE username = ?
+        """
+
+        c.execute(query, (username,))
+        row = c.fetchone()
+        user_cache.set(username, row)
 
     if row:
         return t.User(False, row[0], row[1], row[2])
     else:
         return None
 
+def invalidate_user(username: str):
+    """
+    Drop a user from the cache. Call after anything that changes a user's key or op flag.
+    """
+    user_cache.invalidate(username)
+
+@metrics.timed_db
 def register_user(user: t.User):
     """
     Register a new user in the database.
@@ -95,114 +162,541 @@ def register_user(user: t.User):
     """
 
 
-    # establish DB connection
-    conn = sqlite3.connect("fe_data.db")  # Creates the file if it doesn't exist
+    conn = get_connection()
     c = conn.cursor()
 
     try:
         c.execute(query, (user.name, user.access_key, user.op))
         conn.commit()
-        print(f"User {user.name} registered successfully.")
+        invalidate_user(user.name)
+        log.info("User %s registered successfully.", user.name)
     except sqlite3.IntegrityError:
-        print(f"User {user.name} already exists.")
-    finally:
-        conn.close()
+        conn.rollback()
+        log.warning("User %s already exists.", user.name)
+
+# the header columns of the mailbox queries. All of them are in the covering indexes
+# idx_messages_receiver_headers / idx_messages_sender_headers, so listing a mailbox only
+# reads those indexes and never a message row with its (possibly long) text
+HEADER_COLUMNS = "id, sender_id, receiver_id, timestamp, preview, file_type, queue_deletion, content_length, content_kind"
+
+# two index range scans merged on id instead of a full table scan for the OR.
+# the second half skips messages to yourself, the first half already returned them.
+# ids grow in commit order, so this is the order the messages were sent in.
+# With sharded storage it runs on every shard (the received half only finds rows on the
+# receiver's shard), each with its own position of the cursor
+MAILBOX_QUERY = f"""
+SELECT {HEADER_COLUMNS}
+FROM messages
+WHERE receiver_id = ? AND id > ?
+UNION ALL
+SELECT {HEADER_COLUMNS}
+FROM messages
+WHERE sender_id = ? AND receiver_id <> ? AND id > ?
+ORDER BY id ASC
+LIMIT ?
+"""
+
+def _mailbox_cursors(user_name: str, after: list[int] | None = None, limit: int = -1) -> list[sqlite3.Cursor]:
+    """One cursor per shard over the mailbox rows above the shard's position in after, ordered by id"""
+    after = after or [0] * shards.SHARDS
+    return [
+        conn.execute(MAILBOX_QUERY, (user_name, after_id, user_name, user_name, after_id, limit))
+        for conn, after_id in zip(shard_connections(), after)
+    ]
+
+def _merged(cursors: list[sqlite3.Cursor], upto: list[int] | None = None) -> Iterator[tuple[int, tuple]]:
+    """(shard, row) of the cursors' rows by id, only up to the shard's position in upto"""
+    tagged = [
+        zip(itertools.repeat(shard), cursor if upto is None else itertools.takewhile(lambda row, top=top: row[0] <= top, cursor))
+        for shard, (cursor, top) in enumerate(zip(cursors, upto or itertools.repeat(None)))
+    ]
+    return tagged[0] if len(tagged) == 1 else heapq.merge(*tagged, key=lambda item: item[1][0])
+
+@metrics.timed_db
+def mailbox_position() -> list[int]:
+    """
+    The highest message id of every shard, a cursor for a mailbox read after this call.
+    A shard's ids commit in increasing order, every id up to it is visible to later reads
+    """
+    return [conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0] for conn in shard_connections()]
 
-def fetch_messages_for_user(user: t.User) -> t.Messages | None:
+@metrics.timed_db
+def fetch_messages_for_user(user: t.User, upto: list[int] | None = None) -> t.Messages | None:
+    """The whole mailbox, with upto (a mailbox_position()) only the messages it covers"""
     if not user.verified:
         return None
 
-    conn = sqlite3.connect("fe_data.db")
-    c = conn.cursor()
+    cursors = _mailbox_cursors(user.name)
+    if len(cursors) == 1 and upto is None:
+        return t.Messages.from_cursor(cursors[0])
+    return t.Messages.from_rows(row for _, row in _merged(cursors, upto))
 
-    query = """
-    SELECT id, sender_id, receiver_id, timestamp, file_name, file_type, queue_deletion
-    FROM messages
-    WHERE receiver_id = ? OR sender_id = ?
-    ORDER BY timestamp ASC
+@metrics.timed_db
+def iter_messages_for_user(user: t.User, upto: list[int] | None = None, batch_size: int = 500) -> Iterator[t.Messages]:
     """
-    c.execute(query, (user.name,user.name))
-    rows = c.fetchall()
-    conn.close()
+    The same mailbox as fetch_messages_for_user, in batches of up to batch_size messages.
+    Only one batch is in memory at a time, the whole iteration reads one consistent snapshot
+    (of each shard)
+    """
+    if not user.verified:
+        return
 
-    # fill file_contents with None explicitly
-    messages = t.Messages([
-        t.Message(
-            message_id=row[0],
-            sender_id=row[1],
-            receiver_id=row[2],
-            timestamp=row[3],
-            file_name=row[4][:50] if row[4] else None,
-            file_type=row[5],
-            file_contents=None,      # skipped
-            queue_deletion=row[6]
-        )
-        for row in rows
-    ])
+    cursors = _mailbox_cursors(user.name)
+    rows = (row for _, row in _merged(cursors, upto))
+    strings = {}
+    try:
+        while batch := list(itertools.islice(rows, batch_size)):
+            yield t.Messages.from_rows(batch, strings)
+    finally:
+        # a client that goes away mid-stream must not leave the read snapshot open
+        for c in cursors:
+            c.close()
 
-    return messages
+@metrics.timed_db
+def sync_messages_for_user(user: t.User, after: list[int], limit: int = 100) -> tuple[t.Messages, list[int], bool] | None:
+    """
+    Keyset page of a user's mailbox: up to limit messages above the per shard positions in
+    after (shards.parse_cursor), ordered by id. Returns the page, the positions after it and
+    whether more messages follow.
+    A shard's ids grow in its commit order, so a client that keeps the last id it saw of every
+    shard never misses a message (shards are read one after the other, a single position
+    could move past a lower id of a shard read earlier that commits later).
+    """
+    if not user.verified:
+        return None
+
+    # one extra row tells whether there is another page
+    rows = list(itertools.islice(_merged(_mailbox_cursors(user.name, after, limit + 1)), limit + 1))
+    position = list(after)
+    for shard, row in rows[:limit]:
+        position[shard] = row[0]
+    return t.Messages.from_rows(row for _, row in rows[:limit]), position, len(rows) > limit
+
+
+# ranked full-text matches among one user's messages (migration 10): the owners
+# column narrows the match down to the user's messages inside the FTS index
+SEARCH_QUERY = f"""
+SELECT {HEADER_COLUMNS}, snippet(messages_fts, 0, '[', ']', '...', 12), messages_fts.rank
+FROM messages_fts JOIN messages ON messages.id = messages_fts.rowid
+WHERE messages_fts MATCH ?
+ORDER BY messages_fts.rank
+LIMIT ? OFFSET ?
+"""
+
+def owner_token(user_name: str) -> str:
+    """The token a user name is indexed as in messages_fts.owners (like SQLite's hex())"""
+    return "u" + user_name.encode("utf-8").hex().upper()
+
+def match_expression(query: str) -> str | None:
+    """
+    FTS5 query for the words of a search: every word has to occur, a trailing * matches
+    a prefix. The words are quoted, so user input can't use (or break) the FTS5 syntax.
+    """
+    terms = []
+    for word in query.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms) or None
+
+@metrics.timed_db
+def search_messages(user: t.User, query: str, limit: int = 20, offset: int = 0) -> tuple[t.Messages, list[str]] | None:
+    """
+    Messages user sent or received whose text / file name matches query, best match first.
+    Returns (messages, snippet of each match), None if the query has no words.
+    """
+    terms = match_expression(query)
+    if terms is None or not user.verified:
+        return None
+    match = f"owners:{owner_token(user.name)} AND file_name:({terms})"
+    if shards.sharded():
+        # the best offset + limit of every shard, merged by their bm25 rank
+        pages = [conn.execute(SEARCH_QUERY, (match, offset + limit, 0)).fetchall() for conn in shard_connections()]
+        rows = list(heapq.merge(*pages, key=itemgetter(-1)))[offset:offset + limit]
+    else:
+        rows = get_connection().execute(SEARCH_QUERY, (match, limit, offset)).fetchall()
+    return t.Messages.from_rows([row[:-2] for row in rows]), [row[-2] for row in rows]
 
 
+def _find(query: str, params: tuple) -> tuple | None:
+    """First row of query on the shards, a message id is only on one of them"""
+    for conn in shard_connections():
+        row = conn.execute(query, params).fetchone()
+        if row:
+            return row
+    return None
 
+@metrics.timed_db
 def fetch_message_by_id(message_id: int) -> t.Message | None:
 
     """
     Fetch a single message by its ID.
     Returns a Message object if found, else None.
     """
-    conn = sqlite3.connect("fe_data.db")
-    c = conn.cursor()
-
     query = """
     SELECT id, sender_id, receiver_id, timestamp,
-           file_name, file_type, file_contents, queue_deletion
+           file_name, file_type, blob_hash, queue_deletion, blob_codec
     FROM messages
     WHERE id = ?
     """
 
-    c.execute(query, (message_id,))
-    row = c.fetchone()
-    conn.close()
+    row = _find(query, (message_id,))
 
     if row:
+        # file contents live in the blob store, the row only holds the hash
+        file_contents = blobstore.get(row[6], row[8]) if row[6] else None
         # match constructor: message_id, sender_id, receiver_id, timestamp, file_name, file_type, file_contents, queue_deletion
-        return t.Message(*row)
+        return t.Message(*row[:6], file_contents, row[7])
+    else:
+        return None
+
+@metrics.timed_db
+def fetch_message_ref(message_id: int) -> tuple[t.Message, str | None, int | None, str | None] | None:
+    """
+    Fetch a single message by its ID without loading its file contents.
+    Returns (Message, blob_hash, blob_size, blob_codec) if found, else None.
+    """
+    query = """
+    SELECT id, sender_id, receiver_id, timestamp,
+           file_name, file_type, queue_deletion, blob_hash, blob_size, blob_codec
+    FROM messages
+    WHERE id = ?
+    """
+
+    row = _find(query, (message_id,))
+
+    if row:
+        return t.Message(*row[:6], None, row[6]), row[7], row[8], row[9]
     else:
         return None
 
 
-def save_message(message: t.Message):
+# the id is writer.NEW_ID, filled in by the writer of the shard
+MESSAGE_INSERT = """
+INSERT INTO messages (
+    id, sender_id, receiver_id, timestamp,
+    file_name, file_type, blob_hash, blob_size, blob_codec,
+    queue_deletion, preview, content_length, content_kind
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+PREVIEW_LENGTH = 50  # characters of the text (or file name) listed in the mailbox
+
+BlobRef = tuple[str | None, int | None, str | None]   # (blob_hash, blob_size, blob_codec)
+
+def _store_contents(message: t.Message, blob_ref: BlobRef | None) -> BlobRef:
+    # file contents go to the blob store (stored once per distinct content, compressed
+    # if that's worth it), the row keeps the reference
+    if message.file_contents is None:
+        return blob_ref or (None, None, None)
+    contents = message.file_contents
+    if isinstance(contents, str):
+        contents = contents.encode("utf-8")
+    return blobstore.put(contents, blobstore.coding_for(message.file_name, message.file_type, len(contents)))
+
+def _insert_params(message: t.Message, blob: BlobRef) -> tuple:
+    return (
+        writer.NEW_ID,
+        message.sender_id,
+        message.receiver_id,
+        message.timestamp,
+        message.file_name,
+        message.file_type,
+        *blob,
+        message.queue_deletion,
+        *_header_params(message, blob[1])
+    )
+
+def _header_params(message: t.Message, blob_size: int | None) -> tuple[str | None, int, str]:
+    # (preview, content_length, content_kind), computed once here instead of on every fetch.
+    # a text message is its file_name, a file is in the blob store
+    if blob_size is None:
+        text = message.file_name or ""
+        return text[:PREVIEW_LENGTH], len(text.encode("utf-8")), "text"
+    return message.file_name[:PREVIEW_LENGTH] if message.file_name else None, blob_size, "file"
+
+@metrics.timed_db
+def save_message(message: t.Message, blob_ref: BlobRef | None = None) -> int | None:
     """
-    Save a message to the database.
+    Save a message to the database and notify waiting receivers.
+    Returns the id of the new message, None if it couldn't be saved.
     - sending_user: User object (sender)
     - receiving_user: User object (receiver)
     - message: Message object
+    - blob_ref: (hash, size, codec) of contents already in the blob store, instead of message.file_contents
     """
-    conn = sqlite3.connect("fe_data.db")
-    c = conn.cursor()
+    if shards.sharded() and fetch_user(message.receiver_id) is None:
+        # no foreign key to the users table on a shard
+        log.error("Error saving message: unknown receiver %s", message.receiver_id)
+        return None
+
+    blob = _store_contents(message, blob_ref)
+
+    # the insert is group-committed by the writer thread, result() returns once it is durable
+    try:
+        shard_writer = writer.get_writer(shards.path_of(message.receiver_id))
+        message_id = shard_writer.submit(MESSAGE_INSERT, _insert_params(message, blob)).result()
+        log.debug("Message from %s to %s saved.", message.sender_id, message.receiver_id)
+    except sqlite3.Error as e:
+        log.error("Error saving message: %s", e)
+        return None
+
+    message.message_id = message_id
+    notify.hub.publish(message.receiver_id)
+    return message.message_id
+
+@metrics.timed_db
+def save_messages(messages: list[t.Message], blob_ref: BlobRef | None = None) -> dict[str, int | None]:
+    """
+    Save the same content for several receivers (fan-out): the contents are stored
+    once and every known receiver gets a delivery row, all in a single transaction
+    (one per shard with sharded storage).
+    Returns {receiver_id: id of its message, or None if the receiver doesn't exist}.
+    """
+    if not messages:
+        return {}
+
+    receivers = [m.receiver_id for m in messages]
+    placeholders = ",".join("?" * len(receivers))
+    rows = get_connection().execute(f"SELECT username FROM users WHERE username IN ({placeholders})", receivers)
+    known = {row[0] for row in rows}
+
+    results: dict[str, int | None] = {receiver: None for receiver in receivers}
+    deliveries = [m for m in messages if m.receiver_id in known]
+    if not deliveries:
+        return results
+
+    blob = _store_contents(deliveries[0], blob_ref)
+    by_shard: dict[str, list[t.Message]] = {}
+    for m in deliveries:
+        by_shard.setdefault(shards.path_of(m.receiver_id), []).append(m)
+    # one transaction per shard
+    futures = [
+        (group, writer.get_writer(path).submit_many([(MESSAGE_INSERT, _insert_params(m, blob)) for m in group]))
+        for path, group in by_shard.items()
+    ]
+
+    saved = 0
+    for group, future in futures:
+        try:
+            message_ids = future.result()
+        except sqlite3.Error as e:
+            log.error("Error saving messages: %s", e)
+            continue
+        for message, message_id in zip(group, message_ids):
+            message.message_id = message_id
+            results[message.receiver_id] = message_id
+            notify.hub.publish(message.receiver_id)
+        saved += len(group)
+    log.debug("Message from %s to %d receivers saved.", deliveries[0].sender_id, saved)
+    return results
+
+
+@metrics.timed_db
+def create_upload(upload: dict):
+    """
+    Register a new chunked upload session.
+    """
+    conn = get_connection()
 
     query = """
-    INSERT INTO messages (
-        sender_id, receiver_id, timestamp,
-        file_name, file_type, file_contents,
-        queue_deletion
+    INSERT INTO uploads (id, sender_id, receiver_id, receiver_ids, file_name, file_type, total_size, sha256, received, created)
+    VALUES (:id, :sender_id, :receiver_id, :receiver_ids, :file_name, :file_type, :total_size, :sha256, 0, :created)
+    """
+
+    with conn:
+        conn.execute(query, upload)
+
+@metrics.timed_db
+def fetch_upload(upload_id: str) -> dict | None:
+    """
+    Fetch an upload session by its ID.
+    Returns a dict with the session columns if found, else None.
+    """
+    conn = get_connection()
+
+    query = """
+    SELECT id, sender_id, receiver_id, receiver_ids, file_name, file_type, total_size, sha256, received, created
+    FROM uploads
+    WHERE id = ?
+    """
+
+    c = conn.execute(query, (upload_id,))
+    row = c.fetchone()
+
+    if row:
+        return dict(zip([col[0] for col in c.description], row))
+    else:
+        return None
+
+@metrics.timed_db
+def update_upload_progress(upload_id: str, received: int):
+    """
+    Record how many bytes of an upload are safely on disk.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute("UPDATE uploads SET received = ? WHERE id = ?", (received, upload_id))
+
+@metrics.timed_db
+def delete_upload(upload_id: str):
+    conn = get_connection()
+    with conn:
+        conn.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+
+
+## Retention and maintenance (see maintenance.py)
+
+@metrics.timed_db
+def mark_read(message_id: int, receiver_id: str, read_at: int):
+    """
+    Queue a message for deletion once its receiver has read it: queue_deletion becomes
+    the time of the first read. Handed to the writer without waiting for the commit
+    """
+    writer.get_writer(shards.path_of(receiver_id)).submit(
+        "UPDATE messages SET queue_deletion = ? WHERE id = ? AND receiver_id = ? AND queue_deletion = 0",
+        (read_at, message_id, receiver_id)
     )
-    VALUES (?, ?, ?, ?, ?, ?, ?)
+
+def mark_read_many(message_ids: list[int], receiver_id: str, read_at: int):
+    """
+    mark_read for several messages in one writer transaction, without waiting for the commit.
+    """
+    if message_ids:
+        writer.get_writer(shards.path_of(receiver_id)).submit_many([
+            ("UPDATE messages SET queue_deletion = ? WHERE id = ? AND receiver_id = ? AND queue_deletion = 0",
+             (read_at, message_id, receiver_id))
+            for message_id in message_ids
+        ])
+
+@metrics.timed_db
+def fetch_message_refs(message_ids: list[int], user_name: str) -> dict[int, tuple[t.Message, str | None, int | None, str | None]]:
     """
+    fetch_message_ref for several ids in one query (primary key lookups), limited to the
+    messages user_name sent or received.
+    Returns {id: (Message, blob_hash, blob_size, blob_codec)}, ids the user can't see are left out.
+    """
+    if not message_ids:
+        return {}
+    placeholders = ",".join("?" * len(message_ids))
+    query = f"""
+    SELECT id, sender_id, receiver_id, timestamp,
+           file_name, file_type, queue_deletion, blob_hash, blob_size, blob_codec
+    FROM messages
+    WHERE id IN ({placeholders}) AND (receiver_id = ? OR sender_id = ?)
+    """
+    refs = {}
+    for conn in shard_connections():
+        for row in conn.execute(query, (*message_ids, user_name, user_name)):
+            refs[row[0]] = (t.Message(*row[:6], None, row[6]), row[7], row[8], row[9])
+    return refs
+
+@metrics.timed_db
+def fetch_unread_ids(receiver_id: str, after_id: int, limit: int) -> list[int]:
+    """Ids of up to limit unread messages sent to receiver_id with an id above after_id, ascending"""
+    rows = get_connection(shards.path_of(receiver_id)).execute("""
+    SELECT id FROM messages
+    WHERE receiver_id = ? AND id > ? AND queue_deletion = 0
+    ORDER BY id
+    LIMIT ?
+    """, (receiver_id, after_id, limit))
+    return [row[0] for row in rows]
+
+def _gather(query: str, params: tuple, limit: int | None = None) -> list[tuple]:
+    """Rows of query from every shard, up to limit of them"""
+    rows = []
+    for conn in shard_connections():
+        rows += conn.execute(query, params).fetchall()
+        if limit is not None and len(rows) >= limit:
+            return rows[:limit]
+    return rows
+
+@metrics.timed_db
+def fetch_read_before(read_before: int, limit: int) -> list[tuple[int, str | None]]:
+    """(id, blob_hash) of up to limit messages that were read before read_before"""
+    return _gather("""
+    SELECT id, blob_hash FROM messages
+    WHERE queue_deletion > 0 AND queue_deletion < ?
+    LIMIT ?
+    """, (read_before, limit), limit)
+
+@metrics.timed_db
+def fetch_sent_before(sent_before: int, limit: int) -> list[tuple[int, str | None]]:
+    """(id, blob_hash) of up to limit messages sent before sent_before"""
+    return _gather("""
+    SELECT id, blob_hash FROM messages
+    WHERE timestamp < ?
+    LIMIT ?
+    """, (sent_before, limit), limit)
+
+@metrics.timed_db
+def fetch_full_mailboxes(max_messages: int) -> list[tuple[str, int]]:
+    """(receiver_id, messages above max_messages) of every receiver over the limit"""
+    # a receiver's messages are all on one shard
+    return _gather("""
+    SELECT receiver_id, COUNT(*) - ? FROM messages
+    GROUP BY receiver_id
+    HAVING COUNT(*) > ?
+    """, (max_messages, max_messages))
+
+@metrics.timed_db
+def fetch_oldest_received(receiver_id: str, limit: int) -> list[tuple[int, str | None]]:
+    """(id, blob_hash) of the limit oldest messages sent to receiver_id"""
+    return get_connection(shards.path_of(receiver_id)).execute("""
+    SELECT id, blob_hash FROM messages
+    WHERE receiver_id = ?
+    ORDER BY id ASC
+    LIMIT ?
+    """, (receiver_id, limit)).fetchall()
+
+@metrics.timed_db
+def delete_messages(message_ids: list[int]):
+    """
+    Delete messages by id in one short write transaction (through the writer).
+    Sharded, every shard deletes whichever of the ids it has, in parallel
+    """
+    if not message_ids:
+        return
+    placeholders = ",".join("?" * len(message_ids))
+    futures = [
+        writer.get_writer(path).submit(f"DELETE FROM messages WHERE id IN ({placeholders})", tuple(message_ids))
+        for path in shards.paths()
+    ]
+    for future in futures:
+        future.result()
+
+@metrics.timed_db
+def blob_referenced(blob_hash: str) -> bool:
+    # shards share the blob store
+    return any(
+        conn.execute("SELECT 1 FROM messages WHERE blob_hash = ? LIMIT 1", (blob_hash,)).fetchone() is not None
+        for conn in shard_connections()
+    )
 
-    try:
-        c.execute(query, (
-            message.sender_id,
-            message.receiver_id,
-            message.timestamp,
-            message.file_name,
-            message.file_type,
-            message.file_contents,
-            message.queue_deletion
-        ))
-        conn.commit()
-        print(f"Message from {message.sender_id} to {message.receiver_id} saved.")
-    except sqlite3.Error as e:
-        print(f"Error saving message: {e}")
-    finally:
-        conn.close()
+@metrics.timed_db
+def fetch_uploads_created_before(created_before: int) -> list[str]:
+    rows = get_connection().execute("SELECT id FROM uploads WHERE created < ?", (created_before,)).fetchall()
+    return [row[0] for row in rows]
+
+@metrics.timed_db
+def incremental_vacuum(pages: int) -> int:
+    """
+    Give up to pages free pages of every database file back to the file system,
+    returns how many were freed. Bounded so the write lock is only held briefly
+    """
+    freed = 0
+    for path in shards.databases():
+        conn = get_connection(path)
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # the pragma frees one page per result row, it only runs completely when all rows are read
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        freed += before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return freed
+
+@metrics.timed_db
+def optimize():
+    """Let SQLite refresh the query planner statistics where they went stale"""
+    for path in shards.databases():
+        get_connection(path).execute("PRAGMA optimize")
@@ -0,0 +1,64 @@
+### Server logging
+###
+### Every record goes through a QueueHandler, a QueueListener thread formats it
+### and does the blocking write to stdout, so request threads never wait on the
+### terminal. "json" writes one JSON object per line, fields passed with
+### extra={...} end up as keys of that object.
+
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+# attributes every LogRecord has, anything else came in through extra={...}
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName", "color_message"}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup(level: str = "INFO", fmt: str = "text"):
+    """
+    Route all logging through a queue to a background writer thread.
+    """
+    global _listener
+    shutdown()
+
+    handler = logging.StreamHandler(sys.stdout)
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(name)s: %(message)s"))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+
+def shutdown():
+    """
+    Write out whatever is still queued and stop the writer thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
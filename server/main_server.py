@@ -2,37 +2,138 @@ import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import database as db
+import serving
+import asgi
+import uploads
+import blobstore
+import notify
+import maintenance
+import writer
+import shards
+import prefork
+import admission
+import logs
+import metrics
 import shared.signature as s
 import shared.datatypes as t
+import shared.codec as c
+import shared.compression as z
 import time
+import argparse
+import base64
+import logging
+import flask
 from flask import Flask, request, jsonify, abort
+from werkzeug.wsgi import ClosingIterator
 
 app = Flask(__name__)
+log = logging.getLogger("fe.server")
 
 VERIFICATION_REQUIRED = False # Skips signature validation check:     TURN OFF IN PRODUCTION!
+SYNC_PAGE_SIZE = 100          # default page size of /fetch?cursor=
+SYNC_MAX_PAGE_SIZE = 500
+WAIT_TIMEOUT = 30             # default seconds a /wait long-poll blocks
+WAIT_MAX_TIMEOUT = 60
+MAX_RECEIVERS = 100           # receivers per /send_many or upload
+MAX_READ_BATCH = 500          # messages per /read_many
+SEARCH_PAGE_SIZE = 20         # default page size of /search
+SEARCH_MAX_PAGE_SIZE = 100
+READ_INLINE_MAX = 8 * 1024 ** 2  # larger files aren't inlined by /read_many, the client /downloads them
+DOWNLOAD_CACHE_CONTROL = "private, max-age=31536000, immutable"  # contents of a message never change, but they're the user's
  
 def main():
-    print("## Server started... ##")
-    db.healthcheck()
-    db.create_tables()
+    parser = argparse.ArgumentParser(description="Fe server")
+    parser.add_argument("--mode", choices=["threaded", "asgi"], default="threaded",
+                        help="threaded: werkzeug with a fixed worker pool, asgi: asyncio server (needs uvicorn)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=26834)
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="DEBUG also logs response bodies")
+    parser.add_argument("--no-maintenance", action="store_true",
+                        help="don't run the retention / compaction worker (maintenance.py) in this process")
+    parser.add_argument("--log-format", default="text", choices=["text", "json"],
+                        help="json: one JSON object per line")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the listening socket (prefork.py), 1 serves from this process")
+    # set by prefork.py for the processes it starts
+    parser.add_argument("--worker-fd", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-index", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--ready-fd", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logs.setup(args.log_level, args.log_format)
 
-    print("## Server initializing endpoints ##")
-    #unit_tests()
-    app.run(host="0.0.0.0", port=26834, debug=False)
+    if args.worker_fd is None:
+        log.info("## Server started... ##")
+        db.healthcheck()
+        db.create_tables()
+        #unit_tests()
+        db.close_connection()
+        if args.workers > 1:
+            # migrated once here, the workers start on the current schema
+            prefork.serve(sys.argv, host=args.host, port=args.port, workers=args.workers)
+            logs.shutdown()
+            return
+    else:
+        # a message saved by another worker isn't published to this process' hub
+        notify.poll_interval = notify.CROSS_PROCESS_POLL
+
+    log.info("## Server initializing endpoints ##")
+    # one maintenance worker per database, in the first worker process
+    if not args.no_maintenance and args.worker_index == 0:
+        maintenance.worker.start()
+    prefork.ready(args.ready_fd)
+    limits = {"max_pending": admission.MAX_IN_FLIGHT} if admission.MAX_IN_FLIGHT else {}
+    if args.mode == "asgi":
+        asgi.serve(app, host=args.host, port=args.port, fd=args.worker_fd, max_body=admission.max_body(), **limits)
+    else:
+        # a blocking /wait holds its thread, extra threads for them keep the others serving
+        serving.serve(app, host=args.host, port=args.port, workers=serving.WORKER_THREADS + notify.MAX_WAITERS,
+                      fd=args.worker_fd, on_stop=notify.hub.close, **limits)
+    maintenance.worker.stop()
+    writer.close_writer()  # commit whatever is still queued
+    logs.shutdown()
 
 def get_timestamp():
     return int(time.time())
 
+def request_data() -> dict:
+    """
+    Request body decoded by its Content-Encoding (gzip / zstd) and Content-Type (JSON or msgpack).
+    """
+    codec = c.for_content_type(request.mimetype)
+    if codec is None:
+        abort(415, description=f"unsupported content type, use one of {', '.join(c.CODECS)}")
+    body = request.get_data()
+    coding = request_coding()
+    if coding is not None:
+        try:
+            body = coding.decompress(body)
+        except ValueError as e:
+            abort(400, description=f"body can't be decoded: {e}")
+    return codec.loads(body)
+
+def request_coding() -> z.Coding | None:
+    """
+    Coding named by the request's Content-Encoding, None for an uncompressed body.
+    """
+    name = request.headers.get("Content-Encoding", "identity").strip().lower()
+    if name == "identity":
+        return None
+    coding = z.by_name(name)
+    if coding is None:
+        abort(415, description=f"unsupported content encoding, use one of {', '.join(z.CODINGS)}")
+    return coding
+
 def get_verified_user(sender_id, key, signature) -> t.User | None:
 
     if (sender_id == "unknown" or key == "unknown" or signature == "unknown"):
-        print(f"VERIFY USER: Invalid arguments. At least one is unknown. Sender ID {sender_id}, Key {key}, Signature {signature}")
+        log.debug("VERIFY USER: Invalid arguments. At least one is unknown. Sender ID %s, Key %s", sender_id, key)
         return None
 
     user: t.User = db.fetch_user(sender_id)
     
     if user == None:
-        print("VERIFY USER: Invalid user: " + sender_id)
+        log.warning("VERIFY USER: Invalid user: %s", sender_id)
         return None
     
     secret: str = user.access_key
@@ -45,6 +146,102 @@ def get_verified_user(sender_id, key, signature) -> t.User | None:
 
     return user
 
+### INSTRUMENTATION ###
+
+@app.before_request
+def start_timer():
+    # a parked /wait is dispatched again with the environ keys of its first run (asgi.py)
+    flask.g.started = request.environ.setdefault("fe.started", time.perf_counter())
+
+### ADMISSION CONTROL ###
+
+## rate limits and body size limits, decided from the route and headers alone
+## before the view parses anything (admission.py)
+@app.before_request
+def admit():
+    if asgi.PARK_DEADLINE in request.environ:
+        return None     # a parked /wait coming back, admitted the first time
+    endpoint = request.url_rule.rule if request.url_rule else None
+    # the claimed sender isn't verified yet: with the address, others can't drain this user's buckets
+    sender = (request.args.get("sender_id") or request.headers.get("X-Fe-Sender"), request.remote_addr)
+    rejection = admission.check(endpoint, sender, request.content_length)
+    if rejection is not None:
+        status, retry_after, message = rejection
+        response = jsonify({"status" : status, "message" : message})
+        if retry_after is not None:
+            response.headers["Retry-After"] = str(retry_after)
+        return response, status
+    # also bounds bodies sent without a Content-Length (chunked)
+    request.max_content_length = admission.body_limit(endpoint)
+
+## latency and sizes are recorded once the body is sent (call_on_close, a ClosingIterator
+## for files), so streamed /fetch answers and file downloads count with their full duration
+@app.after_request
+def record_request(response):
+    if asgi.PARK_HEADER in response.headers:
+        return response     # recorded when the long-poll answers
+    started = flask.g.get("started", time.perf_counter())
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    method, status = request.method, str(response.status_code)
+    metrics.REQUEST_BYTES.inc(request.content_length or 0, endpoint)
+
+    sent = [response.content_length]
+    if sent[0] is None and not response.direct_passthrough:
+        response.response = counted(response.response, sent)
+
+    def finished():
+        size = sent[0] or 0
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint, method, status)
+        metrics.RESPONSE_BYTES.inc(size, endpoint)
+        metrics.RESPONSE_SIZE.observe(size, endpoint)
+
+    if response.direct_passthrough:
+        # werkzeug hands these bodies (files) to the server as they are and never calls the response's close()
+        response.response = ClosingIterator(response.response, finished)
+    else:
+        response.call_on_close(finished)
+    return response
+
+def counted(body, sent: list):
+    sent[0] = 0
+    for chunk in body:
+        sent[0] += len(chunk)
+        yield chunk
+
+## responses are compressed with the best coding the client accepts (zstd, gzip).
+## Runs before record_request (after_request handlers run in reverse order), so the
+## metrics count the bytes actually sent. Files (direct_passthrough) handle this themselves.
+@app.after_request
+def compress_response(response):
+    response.headers["Accept-Encoding"] = ", ".join(z.CODINGS)  # request bodies may use these too
+    if (response.status_code != 200 or request.method == "HEAD" or response.direct_passthrough
+            or "Content-Encoding" in response.headers or "ETag" in response.headers
+            or z.is_compressed_type(response.mimetype)):
+        return response
+    coding = z.negotiate(request.headers.get("Accept-Encoding"))
+    if coding is None:
+        return response
+
+    if response.is_streamed:
+        # /fetch streams its JSON, every piece is flushed so the client can parse as it arrives
+        response.response = coding.compress_stream(response.response)
+        response.headers.pop("Content-Length", None)
+    else:
+        body = response.get_data()
+        if len(body) < z.MIN_SIZE:
+            return response
+        response.set_data(coding.compress(body))
+    response.headers["Content-Encoding"] = coding.name
+    response.vary.add("Accept-Encoding")
+    return response
+
+##
+## Prometheus metrics: request latency per endpoint, database call timings, payload sizes, cache hit rates
+##
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 ### ENDPOINTS ###
 
 ##
@@ -66,18 +263,148 @@ def fetch_messages():
     signature   = data.get("signature",     "unknown")      # default to "unknown" if not provided
     sender_id   = data.get("sender_id",     "unknown")      # default to "unknown" if not provided
 
-    print(f"FETCH: DATA RECEIVED %s", data)
+    log.debug("FETCH: sender_id=%s cursor=%s", sender_id, data.get("cursor"))
+
+    user: t.User = get_verified_user(sender_id, "FTCH", signature)
+    # checked up front: errors inside the streamed body come after the 200 went out
+    if (user is None or user.verified == False):
+        log.warning("FETCH: User couldn't be verified")
+        abort(403, description="FETCH: User couldn't be verified")
 
     try:
-        user: t.User = get_verified_user(sender_id, "FTCH", signature)
-        messages: t.Messages  = db.fetch_messages_for_user(user)
-        response = messages.serialize()
-        print(response)
+        if "cursor" in data:
+            return sync_messages(user, data)
+        # the cursor to continue from with ?cursor=, taken before the mailbox is read
+        # and the mailbox is cut off there, later messages come with the next sync
+        position = db.mailbox_position()
+        codec = c.negotiate(request.headers.get("Accept"))
+        if codec is c.JSON:
+            response = flask.Response(stream_mailbox(user, position), mimetype=codec.mimetype)
+        else:
+            messages: t.Messages  = db.fetch_messages_for_user(user, position)
+            response = flask.make_response(messages.encode(codec))
+            response.mimetype = codec.mimetype
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("FETCH: %r", response.get_data())
+        response.headers["X-Fe-Cursor"] = shards.format_cursor(position)
         return response
     except:
-        print("FETCH: User couldn't be verified")
+        log.warning("FETCH: User couldn't be verified")
         abort(403, description="FETCH: User couldn't be verified")
 
+## The whole mailbox as a JSON array, sent batch by batch while the cursor is read,
+## so server memory doesn't grow with the size of the mailbox
+def stream_mailbox(user: t.User, position: list[int]):
+    for piece in c.JSON.dumps_iter(batch.to_dict() for batch in db.iter_messages_for_user(user, position)):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("FETCH: %r", piece)
+        yield piece
+
+## Incremental sync: ?cursor=<X-Fe-Cursor of the last answer>&limit=<page size>
+## Returns the next page as a JSON array, the cursor to continue from in the
+## X-Fe-Cursor header and whether more pages follow in X-Fe-More
+def sync_messages(user: t.User, data):
+    try:
+        cursor, limit = sync_params(data)
+    except (TypeError, ValueError):
+        return jsonify({"status" : 400, "message" : "cursor and limit have to be integers"}), 400
+    return sync_response(*db.sync_messages_for_user(user, cursor, limit))
+
+def sync_params(data) -> tuple[list[int], int]:
+    """Per shard cursor and page size of a sync request, ValueError if malformed"""
+    cursor = shards.parse_cursor(data.get("cursor"))
+    limit = max(1, min(int(data.get("limit") or SYNC_PAGE_SIZE), SYNC_MAX_PAGE_SIZE))
+    return cursor, limit
+
+def sync_response(messages: t.Messages, cursor: list[int], more: bool):
+    codec = c.negotiate(request.headers.get("Accept"))
+    response = flask.make_response(messages.encode(codec))
+    response.mimetype = codec.mimetype
+    response.headers["X-Fe-Cursor"] = shards.format_cursor(cursor)
+    response.headers["X-Fe-More"] = "1" if more else "0"
+    return response
+
+##
+## Long-poll for NEW messages: blocks until a message above ?cursor= arrives
+## for the user (or ?timeout= seconds pass), then answers like /fetch?cursor=
+## Signature key is WAIT
+##
+@app.route("/wait", methods=["GET"])
+def wait_for_messages():
+    data = request.args
+    signature   = data.get("signature",     "unknown")      # default to "unknown" if not provided
+    sender_id   = data.get("sender_id",     "unknown")      # default to "unknown" if not provided
+
+    user: t.User = get_verified_user(sender_id, "WAIT", signature)
+
+    if (user is None or user.verified == False):
+        return jsonify({"status" : 403, "message" : "signature dosen't match. user couldn't be verified"}), 403
+
+    try:
+        cursor, limit = sync_params(data)
+        timeout = max(0, min(float(data.get("timeout") or WAIT_TIMEOUT), WAIT_MAX_TIMEOUT))
+    except (TypeError, ValueError):
+        return jsonify({"status" : 400, "message" : "cursor, limit and timeout have to be numbers"}), 400
+
+    # anything already there is returned right away, otherwise wait for save_message to publish
+    # (and look in the database every notify.poll_interval seconds for messages of other processes)
+    deadline = request.environ.setdefault(asgi.PARK_DEADLINE, time.monotonic() + timeout)
+    while True:
+        # taken before the database is read: a message saved after the read ends the wait
+        version = notify.hub.version(user.name)
+        page = db.sync_messages_for_user(user, cursor, limit)
+        remaining = deadline - time.monotonic()
+        if page[0] or remaining <= 0:
+            return sync_response(*page)
+        if request.environ.get(asgi.PARKING):
+            # asgi: the event loop waits without holding a thread, then dispatches the request again
+            response = flask.make_response("", 202)
+            response.headers[asgi.PARK_HEADER] = f"{version} {user.name}"
+            return response
+        if notify.hub.wait(user.name, version, min(remaining, notify.poll_interval or remaining)) is None:
+            response = jsonify({"status" : 503, "message" : "too many waiting clients, poll again later"})
+            response.headers["Retry-After"] = "5"
+            return response, 503
+
+##
+## SEARCH the text and file names of the user's own messages (sent and received): ?q=<words>
+## every word has to occur, "word*" matches a prefix. Best matches first, paginated with
+## ?limit= and ?offset=, X-Fe-More: 1 means another page follows.
+## Returns the message headers like /fetch, each with a "snippet" of the matching text
+## Signature key is SRCH
+##
+@app.route("/search", methods=["GET"])
+def search_messages():
+    data = request.args
+    signature   = data.get("signature",     "unknown")      # default to "unknown" if not provided
+    sender_id   = data.get("sender_id",     "unknown")      # default to "unknown" if not provided
+
+    user: t.User = get_verified_user(sender_id, "SRCH", signature)
+
+    if (user is None or user.verified == False):
+        return jsonify({"status" : 403, "message" : "signature dosen't match. user couldn't be verified"}), 403
+
+    try:
+        limit = max(1, min(int(data.get("limit") or SEARCH_PAGE_SIZE), SEARCH_MAX_PAGE_SIZE))
+        offset = max(0, int(data.get("offset") or 0))
+    except ValueError:
+        return jsonify({"status" : 400, "message" : "limit and offset have to be integers"}), 400
+
+    # one extra row tells whether there is another page
+    found = db.search_messages(user, data.get("q", ""), limit + 1, offset)
+    if found is None:
+        return jsonify({"status" : 400, "message" : "nothing to search for"}), 400
+    messages, snippets = found
+
+    results = messages[:limit].to_dict()
+    for result, snippet in zip(results, snippets):
+        result["snippet"] = snippet
+    codec = c.negotiate(request.headers.get("Accept"))
+    response = flask.make_response(codec.dumps(results))
+    response.mimetype = codec.mimetype
+    response.headers["X-Fe-More"] = "1" if len(messages) > limit else "0"
+    return response
+
 ##
 ## Retrieve a SINGLE message for a user
 ## Signature key is message_id
@@ -92,25 +419,151 @@ def read_message():
     
     user: t.User = get_verified_user(sender_id, message_id, signature)
 
-    if (user.verified == False):
-        return jsonify({"status" : 403, "message" : "signature dosen't match. user couldn't be verified"})
-    
-    message: t.Message = db.fetch_message_by_id(int(message_id))
+    if (user is None or user.verified == False):
+        return jsonify({"status" : 403, "message" : "signature dosen't match. user couldn't be verified"}), 403
+
+    message: t.Message = db.fetch_message_by_id(int(message_id)) if message_id.isdigit() else None
+    if message is None or user.name not in (message.sender_id, message.receiver_id):
+        return jsonify({"status" : 404, "message" : "message not found"}), 404
+    if message.receiver_id == user.name:
+        db.mark_read(message.message_id, user.name, get_timestamp())
     return message.serialize()
 
+##
+## READ several messages in one request: POST {"message_ids": [...]} (at most MAX_READ_BATCH),
+## or {"unread": true, "after": <id>} for the caller's unread messages above that id.
+## The answer is streamed as NDJSON, one line per message in the requested order:
+## the message like /read (file contents base64), {"id", "status": 404} for ids the caller
+## can't see, files above READ_INLINE_MAX come without contents and "download": true
+## Signature key is signature.read_many_key(message_ids), "UNRD" for unread
+##
+@app.route("/read_many", methods=["POST"])
+def read_many():
+    data = request_data()  # Expect JSON (or msgpack) body
+    signature   = data.get("signature",     "unknown")      # default to "unknown" if not provided
+    sender_id   = data.get("sender_id",     "unknown")      # default to "unknown" if not provided
+    unread      = bool(data.get("unread"))
+
+    try:
+        if unread:
+            key = "UNRD"
+        else:
+            message_ids = list(dict.fromkeys(int(message_id) for message_id in data.get("message_ids") or []))
+            key = s.read_many_key(message_ids)
+        limit = max(1, min(int(data.get("limit") or MAX_READ_BATCH), MAX_READ_BATCH))
+        after = int(data.get("after") or 0)
+    except (TypeError, ValueError):
+        return jsonify({"status" : 400, "message" : "message_ids have to be integers"}), 400
+
+    user: t.User = get_verified_user(sender_id, key, signature)
+
+    if (user is None or user.verified == False):
+        return jsonify({"status" : 403, "message" : "signature dosen't match. user couldn't be verified"}), 403
+
+    if unread:
+        message_ids = db.fetch_unread_ids(user.name, after, limit)
+    elif len(message_ids) > MAX_READ_BATCH:
+        return jsonify({"status" : 400, "message" : f"at most {MAX_READ_BATCH} messages per request"}), 400
+
+    # ownership of the whole batch is checked in one query
+    refs = db.fetch_message_refs(message_ids, user.name)
+    db.mark_read_many([i for i, ref in refs.items() if ref[0].receiver_id == user.name], user.name, get_timestamp())
+    return flask.Response(stream_read_many(message_ids, refs), mimetype="application/x-ndjson")
+
+## one line per message, a blob is only read from disk when its line is written
+def stream_read_many(message_ids: list[int], refs: dict):
+    for message_id in message_ids:
+        ref = refs.get(message_id)
+        if ref is None:
+            yield c.JSON.dumps({"id": message_id, "status": 404}) + b"\n"
+            continue
+        message, blob_hash, blob_size, blob_codec = ref
+        entry = {"status": 200}
+        if blob_hash is not None and blob_size > READ_INLINE_MAX:
+            entry["download"] = True
+        elif blob_hash is not None:
+            message.file_contents = blobstore.get(blob_hash, blob_codec)
+        entry.update(message.to_dict())
+        yield c.JSON.dumps(entry) + b"\n"
+
+##
+## DOWNLOAD the contents of a SINGLE message as raw bytes (no JSON, no base64)
+## Files are streamed from the blob store and support Range / If-None-Match (ETag is the SHA-256),
+## text messages are returned as text/plain
+## Signature key is message_id
+##
+@app.route("/download", methods=["GET"])
+def download_message():
+    data = request.args  # Expect args
+    signature   = data.get("signature",     "unknown")      # default to "unknown" if not provided
+    sender_id   = data.get("sender_id",     "unknown")      # default to "unknown" if not provided
+    message_id  = data.get("message_id",    "unknown")
+
+    user: t.User = get_verified_user(sender_id, message_id, signature)
+
+    if (user is None or user.verified == False):
+        return jsonify({"status" : 403, "message" : "signature dosen't match. user couldn't be verified"}), 403
+
+    ref = db.fetch_message_ref(int(message_id)) if message_id.isdigit() else None
+    if ref is None or user.name not in (ref[0].sender_id, ref[0].receiver_id):
+        return jsonify({"status" : 404, "message" : "message not found"}), 404
+    message, blob_hash, blob_size, blob_codec = ref
+    if message.receiver_id == user.name:
+        db.mark_read(message.message_id, user.name, get_timestamp())
+
+    if blob_hash is None:
+        # text message, the text is the file_name
+        response = flask.make_response(message.file_name or "")
+        response.mimetype = "text/plain"
+        response.set_etag(f"msg-{message.message_id}")
+        return response.make_conditional(request)
+
+    mimetype = message.file_type if message.file_type and "/" in message.file_type else "application/octet-stream"
+    download_name = message.file_name or str(message.message_id)
+    if blob_codec is None or (z.accepts(request.headers.get("Accept-Encoding"), blob_codec) and "Range" not in request.headers):
+        # stored as it is, or compressed and the client takes it that way: the file goes out unchanged
+        response = flask.send_file(
+            os.path.abspath(blobstore.path_for(blob_hash, blob_codec)),
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=download_name,
+            conditional=True,
+            etag=f"{blob_hash}.{blob_codec}" if blob_codec else blob_hash
+        )
+        response.headers["Cache-Control"] = DOWNLOAD_CACHE_CONTROL
+        if blob_codec is not None:
+            response.headers["Content-Encoding"] = blob_codec
+            response.vary.add("Accept-Encoding")
+        return response
+
+    # compressed at rest but the client wants the plain bytes (or a range of them): decode while sending
+    response = flask.send_file(
+        blobstore.open_blob(blob_hash, blob_codec),
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=download_name,
+        conditional=False,
+        etag=False
+    )
+    response.headers["Cache-Control"] = DOWNLOAD_CACHE_CONTROL
+    response.content_length = blob_size
+    response.set_etag(blob_hash)
+    response.vary.add("Accept-Encoding")
+    return response.make_conditional(request, accept_ranges=True, complete_length=blob_size)
+
 ##
 ## SAVE a MESSAGE to the database for the user
 ## signature key is message_text[:32]
 ##
 @app.route("/send_message", methods=["POST"])
 def send_message():
-    data = request.json  # Expect JSON body
+    data = request_data()  # Expect JSON (or msgpack) body
     signature   = data.get("signature",     "unknown")      # default to "unknown" if not provided
     sender_id   = data.get("sender_id",     "unknown")      # default to "unknown" if not provided
     receiver_id = data.get("receiver_id",   "unknown")      # default to "unknown" if not provided
     message_text  = data.get("message_text","no content")   # default to "no content" if not provided
     
-    print(f"send_message called with: {data}")
+    log.debug("SEND: %s -> %s, %d characters", sender_id, receiver_id, len(message_text))
 
     user: t.User = get_verified_user(sender_id, message_text[:32], signature)
     
@@ -118,17 +571,60 @@ def send_message():
         return jsonify({"status" : 403, "message" : "signature dosen't match. user couldn't be verified"})
     
     message: t.Message = t.Message(0, sender_id, receiver_id, get_timestamp(), message_text, "FETXT", None, False)
-    db.save_message(message)
+    if db.save_message(message) is None:
+        return not_saved(receiver_id)
     return jsonify({"status" : 200, "message" : "Message was sent."})
 
 
+##
+## SAVE a MESSAGE for SEVERAL receivers at once (fan-out)
+## One transaction, the answer reports the outcome per receiver
+## signature key is message_text[:32]
+##
+@app.route("/send_many", methods=["POST"])
+def send_many():
+    data = request_data()  # Expect JSON (or msgpack) body
+    signature    = data.get("signature",     "unknown")      # default to "unknown" if not provided
+    sender_id    = data.get("sender_id",     "unknown")      # default to "unknown" if not provided
+    receiver_ids = unique(data.get("receiver_ids") or [])
+    message_text = data.get("message_text", "no content")   # default to "no content" if not provided
+
+    user: t.User = get_verified_user(sender_id, message_text[:32], signature)
+
+    if (user is None or user.verified == False):
+        return jsonify({"status" : 403, "message" : "signature dosen't match. user couldn't be verified"}), 403
+    if not receiver_ids or len(receiver_ids) > MAX_RECEIVERS:
+        return jsonify({"status" : 400, "message" : f"between 1 and {MAX_RECEIVERS} receivers required"}), 400
+
+    timestamp = get_timestamp()
+    messages = [t.Message(0, sender_id, receiver_id, timestamp, message_text, "FETXT", None, False) for receiver_id in receiver_ids]
+    saved = db.save_messages(messages)
+    return jsonify({"status" : 200, "message" : "Message was sent.", "results" : delivery_results(saved)})
+
+def unique(receiver_ids: list[str]) -> list[str]:
+    return list(dict.fromkeys(r for r in receiver_ids if r))
+
+def not_saved(receiver_id: str):
+    # save_message only says None: an unknown receiver is the client's fault, anything else is ours
+    if db.fetch_user(receiver_id) is None:
+        return jsonify({"status" : 404, "message" : "unknown receiver"}), 404
+    return jsonify({"status" : 500, "message" : "message couldn't be saved"}), 500
+
+def delivery_results(saved: dict[str, int | None]) -> dict[str, dict]:
+    return {
+        receiver_id: {"status" : 200, "message_id" : message_id} if message_id is not None
+                     else {"status" : 404, "message" : "unknown receiver"}
+        for receiver_id, message_id in saved.items()
+    }
+
+
 ##
 ## SAVE a FILE to the database for the user
 ## Signature key is file_name[:16]+file_content[:16]
 ##
 @app.route("/send_file", methods=["POST"])
 def send_file():
-    data = request.json  # Expect JSON body
+    data = request_data()  # Expect JSON (or msgpack) body
     signature   = data.get("signature",     "unknown")      # default to "unknown" if not provided
     sender_id   = data.get("sender_id",     "unknown")      # default to "unknown" if not provided
     receiver_id = data.get("receiver_id",   "unknown")      # default to "unknown" if not provided
@@ -141,11 +637,85 @@ def send_file():
     if (user.verified == False):
         return jsonify({"status" : 403, "message" : "signature dosen't match. user couldn't be verified"})
     
-    message: t.Message = t.Message(0, sender_id, receiver_id, get_timestamp(), file_name, file_type, file_content, False)
-    db.save_message(message)
+    # the client sends base64, the blob store keeps the raw bytes
+    message: t.Message = t.Message(0, sender_id, receiver_id, get_timestamp(), file_name, file_type, base64.b64decode(file_content), False)
+    if db.save_message(message) is None:
+        return not_saved(receiver_id)
     return jsonify({"status" : 200, "message" : "File was sent."})
 
 
+##
+## START a chunked UPLOAD of a file for the user
+## Signature key is file_name:file_size:sha256 (shared.signature.upload_key)
+##
+@app.route("/upload/start", methods=["POST"])
+def start_upload():
+    data = request_data()  # Expect JSON (or msgpack) body, the file itself is sent in chunks
+    signature   = data.get("signature",     "unknown")      # default to "unknown" if not provided
+    sender_id   = data.get("sender_id",     "unknown")      # default to "unknown" if not provided
+    receiver_id = data.get("receiver_id",   "unknown")      # default to "unknown" if not provided
+    receiver_ids = unique(data.get("receiver_ids") or [receiver_id])   # several receivers share one upload
+    file_name = data.get("file_name", "unknown")
+    file_type = data.get("file_type") or "application/octet-stream"
+    file_size = int(data.get("file_size", -1))
+    sha256    = data.get("sha256", "")
+
+    user: t.User = get_verified_user(sender_id, s.upload_key(file_name, file_size, sha256), signature)
+
+    if (user is None or user.verified == False):
+        return jsonify({"status" : 403, "message" : "signature dosen't match. user couldn't be verified"}), 403
+
+    try:
+        if len(receiver_ids) > MAX_RECEIVERS:
+            raise uploads.UploadError(400, f"at most {MAX_RECEIVERS} receivers per message")
+        session = uploads.start(sender_id, receiver_ids, file_name, file_type, file_size, sha256)
+    except uploads.UploadError as e:
+        return jsonify(e.to_dict()), e.status
+    return jsonify({"status" : 200, **session})
+
+##
+## Upload state (GET), next CHUNK at ?offset= as raw body (PUT)
+## and FINISH (POST) of a chunked upload
+## Signature key is the upload_id
+##
+def get_upload_user() -> t.User | None:
+    data = request.args
+    signature   = data.get("signature",     "unknown")      # default to "unknown" if not provided
+    sender_id   = data.get("sender_id",     "unknown")      # default to "unknown" if not provided
+    return get_verified_user(sender_id, request.view_args["upload_id"], signature)
+
+@app.route("/upload/<upload_id>", methods=["GET", "PUT"])
+def upload_chunk(upload_id):
+    user: t.User = get_upload_user()
+
+    if (user is None or user.verified == False):
+        return jsonify({"status" : 403, "message" : "signature dosen't match. user couldn't be verified"}), 403
+
+    try:
+        if request.method == "GET":
+            return jsonify({"status" : 200, **uploads.status(upload_id, user.name)})
+        offset = int(request.args.get("offset", "0"))
+        coding = request_coding()
+        stream = z.DecodingReader(request.stream, coding) if coding else request.stream
+        received = uploads.write_chunk(upload_id, user.name, offset, stream)
+    except uploads.UploadError as e:
+        return jsonify(e.to_dict()), e.status
+    return jsonify({"status" : 200, "offset" : received})
+
+@app.route("/upload/<upload_id>/finish", methods=["POST"])
+def finish_upload(upload_id):
+    user: t.User = get_upload_user()
+
+    if (user is None or user.verified == False):
+        return jsonify({"status" : 403, "message" : "signature dosen't match. user couldn't be verified"}), 403
+
+    try:
+        saved = uploads.finish(upload_id, user.name)
+    except uploads.UploadError as e:
+        return jsonify(e.to_dict()), e.status
+    return jsonify({"status" : 200, "message" : "File was sent.", "results" : delivery_results(saved)})
+
+
 ## Call main function
 if __name__ == "__main__":
     main()
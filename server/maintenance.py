@@ -0,0 +1,194 @@
+### Background maintenance: retention, blob cleanup and compaction
+###
+### One thread wakes up every INTERVAL seconds and
+###   - deletes read messages after READ_RETENTION, messages older than MAX_AGE
+###     and the oldest messages of mailboxes above MAX_MAILBOX
+###   - removes blobs no message references anymore and abandoned uploads
+###   - gives free pages back to the file system (incremental vacuum) and
+###     refreshes the query planner statistics (PRAGMA optimize)
+### Deletes run in batches of BATCH_SIZE through the writer, so every write
+### transaction stays short and sending messages never waits long on the lock.
+###
+### Retention is configured with environment variables, in seconds / messages,
+### 0 switches a rule off. Every rule is off by default.
+###
+### usage: python maintenance.py --vacuum [--db fe_data.db]
+###   one full VACUUM (server stopped) to switch a database created before
+###   incremental auto_vacuum, the server only warns about it on startup
+
+import argparse
+import logging
+import os
+import threading
+import time
+
+import database as db
+import blobstore
+import logs
+import migrations
+import shards
+import uploads
+import metrics
+
+DAY = 24 * 60 * 60
+
+INTERVAL = int(os.environ.get("FE_MAINTENANCE_INTERVAL", 300))         # seconds between runs
+READ_RETENTION = int(os.environ.get("FE_RETENTION_READ", 0))           # keep read messages this long
+MAX_AGE = int(os.environ.get("FE_RETENTION_MAX_AGE", 0))               # delete any message older than this
+MAX_MAILBOX = int(os.environ.get("FE_RETENTION_MAX_MAILBOX", 0))       # keep at most this many messages per receiver
+UPLOAD_TTL = int(os.environ.get("FE_UPLOAD_TTL", 2 * DAY))             # abandoned uploads are dropped after this
+
+BATCH_SIZE = 500            # messages per delete transaction
+MAX_BATCHES = 100           # delete batches per run, the rest waits for the next run
+BATCH_PAUSE = 0.05          # seconds between batches, lets queued sends through
+VACUUM_PAGES = 2000         # free pages given back per run
+ORPHAN_GRACE = 60 * 60      # blobs written or reused more recently than this are never removed
+ORPHAN_SWEEP_INTERVAL = DAY # full walk of the blob store
+
+log = logging.getLogger("fe.maintenance")
+
+PURGED = metrics.Counter("fe_maintenance_purged_messages_total", "Messages deleted by retention rules", ("rule",))
+BLOBS_REMOVED = metrics.Counter("fe_maintenance_removed_blobs_total", "Blobs removed because no message referenced them")
+UPLOADS_EXPIRED = metrics.Counter("fe_maintenance_expired_uploads_total", "Abandoned upload sessions removed")
+PAGES_FREED = metrics.Counter("fe_maintenance_freed_pages_total", "Database pages given back by incremental vacuum")
+RUN_TIME = metrics.Histogram("fe_maintenance_run_duration_seconds", "Duration of a maintenance run")
+
+
+def _purge(fetch_batch, rule: str, budget: list, blob_hashes: set) -> int:
+    """Delete fetch_batch() results batch by batch until none are left or the run's budget is used up."""
+    purged = 0
+    while budget[0] > 0:
+        rows = fetch_batch()
+        if not rows:
+            break
+        db.delete_messages([row[0] for row in rows])
+        blob_hashes.update(row[1] for row in rows if row[1])
+        purged += len(rows)
+        budget[0] -= 1
+        time.sleep(BATCH_PAUSE)
+    if purged:
+        PURGED.inc(purged, rule)
+    return purged
+
+def purge_messages(now: int, blob_hashes: set) -> dict[str, int]:
+    """
+    Apply the retention rules. Blob hashes of deleted messages are added to blob_hashes.
+    """
+    budget = [MAX_BATCHES]
+    purged = {}
+    if READ_RETENTION > 0:
+        purged["read"] = _purge(lambda: db.fetch_read_before(now - READ_RETENTION, BATCH_SIZE), "read", budget, blob_hashes)
+    if MAX_AGE > 0:
+        purged["age"] = _purge(lambda: db.fetch_sent_before(now - MAX_AGE, BATCH_SIZE), "age", budget, blob_hashes)
+    if MAX_MAILBOX > 0:
+        purged["mailbox"] = 0
+        for receiver_id, excess in db.fetch_full_mailboxes(MAX_MAILBOX):
+            remaining = [excess]
+
+            def batch():
+                rows = db.fetch_oldest_received(receiver_id, min(remaining[0], BATCH_SIZE))
+                remaining[0] -= len(rows)
+                return rows
+
+            purged["mailbox"] += _purge(batch, "mailbox", budget, blob_hashes)
+    return purged
+
+def remove_orphans(blob_hashes, now: float) -> int:
+    """
+    Remove the given blobs where no message references them anymore.
+    """
+    removed = 0
+    for blob_hash in blob_hashes:
+        if not db.blob_referenced(blob_hash) and blobstore.delete(blob_hash, now - ORPHAN_GRACE):
+            removed += 1
+    if removed:
+        BLOBS_REMOVED.inc(removed)
+    return removed
+
+
+class Maintenance:
+    def __init__(self, interval: float = INTERVAL):
+        self.interval = interval
+        self.last_sweep = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="fe-maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    self.run_once()
+                except Exception:
+                    log.exception("MAINTENANCE: run failed")
+        finally:
+            db.close_connection()
+
+    def run_once(self) -> dict:
+        """
+        One maintenance run, returns what it did.
+        """
+        started = time.perf_counter()
+        now = int(time.time())
+        blob_hashes = set()
+        result = {"purged": purge_messages(now, blob_hashes)}
+
+        # a full walk of the blob store once in a while also finds blobs left behind by crashes
+        if time.time() - self.last_sweep >= ORPHAN_SWEEP_INTERVAL:
+            blob_hashes.update(blobstore.digests())
+            self.last_sweep = time.time()
+        result["blobs_removed"] = remove_orphans(blob_hashes, now)
+
+        result["uploads_expired"] = uploads.expire(now - UPLOAD_TTL) if UPLOAD_TTL > 0 else 0
+        UPLOADS_EXPIRED.inc(result["uploads_expired"])
+
+        result["pages_freed"] = db.incremental_vacuum(VACUUM_PAGES)
+        PAGES_FREED.inc(result["pages_freed"])
+        db.optimize()
+
+        RUN_TIME.observe(time.perf_counter() - started)
+        if any(result["purged"].values()) or result["blobs_removed"] or result["uploads_expired"] or result["pages_freed"]:
+            log.info("MAINTENANCE: %s", result)
+        return result
+
+
+worker = Maintenance()
+
+
+def vacuum():
+    """Switch the main database and every shard to incremental auto_vacuum"""
+    for path in shards.databases():
+        conn = db.open_connection(path)
+        if migrations.enable_incremental_vacuum(conn):
+            log.info("MAINTENANCE: %s vacuumed", path)
+        else:
+            log.info("MAINTENANCE: %s already gives free pages back", path)
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="one-off maintenance of the database (offline)")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="full VACUUM to switch to incremental auto_vacuum (stop the server first)")
+    parser.add_argument("--db", default=db.DB_PATH, help="main database file (default FE_DB_PATH or fe_data.db)")
+    args = parser.parse_args()
+    if not args.vacuum:
+        parser.error("nothing to do, pass --vacuum")
+    logs.setup("INFO")
+
+    db.DB_PATH = args.db
+    vacuum()
+    logs.shutdown()
+
+
+if __name__ == "__main__":
+    main()
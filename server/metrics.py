@@ -0,0 +1,162 @@
+### In-process metrics, exposed in the Prometheus text format on /metrics
+###
+### Counters and histograms keep one series per label tuple behind a lock, an
+### observation is a bisect and a few additions. Callback metrics are read
+### only when /metrics is scraped (e.g. the user cache statistics).
+
+import bisect
+import functools
+import inspect
+import threading
+import time
+
+# seconds, from a cached lookup up to a full /wait long-poll
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+REGISTRY = []
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.label_names = name, help, labels
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.label_names, labels)} {_number(value)}" for labels, value in values]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.label_names = name, help, labels
+        self.buckets = tuple(buckets)
+        self._series = {}   # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 3)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                label = _labels(self.label_names + ("le",), labels + (_number(bound),))
+                lines.append(f"{self.name}_bucket{label} {cumulative}")
+            label = _labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label} {_number(values[-2])}")
+            lines.append(f"{self.name}_count{label} {values[-1]}")
+        return lines
+
+
+class Callback:
+    """A gauge or counter whose value is read from fn() on every scrape"""
+
+    def __init__(self, name: str, help: str, fn, kind: str = "gauge"):
+        self.name, self.help, self.fn, self.kind = name, help, fn, kind
+        REGISTRY.append(self)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", f"{self.name} {_number(self.fn())}"]
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+## server metrics
+
+REQUEST_LATENCY = Histogram("fe_http_request_duration_seconds",
+                            "Time from receiving a request until its response body is sent",
+                            ("endpoint", "method", "status"))
+REQUEST_BYTES = Counter("fe_http_request_bytes_total", "Request body bytes received", ("endpoint",))
+RESPONSE_BYTES = Counter("fe_http_response_bytes_total", "Response body bytes sent", ("endpoint",))
+RESPONSE_SIZE = Histogram("fe_http_response_size_bytes", "Response body size", ("endpoint",), SIZE_BUCKETS)
+DB_LATENCY = Histogram("fe_db_call_duration_seconds", "Time spent in database.py calls", ("function",))
+DB_ERRORS = Counter("fe_db_call_errors_total", "database.py calls that raised", ("function",))
+REJECTED_REQUESTS = Counter("fe_admission_rejected_requests_total",
+                            "Requests turned away before any work (admission.py, server in-flight caps)", ("reason", "endpoint"))
+
+
+def timed_db(fn):
+    """
+    Record the duration of a database call in DB_LATENCY. For a generator only the time
+    spent inside the generator counts, not the time its consumer takes between items
+    """
+    name = fn.__name__
+
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def generator(*args, **kwargs):
+            spent = 0.0
+            it = fn(*args, **kwargs)
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        item = next(it)
+                    except StopIteration:
+                        return
+                    finally:
+                        spent += time.perf_counter() - start
+                    yield item
+            except Exception:
+                DB_ERRORS.inc(1, name)
+                raise
+            finally:
+                it.close()
+                DB_LATENCY.observe(spent, name)
+        return generator
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(1, name)
+            raise
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - start, name)
+    return wrapper
@@ -0,0 +1,253 @@
+### Versioned schema migrations, tracked in PRAGMA user_version
+
+import base64
+import binascii
+import logging
+import sqlite3
+
+import blobstore
+
+log = logging.getLogger("fe.migrations")
+
+
+def _v1_base_tables(c: sqlite3.Cursor):
+    # User table
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        accesskey TEXT,
+        op INTEGER
+    )
+    """)
+
+    # Messages table
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        sender_id TEXT,
+        receiver_id TEXT,
+        timestamp INTEGER,
+        file_name TEXT,
+        file_type TEXT,
+        file_contents BLOB,
+        queue_deletion INTEGER,
+        FOREIGN KEY(sender_id) REFERENCES users(username),
+        FOREIGN KEY(receiver_id) REFERENCES users(username)
+    )
+    """)
+
+def _v2_mailbox_indexes(c: sqlite3.Cursor):
+    # one index per half of the mailbox query, both already sorted by timestamp
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_receiver_ts ON messages (receiver_id, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender_ts ON messages (sender_id, timestamp)")
+
+def _v3_blob_store(c: sqlite3.Cursor):
+    # file contents move out of the row into the content-addressed blob store
+    c.execute("ALTER TABLE messages ADD COLUMN blob_hash TEXT")
+    c.execute("ALTER TABLE messages ADD COLUMN blob_size INTEGER")
+
+    rows = c.execute("SELECT id FROM messages WHERE file_contents IS NOT NULL").fetchall()
+    for (message_id,) in rows:
+        contents = c.execute("SELECT file_contents FROM messages WHERE id = ?", (message_id,)).fetchone()[0]
+        if isinstance(contents, str):
+            # /send_file used to store the base64 string as sent by the client,
+            # anything that isn't canonical base64 is kept as its text
+            try:
+                decoded = base64.b64decode(contents, validate=True)
+                contents = decoded if base64.b64encode(decoded).decode() == contents else contents.encode("utf-8")
+            except binascii.Error:
+                contents = contents.encode("utf-8")
+        digest, size, _ = blobstore.put(contents)
+        c.execute(
+            "UPDATE messages SET blob_hash = ?, blob_size = ?, file_contents = NULL WHERE id = ?",
+            (digest, size, message_id)
+        )
+
+def _v4_upload_sessions(c: sqlite3.Cursor):
+    # resumable chunked uploads, the partial data lives next to the blob store
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS uploads (
+        id TEXT PRIMARY KEY,
+        sender_id TEXT,
+        receiver_id TEXT,
+        file_name TEXT,
+        file_type TEXT,
+        total_size INTEGER,
+        sha256 TEXT,
+        received INTEGER,
+        created INTEGER
+    )
+    """)
+
+def _v5_sync_indexes(c: sqlite3.Cursor):
+    # keyset pagination walks each half of the mailbox in id order
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_receiver_id ON messages (receiver_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages (sender_id, id)")
+
+def _v6_upload_receivers(c: sqlite3.Cursor):
+    # one upload can be delivered to several receivers (JSON list)
+    c.execute("ALTER TABLE uploads ADD COLUMN receiver_ids TEXT")
+
+def _v7_retention(c: sqlite3.Cursor):
+    # queue_deletion now holds the time the receiver read the message (0 = unread)
+    c.execute("UPDATE messages SET queue_deletion = 0 WHERE queue_deletion IS NULL OR queue_deletion < 0")
+    # the maintenance worker looks up read messages, old messages and blobs nothing references anymore
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_read ON messages (queue_deletion) WHERE queue_deletion > 0")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_blob_hash ON messages (blob_hash) WHERE blob_hash IS NOT NULL")
+
+def _v8_blob_codec(c: sqlite3.Cursor):
+    # coding the blob is stored with at rest (zstd / gzip), NULL = stored as it is
+    c.execute("ALTER TABLE messages ADD COLUMN blob_codec TEXT")
+
+def _v9_message_headers(c: sqlite3.Cursor):
+    # preview, size and kind are computed once when a message is saved. Together with the
+    # other header columns they go into covering indexes, listing a mailbox doesn't read
+    # the message rows (and the full text of text messages) anymore
+    c.execute("ALTER TABLE messages ADD COLUMN preview TEXT")
+    c.execute("ALTER TABLE messages ADD COLUMN content_length INTEGER")
+    c.execute("ALTER TABLE messages ADD COLUMN content_kind TEXT")
+    c.execute("""
+    UPDATE messages SET
+        preview = substr(file_name, 1, 50),
+        content_length = CASE WHEN blob_hash IS NULL THEN COALESCE(length(CAST(file_name AS BLOB)), 0) ELSE blob_size END,
+        content_kind = CASE WHEN blob_hash IS NULL THEN 'text' ELSE 'file' END
+    """)
+    for index in ("idx_messages_receiver_ts", "idx_messages_sender_ts", "idx_messages_receiver_id", "idx_messages_sender_id"):
+        c.execute(f"DROP INDEX IF EXISTS {index}")
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_messages_receiver_headers ON messages
+    (receiver_id, id, sender_id, timestamp, preview, file_type, queue_deletion, content_length, content_kind)
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_messages_sender_headers ON messages
+    (sender_id, id, receiver_id, timestamp, preview, file_type, queue_deletion, content_length, content_kind)
+    """)
+
+# FTS5 index over the message text / file name (file_name) and the sender and receiver
+# ("owners", as u<hex of the name> tokens so any user name is one exact token).
+# It stores no copy of the text, its content is read from the view
+_OWNERS = "'u' || hex({0}.sender_id) || ' u' || hex({0}.receiver_id)"
+
+def _v10_full_text_search(c: sqlite3.Cursor):
+    c.execute(f"""
+    CREATE VIEW IF NOT EXISTS messages_search_content AS
+    SELECT id, file_name, {_OWNERS.format("messages")} AS owners FROM messages
+    """)
+    c.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        file_name, owners,
+        content='messages_search_content', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """)
+    # kept in sync with every insert / delete, whichever code path writes the row
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, file_name, owners) VALUES (new.id, new.file_name, {_OWNERS.format("new")});
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, file_name, owners) VALUES ('delete', old.id, old.file_name, {_OWNERS.format("old")});
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF file_name, sender_id, receiver_id ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, file_name, owners) VALUES ('delete', old.id, old.file_name, {_OWNERS.format("old")});
+        INSERT INTO messages_fts (rowid, file_name, owners) VALUES (new.id, new.file_name, {_OWNERS.format("new")});
+    END
+    """)
+    # index the messages that are already there
+    c.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+# sharded message storage (shards.py): how many shard files the messages are split into,
+# the next message id and which shard a receiver lives on. Only used in the main database,
+# the shard files get the (empty) tables as well since they share the migrations
+def _v11_shards(c: sqlite3.Cursor):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS shard_meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """)
+    c.execute("INSERT OR IGNORE INTO shard_meta (key, value) VALUES ('shards', 1)")
+    c.execute("INSERT OR IGNORE INTO shard_meta (key, value) SELECT 'next_id', COALESCE(MAX(id), 0) + 1 FROM messages")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS shard_routes (
+        receiver_id TEXT PRIMARY KEY,
+        shard INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """)
+
+
+# (version, migration) in the order they have to be applied.
+# Append new migrations at the end, never edit or reorder released ones.
+MIGRATIONS = [
+    (1, _v1_base_tables),
+    (2, _v2_mailbox_indexes),
+    (3, _v3_blob_store),
+    (4, _v4_upload_sessions),
+    (5, _v5_sync_indexes),
+    (6, _v6_upload_receivers),
+    (7, _v7_retention),
+    (8, _v8_blob_codec),
+    (9, _v9_message_headers),
+    (10, _v10_full_text_search),
+    (11, _v11_shards),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """
+    Apply every migration newer than the database's user_version.
+    Each migration runs in its own write transaction together with the
+    version bump, so a failed migration leaves the database at the previous
+    version and concurrent starters wait for each other instead of racing.
+    Returns the resulting schema version.
+    """
+    for version, migration in MIGRATIONS:
+        if current_version(conn) >= version:
+            continue
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # re-check under the write lock, another process may have been first
+            if current_version(conn) >= version:
+                conn.rollback()
+                continue
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        log.info("MIGRATION: schema upgraded to version %d (%s)", version, migration.__name__)
+
+    if not incremental_vacuum_enabled(conn):
+        # a full VACUUM rewrites the whole file, too long to block the startup of a large database
+        log.warning("MIGRATION: this database doesn't give free pages back, "
+                    "run 'python maintenance.py --vacuum' once with the server stopped")
+    return current_version(conn)
+
+def incremental_vacuum_enabled(conn: sqlite3.Connection) -> bool:
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+def enable_incremental_vacuum(conn: sqlite3.Connection) -> bool:
+    """
+    Databases created before auto_vacuum=INCREMENTAL need one full VACUUM to switch,
+    after that the maintenance worker gives free pages back in small steps.
+    VACUUM can't run inside a transaction, so this isn't a versioned migration.
+    Returns False if there was nothing to do
+    """
+    if incremental_vacuum_enabled(conn):
+        return False
+    log.info("MIGRATION: switching to incremental auto_vacuum (full VACUUM)")
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
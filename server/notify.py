@@ -0,0 +1,122 @@
+### In-process notification hub for new messages, keyed by receiver
+###
+### save_message publishes every committed message to its receiver, long-poll
+### requests wait here until a message for their user shows up. Waiters compare
+### a per receiver count of published messages (version), message ids don't
+### grow across shards.
+### The hub only sees the messages of its own process, see poll_interval.
+###
+### The threaded server waits in the request's worker thread (wait), the asgi
+### server parks the request on the event loop instead (wait_async, asgi.py)
+### and holds no thread until something arrives.
+
+import asyncio
+import threading
+
+MAX_WAITERS = 64    # concurrent blocking long-polls, each holds a thread (serving.py adds them to its pool)
+
+# seconds between database checks of a waiting long-poll, None waits for a publish only.
+# Set when several worker processes serve (prefork.py): a message saved by another
+# process is only published to that process' hub
+CROSS_PROCESS_POLL = 1.0
+poll_interval: float | None = None
+
+
+class NotificationHub:
+    def __init__(self, max_waiters: int = MAX_WAITERS):
+        self._lock = threading.Lock()
+        self._versions: dict[str, int] = {}                 # receiver -> messages published so far
+        self._waiters: dict[str, list[threading.Event]] = {}
+        self._slots = threading.BoundedSemaphore(max_waiters)
+        self._closed = False
+
+    def publish(self, receiver_id: str):
+        with self._lock:
+            self._versions[receiver_id] = self._versions.get(receiver_id, 0) + 1
+            for event in self._waiters.get(receiver_id, ()):
+                event.set()
+
+    def version(self, receiver_id: str) -> int:
+        """Take it before looking for messages, a wait for it ends with any message published since"""
+        with self._lock:
+            return self._versions.get(receiver_id, 0)
+
+    def wait(self, receiver_id: str, version: int, timeout: float) -> bool | None:
+        """
+        Block until a message is published for receiver_id after version(receiver_id) was version.
+        Returns True if one was, False on timeout and None if all waiter slots are taken.
+        """
+        if not self._slots.acquire(blocking=False):
+            return None
+        event = threading.Event()
+        try:
+            if not self._register(receiver_id, version, event):
+                return True
+            return event.wait(timeout)
+        finally:
+            self._unregister(receiver_id, event)
+            self._slots.release()
+
+    async def wait_async(self, receiver_id: str, version: int, timeout: float) -> bool:
+        """
+        wait() for the event loop: no thread and no waiter slot is held
+        (the asgi server bounds its requests itself)
+        """
+        event = _LoopEvent(asyncio.get_running_loop())
+        try:
+            if not self._register(receiver_id, version, event):
+                return True
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+        finally:
+            self._unregister(receiver_id, event)
+
+    def _register(self, receiver_id: str, version: int, event) -> bool:
+        """Add a waiter, False if there is no need to wait"""
+        with self._lock:
+            if self._closed or self._versions.get(receiver_id, 0) != version:
+                return False
+            self._waiters.setdefault(receiver_id, []).append(event)
+            return True
+
+    def _unregister(self, receiver_id: str, event):
+        with self._lock:
+            waiters = self._waiters.get(receiver_id)
+            if waiters and event in waiters:
+                waiters.remove(event)
+                if not waiters:
+                    del self._waiters[receiver_id]
+
+    def close(self):
+        """
+        Release every waiting long-poll (and any that comes later) as if a message arrived,
+        so a stopping server doesn't wait for their timeouts. Their clients poll again.
+        """
+        with self._lock:
+            self._closed = True
+            for waiters in self._waiters.values():
+                for event in waiters:
+                    event.set()
+
+
+class _LoopEvent:
+    """asyncio.Event that can be set from any thread (publish runs in request threads)"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._event = asyncio.Event()
+
+    def set(self):
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            pass    # the loop is closed, nobody waits anymore
+
+    async def wait(self):
+        await self._event.wait()
+
+
+hub = NotificationHub()
@@ -0,0 +1,179 @@
+### Pre-fork launcher: a master process and N worker processes sharing one listening socket
+###
+### The master binds the socket and migrates the database once, then starts the workers
+### (main_server.py again, with --worker-fd), which inherit the socket and accept on it
+### side by side, each with its own GIL. The master only supervises:
+###   - a worker that dies is started again (with a growing delay if it keeps dying right away)
+###   - SIGHUP replaces the workers one at a time (rolling reload, picks up new code):
+###     the new one is started and ready before the old one is asked to stop
+###   - SIGTERM / SIGINT stop every worker gracefully, SIGKILL after STOP_GRACE seconds
+### Connections that arrive while a worker is replaced wait in the socket's backlog.
+
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+log = logging.getLogger("fe.prefork")
+
+BACKLOG = 4096
+STOP_GRACE = 30         # seconds a worker gets to finish its requests on stop / reload
+READY_TIMEOUT = 60      # seconds a new worker gets to start serving
+MIN_UPTIME = 5          # a worker that dies earlier is restarted after RESTART_DELAY ...
+RESTART_DELAY = 1       # ... doubling up to MAX_RESTART_DELAY while it keeps doing so
+MAX_RESTART_DELAY = 30
+POLL_INTERVAL = 0.5
+
+
+def listen(host: str, port: int) -> socket.socket:
+    """The listening socket the workers inherit"""
+    sock = socket.create_server((host, port), backlog=BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+def ready(fd: int | None):
+    """Tell the master this worker is about to serve (called by the worker)"""
+    if fd is not None:
+        os.write(fd, b"1")
+        os.close(fd)
+
+
+class Worker:
+    def __init__(self, index: int, argv: list[str], sock: socket.socket):
+        self.index = index
+        self.started = time.monotonic()
+        read_fd, write_fd = os.pipe()
+        self.process = subprocess.Popen(
+            [*argv, "--worker-fd", str(sock.fileno()), "--worker-index", str(index), "--ready-fd", str(write_fd)],
+            pass_fds=(sock.fileno(), write_fd),
+        )
+        os.close(write_fd)
+        self._ready = read_fd
+
+    def wait_ready(self, timeout: float) -> bool:
+        """True once the worker serves, False if it exited or didn't get there in time"""
+        deadline = time.monotonic() + timeout
+        os.set_blocking(self._ready, False)
+        try:
+            while time.monotonic() < deadline and self.process.poll() is None:
+                try:
+                    if os.read(self._ready, 1):
+                        return True
+                except BlockingIOError:
+                    pass
+                time.sleep(0.05)
+            return False
+        finally:
+            self.close_pipe()
+
+    def close_pipe(self):
+        if self._ready is not None:
+            os.close(self._ready)
+            self._ready = None
+
+    def stop(self, grace: float = STOP_GRACE):
+        """Ask the worker to finish its requests and exit, kill it after grace seconds"""
+        self.close_pipe()
+        if self.process.poll() is None:
+            self.process.terminate()
+        try:
+            self.process.wait(grace)
+        except subprocess.TimeoutExpired:
+            log.warning("PREFORK: worker %d (pid %d) didn't stop in %ds, killing it", self.index, self.process.pid, grace)
+            self.process.kill()
+            self.process.wait()
+
+
+class Master:
+    def __init__(self, argv: list[str], sock: socket.socket, workers: int):
+        self.argv = argv
+        self.sock = sock
+        self.count = workers
+        self.workers: dict[int, Worker] = {}
+        self.delays: dict[int, float] = {}
+        self.restart_at: dict[int, float] = {}     # dead workers waiting for their restart
+        self._stop = False
+        self._reload = False
+
+    def run(self):
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        for index in range(self.count):
+            self.workers[index] = Worker(index, self.argv, self.sock)
+        log.info("## Master %d supervising %d workers ##", os.getpid(), self.count)
+
+        while not self._stop:
+            time.sleep(POLL_INTERVAL)
+            if self._reload:
+                self._reload = False
+                self.rolling_reload()
+            self.restart_dead()
+        self.stop()
+
+    def _on_stop(self, signum, frame):
+        self._stop = True
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def restart_dead(self):
+        now = time.monotonic()
+        for index, worker in list(self.workers.items()):
+            if index in self.restart_at:
+                if now >= self.restart_at[index]:
+                    del self.restart_at[index]
+                    self.workers[index] = Worker(index, self.argv, self.sock)
+                continue
+            code = worker.process.poll()
+            if code is None:
+                continue
+            worker.close_pipe()
+            uptime = now - worker.started
+            delay = 0 if uptime >= MIN_UPTIME else min(self.delays.get(index, RESTART_DELAY / 2) * 2, MAX_RESTART_DELAY)
+            self.delays[index] = delay
+            self.restart_at[index] = now + delay
+            log.error("PREFORK: worker %d (pid %d) exited with %s after %.1fs, restarting in %.0fs",
+                      index, worker.process.pid, code, uptime, delay)
+
+    def rolling_reload(self):
+        log.info("PREFORK: rolling reload of %d workers", self.count)
+        for index in range(self.count):
+            if self._stop:
+                return
+            old = self.workers[index]
+            self.restart_at.pop(index, None)
+            new = Worker(index, self.argv, self.sock)
+            if not new.wait_ready(READY_TIMEOUT):
+                # keep the old one serving, the new code doesn't come up
+                log.error("PREFORK: new worker %d didn't start, reload aborted", index)
+                new.stop()
+                return
+            self.workers[index] = new
+            old.stop()
+        log.info("PREFORK: reload done")
+
+    def stop(self):
+        log.info("PREFORK: stopping %d workers", len(self.workers))
+        for worker in self.workers.values():
+            worker.close_pipe()
+            if worker.process.poll() is None:
+                worker.process.terminate()
+        deadline = time.monotonic() + STOP_GRACE
+        for worker in self.workers.values():
+            worker.stop(max(0.0, deadline - time.monotonic()))
+        self.sock.close()
+
+
+def serve(argv: list[str], host: str, port: int, workers: int):
+    """
+    Bind host:port and run workers started with argv (the command line of this server)
+    until SIGTERM / SIGINT. The database has to be migrated before.
+    """
+    sock = listen(host, port)
+    log.info("## Listening on %s:%d ##", host, port)
+    Master([sys.executable, *argv], sock, workers).run()
@@ -0,0 +1,131 @@
+### Offline resharding: split the messages of a database into N shard files
+### (or merge the shards back into the main database with --shards 1)
+###
+### Stop the server and keep a copy of the files first. The messages keep their ids,
+### so clients' caches and cursors stay valid. Start the server with FE_SHARDS=N afterwards.
+###
+### usage: python reshard.py --shards 4 [--db fe_data.db] [--balance]
+###   --balance  place the receivers with the most messages first, each on the
+###              emptiest shard (stored in shard_routes) instead of by hash
+
+import argparse
+import heapq
+import logging
+import os
+import sqlite3
+
+import database as db
+import logs
+import migrations
+import shards
+
+log = logging.getLogger("fe.reshard")
+
+COPY_BATCH = 5000
+
+
+def assign(receivers: dict[str, int], count: int, balance: bool) -> dict[str, int]:
+    """
+    Routes for the receivers ({receiver_id: messages}) that differ from the hash
+    placement, the others are found by hash and need no row
+    """
+    if not balance or count == 1:
+        return {}
+    routes = {}
+    load = [(0, shard) for shard in range(count)]
+    for receiver_id, messages in sorted(receivers.items(), key=lambda item: -item[1]):
+        used, shard = heapq.heappop(load)
+        routes[receiver_id] = shard
+        heapq.heappush(load, (used + messages, shard))
+    return routes
+
+def open_target(path: str) -> sqlite3.Connection:
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    conn = db.open_connection(path)
+    migrations.migrate(conn)
+    conn.execute("PRAGMA synchronous = OFF")    # the copy is synced once at the end
+    conn.execute("PRAGMA foreign_keys = OFF")
+    return conn
+
+def reshard(count: int, balance: bool = False):
+    main = db.open_connection()
+    migrations.migrate(main)
+    old = shards.get_count(main)
+    if old == 1 and count == 1:
+        log.info("RESHARD: %s isn't sharded, nothing to do", db.DB_PATH)
+        return
+    main.execute("PRAGMA foreign_keys = OFF")
+    sources = [main] if old == 1 else [db.open_connection(path) for path in shards.paths(old)]
+
+    receivers: dict[str, int] = {}
+    top = 0
+    for conn in sources:
+        for receiver_id, messages in conn.execute("SELECT receiver_id, COUNT(*) FROM messages GROUP BY receiver_id"):
+            receivers[receiver_id] = messages
+        top = max(top, conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0])
+    routes = assign(receivers, count, balance)
+    log.info("RESHARD: %d messages of %d receivers, %d shard(s) -> %d", sum(receivers.values()), len(receivers), old, count)
+
+    # copy into new files (into the main database when merging back into one)
+    temporary = [path + ".resharding" for path in shards.paths(count)] if count > 1 else []
+    targets = [open_target(path) for path in temporary] if count > 1 else [main]
+    columns = None
+    for source in sources:
+        cursor = source.execute("SELECT * FROM messages ORDER BY id")
+        columns = columns or [col[0] for col in cursor.description]
+        receiver = columns.index("receiver_id")
+        insert = f"INSERT INTO messages ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        while rows := cursor.fetchmany(COPY_BATCH):
+            by_shard: dict[int, list] = {}
+            for row in rows:
+                shard = routes.get(row[receiver], shards.hash_shard(row[receiver], count))
+                by_shard.setdefault(shard, []).append(row)
+            for shard, group in by_shard.items():
+                targets[shard].executemany(insert, group)
+    for conn in targets:
+        conn.commit()
+
+    # switch: shard count, routes and the id counter in one transaction of the main database
+    with main:
+        if old == 1 and count > 1:
+            main.execute("DELETE FROM messages")
+        main.execute("DELETE FROM shard_routes")
+        main.executemany("INSERT INTO shard_routes (receiver_id, shard) VALUES (?, ?)", routes.items())
+        main.execute("UPDATE shard_meta SET value = ? WHERE key = 'shards'", (count,))
+        main.execute("UPDATE shard_meta SET value = MAX(value, ?) WHERE key = 'next_id'", (top + 1,))
+
+    # closing the last connection checkpoints a file and removes its WAL
+    for conn in targets + sources:
+        if conn is not main:
+            conn.close()
+    for path in shards.paths(old) if old > 1 else []:
+        if path not in shards.paths(count):
+            os.remove(path)
+    for path in temporary:
+        os.replace(path, path.removesuffix(".resharding"))
+    if old == 1 and count > 1:
+        main.execute("VACUUM")  # give the space of the moved messages back
+    main.close()
+    log.info("RESHARD: done, start the server with FE_SHARDS=%d", count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="split the messages into shard files (offline)")
+    parser.add_argument("--shards", type=int, required=True, help="number of shard files, 1 merges them back")
+    parser.add_argument("--db", default=db.DB_PATH, help="main database file (default FE_DB_PATH or fe_data.db)")
+    parser.add_argument("--balance", action="store_true",
+                        help="spread the receivers by message count instead of by hash")
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    logs.setup("INFO")
+
+    db.DB_PATH = args.db
+    reshard(args.shards, args.balance)
+    logs.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+### WSGI server with a fixed pool of worker threads
+
+import io
+import logging
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import LimitedStream
+
+import metrics
+
+WORKER_THREADS = 16
+MAX_PENDING = 512   # accepted connections (served + waiting for a thread), beyond that 503 right away
+KEEP_ALIVE_TIMEOUT = 5      # seconds an idle keep-alive connection may hold its worker thread
+MAX_DRAIN = 64 * 1024       # unread request body bytes skipped to keep a connection, above that it is closed
+BUSY_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Type: text/plain\r\n"
+                 b"Content-Length: 24\r\nConnection: close\r\n\r\nserver busy, retry later")
+
+log = logging.getLogger("fe.serving")
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+    HTTP/1.1 with persistent connections. werkzeug closes every connection since it can't
+    tell where an unread request body ends; here the body is a LimitedStream, whatever
+    the view left of it is skipped after the response (up to MAX_DRAIN, larger leftovers
+    and chunked bodies close the connection as before).
+    """
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+
+    def make_environ(self):
+        environ = super().make_environ()
+        self.body = None
+        if not environ.get("wsgi.input_terminated"):
+            self.body = LimitedStream(self.rfile, int(environ.get("CONTENT_LENGTH") or 0))
+            environ["wsgi.input"] = self.body
+            # werkzeug reads whatever is left on the socket after the response, that would be
+            # the next request of a kept connection: hand it an empty stream until run_wsgi ends
+            self.socket_rfile, self.rfile = self.rfile, io.BytesIO()
+        return environ
+
+    def send_header(self, keyword, value):
+        # werkzeug sends "Connection: close" with every response, only keep it if the rest of the body is too long
+        if keyword.lower() == "connection" and value.lower() == "close":
+            if self._can_keep_alive():
+                return
+            if self.body is not None:
+                self.rfile = self.socket_rfile    # closing: let werkzeug discard the rest as before
+        super().send_header(keyword, value)
+
+    def _can_keep_alive(self) -> bool:
+        return (
+            not self.close_connection
+            and self.body is not None
+            and self.body.limit - self.body.tell() <= MAX_DRAIN
+        )
+
+    def run_wsgi(self):
+        super().run_wsgi()
+        if self.body is not None:
+            self.rfile = self.socket_rfile
+            if not self.close_connection:
+                self.body.exhaust()
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug server that hands requests to a fixed set of worker threads
+    instead of spawning a new thread per request. Worker threads live for
+    the lifetime of the server, so their pooled database connections do too.
+    A worker thread serves one connection, keep-alive included, until it is closed or idle
+    for KEEP_ALIVE_TIMEOUT seconds.
+    Beyond max_pending accepted connections a new one gets 503 instead of a place in the queue.
+    """
+
+    def __init__(self, host, port, app, workers: int = WORKER_THREADS, max_pending: int = MAX_PENDING, **kwargs):
+        kwargs.setdefault("handler", KeepAliveRequestHandler)
+        super().__init__(host, port, app, **kwargs)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fe-worker")
+        self.max_pending = max_pending
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self._pending_lock:
+            admitted = self.pending < self.max_pending
+            if admitted:
+                self.pending += 1
+        if not admitted:
+            # nothing of the request is read, the client retries after Retry-After
+            metrics.REJECTED_REQUESTS.inc(1, "in_flight", "")
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._pending_lock:
+                self.pending -= 1
+
+    def server_close(self):
+        # werkzeug also calls this from __init__ when it is given an fd, before the pool exists
+        if hasattr(self, "pool"):
+            self.pool.shutdown(wait=True)
+        super().server_close()
+
+
+def serve(app, host: str, port: int, workers: int = WORKER_THREADS, fd: int | None = None, on_stop=None,
+          max_pending: int = MAX_PENDING):
+    """
+    Run the app until interrupted.
+    fd: an inherited listening socket to accept on instead of binding host:port (prefork.py),
+    SIGTERM then calls on_stop() and lets the running requests finish before the server stops
+    max_pending: connections accepted at once (served or queued for a thread), 503 beyond
+    """
+    server = PooledWSGIServer(host, port, app, workers=workers, max_pending=max_pending, fd=fd)
+    if fd is not None:
+        def stop(signum, frame):
+            if on_stop is not None:
+                on_stop()
+            # shutdown() waits for serve_forever to return, so it can't run in the signal handler itself
+            threading.Thread(target=server.shutdown).start()
+        signal.signal(signal.SIGTERM, stop)
+    log.info("## Serving on %s:%d with %d worker threads ##", *server.server_address[:2], workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,158 @@
+### Message storage split across several SQLite files (shards) by receiver
+###
+### With FE_SHARDS=1 (the default) everything stays in the one database file.
+### With N > 1 the messages live in N shard files next to it (fe_data.shard0.db, ...),
+### every receiver's messages in one shard, and each shard has its own writer thread,
+### connections, write lock and message ids (see allocate_ids), so nothing is serialized
+### across the shards. The main database keeps the users, upload sessions and the routing table.
+###
+### A receiver's shard is its row in shard_routes, crc32(name) % N if it has none.
+### reshard.py splits or merges the files offline and rewrites the routes.
+
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+
+import database as db
+import cache
+import migrations
+
+SHARDS = int(os.environ.get("FE_SHARDS", 1))
+
+log = logging.getLogger("fe.shards")
+
+# routes only change offline (reshard.py), the TTL bounds staleness anyway
+ROUTE_CACHE_SIZE = 100000
+ROUTE_CACHE_TTL = 300
+route_cache = cache.TTLCache(ROUTE_CACHE_SIZE, ROUTE_CACHE_TTL)
+
+
+def sharded() -> bool:
+    return SHARDS > 1
+
+def path(shard: int, count: int | None = None) -> str:
+    """File of a shard, the main database itself when there is only one"""
+    if (count or SHARDS) == 1:
+        return db.DB_PATH
+    base, ext = os.path.splitext(db.DB_PATH)
+    return f"{base}.shard{shard}{ext or '.db'}"
+
+def paths(count: int | None = None) -> list[str]:
+    """Files holding messages, in shard order"""
+    return [path(shard, count) for shard in range(count or SHARDS)]
+
+def databases() -> list[str]:
+    """Every database file: the main one and the shards"""
+    return [db.DB_PATH] + (paths() if sharded() else [])
+
+def hash_shard(receiver_id: str, count: int) -> int:
+    return zlib.crc32(receiver_id.encode("utf-8")) % count
+
+def shard_of(receiver_id: str) -> int:
+    """The shard holding the messages sent to receiver_id"""
+    if not sharded():
+        return 0
+    shard = route_cache.get(receiver_id)
+    if shard is cache.MISSING:
+        row = db.get_connection().execute(
+            "SELECT shard FROM shard_routes WHERE receiver_id = ?", (receiver_id,)
+        ).fetchone()
+        shard = row[0] if row else hash_shard(receiver_id, SHARDS)
+        route_cache.set(receiver_id, shard)
+    return shard
+
+def path_of(receiver_id: str) -> str:
+    return path(shard_of(receiver_id))
+
+
+## Message ids
+##
+## Ids have to be unique across the shards (read/download look them up by id). Every shard
+## hands out its own: shard s only uses the ids that are s modulo SHARDS, counted by next_id
+## in the shard file's shard_meta, inside the transaction that inserts the rows. A shard's ids
+## grow in its commit order and no lock is shared between shards, mailbox cursors keep a
+## position per shard (parse_cursor). New ids start above the highest one this process handed
+## out on any shard, so ids of different shards stay roughly in the order messages were sent in.
+_highest = 0
+_highest_lock = threading.Lock()
+
+def allocate_ids(shard: int, conn: sqlite3.Connection, count: int) -> range:
+    """count new ids of shard, conn has to be in the write transaction that uses them"""
+    global _highest
+    # the stored counter is always an id of the shard (setup aligns it)
+    stop = conn.execute(
+        "UPDATE shard_meta SET value = MAX(value, ?) + ? WHERE key = 'next_id' RETURNING value",
+        (_aligned(_highest + 1, shard), count * SHARDS)
+    ).fetchone()[0]
+    ids = range(stop - count * SHARDS, stop, SHARDS)
+    with _highest_lock:
+        _highest = max(_highest, ids[-1])
+    return ids
+
+def id_allocator(shard_path: str):
+    """allocate_ids for the writer of shard_path, None for an unsharded database (rowids)"""
+    if not sharded() or shard_path not in paths():
+        return None
+    return functools.partial(allocate_ids, paths().index(shard_path))
+
+def _aligned(value: int, shard: int) -> int:
+    """The smallest id of shard that is >= value"""
+    return value + (shard - value) % SHARDS
+
+
+## Mailbox cursors
+##
+## A sync cursor holds the last id a client has seen on every shard, "12,7,9,4" (a plain id
+## without shards). A cursor of another shard count (e.g. a single id from before a split)
+## continues from its lowest id on every shard: some messages come again, none is missed.
+def parse_cursor(text: str | None) -> list[int]:
+    """Per shard positions of a cursor, ValueError if it is malformed"""
+    ids = [int(part) for part in (text or "0").split(",")]
+    if len(ids) != SHARDS:
+        ids = [min(ids)] * SHARDS
+    return ids
+
+def format_cursor(ids: list[int]) -> str:
+    return ",".join(str(i) for i in ids)
+
+
+## Startup
+def setup(conn: sqlite3.Connection):
+    """
+    Check that the files on disk are split into SHARDS shards, bring every shard's schema
+    up to date and move every shard's id counter past every id in use (ids from before the
+    split or of another shard count don't follow the per shard spaces).
+    conn is a connection to the (already migrated) main database.
+    """
+    stored = get_count(conn)
+    if stored != SHARDS:
+        if stored == 1 and conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is None:
+            set_count(conn, SHARDS)     # nothing stored yet, no need to reshard
+        else:
+            raise RuntimeError(f"{db.DB_PATH} holds {stored} shard(s) but FE_SHARDS is {SHARDS}, "
+                               f"run 'python reshard.py --shards {SHARDS}' first")
+    if not sharded():
+        return
+
+    # reshard.py leaves the highest copied id + 1 in the main database's counter
+    top = conn.execute("SELECT value FROM shard_meta WHERE key = 'next_id'").fetchone()[0] - 1
+    for shard_path in paths():
+        version = migrations.migrate(db.get_connection(shard_path))
+        top = max(top, db.get_connection(shard_path).execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0])
+        log.info("SHARD: %s at schema version %d", shard_path, version)
+    for shard, shard_path in enumerate(paths()):
+        with db.get_connection(shard_path) as shard_conn:
+            next_id = shard_conn.execute("SELECT value FROM shard_meta WHERE key = 'next_id'").fetchone()[0]
+            shard_conn.execute("UPDATE shard_meta SET value = ? WHERE key = 'next_id'",
+                               (_aligned(max(next_id, top + 1), shard),))
+    log.info("SHARD: messages split across %d shards", SHARDS)
+
+def get_count(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT value FROM shard_meta WHERE key = 'shards'").fetchone()[0]
+
+def set_count(conn: sqlite3.Connection, count: int):
+    with conn:
+        conn.execute("UPDATE shard_meta SET value = ? WHERE key = 'shards'", (count,))
@@ -0,0 +1,207 @@
+### Resumable chunked file uploads
+###
+### A client opens an upload session announcing size and SHA-256 of the file,
+### then PUTs raw chunks at increasing offsets. Every chunk is written straight
+### to a partial file and fed into a running hash, the acknowledged offset is
+### persisted so an interrupted upload resumes where it stopped. Finishing the
+### upload checks the hash and moves the file into the blob store.
+
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+import blobstore
+import database as db
+import shared.datatypes as t
+
+CHUNK_SIZE = 1024 * 1024            # bytes per PUT
+MAX_UPLOAD_SIZE = 16 * 1024 ** 3    # refuse announcements above this
+READ_SIZE = 64 * 1024               # copy granularity from the request stream
+
+# running hashes of the uploads this process is receiving. an upload whose hash
+# isn't here (restart, another worker) gets it rebuilt from its partial file
+_hashers: dict[str, "hashlib._Hash"] = {}
+_locks: dict[str, threading.Lock] = {}
+_registry_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    def __init__(self, status: int, message: str, offset: int | None = None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.offset = offset
+
+    def to_dict(self) -> dict:
+        result = {"status": self.status, "message": self.message}
+        if self.offset is not None:
+            result["offset"] = self.offset
+        return result
+
+
+def _partial_path(upload_id: str) -> str:
+    return os.path.join(blobstore.BLOB_DIR, "uploads", upload_id)
+
+def _lock_for(upload_id: str) -> threading.Lock:
+    with _registry_lock:
+        return _locks.setdefault(upload_id, threading.Lock())
+
+def _forget(upload_id: str):
+    with _registry_lock:
+        _hashers.pop(upload_id, None)
+        _locks.pop(upload_id, None)
+
+def _hasher_for(upload: dict):
+    hasher = _hashers.get(upload["id"])
+    if hasher is None:
+        hasher = hashlib.sha256()
+        with open(_partial_path(upload["id"]), "rb") as f:
+            remaining = upload["received"]
+            while remaining:
+                block = f.read(min(READ_SIZE, remaining))
+                if not block:
+                    break
+                hasher.update(block)
+                remaining -= len(block)
+        _hashers[upload["id"]] = hasher
+    return hasher
+
+
+def start(sender_id: str, receiver_ids: list[str], file_name: str, file_type: str, total_size: int, sha256: str) -> dict:
+    """
+    Open a new upload session for one or more receivers and return its state.
+    """
+    if total_size < 0 or total_size > MAX_UPLOAD_SIZE:
+        raise UploadError(413, f"file size must be between 0 and {MAX_UPLOAD_SIZE} bytes")
+    if len(sha256) != 64:
+        raise UploadError(400, "sha256 must be a hex digest")
+
+    upload = {
+        "id": uuid.uuid4().hex,
+        "sender_id": sender_id,
+        "receiver_id": receiver_ids[0],
+        "receiver_ids": json.dumps(receiver_ids),
+        "file_name": file_name,
+        "file_type": file_type,
+        "total_size": total_size,
+        "sha256": sha256.lower(),
+        "created": int(time.time()),
+    }
+
+    path = _partial_path(upload["id"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+    db.create_upload(upload)
+    _hashers[upload["id"]] = hashlib.sha256()
+
+    return {"upload_id": upload["id"], "chunk_size": CHUNK_SIZE, "offset": 0}
+
+def get(upload_id: str, sender_id: str) -> dict:
+    """
+    Look up an upload session owned by sender_id.
+    """
+    upload = db.fetch_upload(upload_id)
+    if upload is None or upload["sender_id"] != sender_id:
+        raise UploadError(404, "unknown upload")
+    return upload
+
+def status(upload_id: str, sender_id: str) -> dict:
+    upload = get(upload_id, sender_id)
+    return {"upload_id": upload_id, "chunk_size": CHUNK_SIZE, "offset": upload["received"], "size": upload["total_size"]}
+
+def write_chunk(upload_id: str, sender_id: str, offset: int, stream) -> int:
+    """
+    Append one chunk read from stream at offset, which has to be the current
+    end of the upload. Returns the new acknowledged offset.
+    """
+    with _lock_for(upload_id):
+        upload = get(upload_id, sender_id)
+        if offset != upload["received"]:
+            raise UploadError(409, "offset doesn't match the uploaded data", upload["received"])
+
+        hasher = _hasher_for(upload)
+        limit = min(CHUNK_SIZE, upload["total_size"] - offset)
+        written = 0
+        with open(_partial_path(upload_id), "r+b") as f:
+            f.seek(offset)
+            f.truncate()
+            try:
+                while written <= limit:
+                    block = stream.read(min(READ_SIZE, limit + 1 - written))
+                    if not block:
+                        break
+                    written += len(block)
+                    if written > limit:
+                        break
+                    f.write(block)
+                    hasher.update(block)
+            except ValueError as e:
+                # a compressed chunk that doesn't decode, the hash saw part of it
+                _hashers.pop(upload_id, None)
+                raise UploadError(400, f"chunk can't be decoded: {e}", upload["received"])
+            f.flush()
+            os.fsync(f.fileno())
+
+        if written > limit:
+            # the hash already saw the valid part, rebuild it from disk next time
+            _hashers.pop(upload_id, None)
+            raise UploadError(413, f"chunk exceeds {limit} bytes", upload["received"])
+
+        received = offset + written
+        db.update_upload_progress(upload_id, received)
+        return received
+
+def expire(created_before: int) -> int:
+    """
+    Drop upload sessions opened before created_before together with their partial data,
+    unless data arrived for them since. Returns how many were removed.
+    """
+    expired = 0
+    for upload_id in db.fetch_uploads_created_before(created_before):
+        with _lock_for(upload_id):
+            path = _partial_path(upload_id)
+            try:
+                if os.path.getmtime(path) >= created_before:
+                    continue    # still being uploaded
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            db.delete_upload(upload_id)
+        _forget(upload_id)
+        expired += 1
+    return expired
+
+def finish(upload_id: str, sender_id: str) -> dict[str, int | None]:
+    """
+    Verify a complete upload against its announced hash, move it into the blob
+    store and save one message per receiver.
+    Returns {receiver_id: message id, or None if the receiver doesn't exist}.
+    """
+    with _lock_for(upload_id):
+        upload = get(upload_id, sender_id)
+        if upload["received"] != upload["total_size"]:
+            raise UploadError(409, "upload is incomplete", upload["received"])
+
+        digest = _hasher_for(upload).hexdigest()
+        if digest != upload["sha256"]:
+            # corrupted, start over
+            os.unlink(_partial_path(upload_id))
+            db.delete_upload(upload_id)
+            _forget(upload_id)
+            raise UploadError(422, "sha256 of the uploaded data doesn't match")
+
+        coding = blobstore.coding_for(upload["file_name"], upload["file_type"], upload["total_size"])
+        codec = blobstore.put_file(_partial_path(upload_id), digest, coding)
+        timestamp = int(time.time())
+        receiver_ids = json.loads(upload["receiver_ids"]) if upload["receiver_ids"] else [upload["receiver_id"]]
+        messages = [
+            t.Message(0, upload["sender_id"], receiver_id, timestamp, upload["file_name"], upload["file_type"], None, False)
+            for receiver_id in receiver_ids
+        ]
+        results = db.save_messages(messages, blob_ref=(digest, upload["total_size"], codec))
+        db.delete_upload(upload_id)
+    _forget(upload_id)
+    return results
@@ -0,0 +1,179 @@
+### Single writer thread with group commit
+###
+### Callers hand their INSERTs to one writer thread and get a Future back.
+### The writer drains the queue into batches (up to MAX_BATCH statements or
+### MAX_DELAY seconds after the first one) and commits each batch as one
+### transaction, so many messages share one WAL commit instead of each taking
+### the write lock and syncing on its own. A Future only resolves after the
+### commit of its batch, and commits run with synchronous=FULL, so an
+### acknowledged message survives a power loss as well.
+###
+### There is one writer per database file, with sharded storage (shards.py)
+### one per shard, each taking the ids of new messages from its own shard's
+### counter (shards.allocate_ids).
+
+import itertools
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import database as db
+import shards
+
+MAX_BATCH = 256         # units per transaction
+SYNCHRONOUS = "FULL"    # the writer fsyncs every commit, affordable since a commit covers a whole batch
+MAX_DELAY = 0.0         # extra seconds to wait for more work after the first unit of a batch.
+                        # 0 commits whatever queued up during the previous commit right away
+
+# first parameter of an INSERT whose id the writer fills in: an id of the shard
+# (shards.allocate_ids), NULL (the next rowid) on an unsharded database
+NEW_ID = object()
+
+
+class _Unit:
+    """Statements that succeed or fail together, resolved with their lastrowids."""
+    __slots__ = ("statements", "future", "single")
+
+    def __init__(self, statements, single: bool = False):
+        self.statements = statements
+        self.future = Future()
+        self.single = single    # resolve with the one lastrowid instead of a list
+
+    def new_ids(self) -> int:
+        return sum(1 for _, params in self.statements if params and params[0] is NEW_ID)
+
+    def apply(self, conn: sqlite3.Connection, new_ids):
+        ids = [
+            conn.execute(sql, (next(new_ids), *params[1:]) if params and params[0] is NEW_ID else params).lastrowid
+            for sql, params in self.statements
+        ]
+        return ids[0] if self.single else ids
+
+
+class WriteQueue:
+    def __init__(self, path: str, max_batch: int = MAX_BATCH, max_delay: float = MAX_DELAY, allocate_ids=None):
+        self.path = path
+        self.allocate_ids = allocate_ids    # (conn, count) -> ids, NEW_ID is NULL without it
+        self.pid = os.getpid()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: queue.Queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="fe-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, sql: str, params=()) -> Future:
+        """
+        Queue one statement. The future resolves to its lastrowid after commit.
+        """
+        return self._submit(_Unit([(sql, params)], single=True))
+
+    def submit_many(self, statements: list[tuple[str, tuple]]) -> Future:
+        """
+        Queue statements that are applied atomically (all or none).
+        The future resolves to the list of their lastrowids after commit.
+        """
+        return self._submit(_Unit(statements))
+
+    def _submit(self, unit: _Unit) -> Future:
+        if self._closed:
+            raise RuntimeError("writer is closed")
+        self._queue.put(unit)
+        return unit.future
+
+    def close(self):
+        """
+        Commit everything queued so far and stop the writer thread.
+        """
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        conn = db.open_connection(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute(f"PRAGMA synchronous = {SYNCHRONOUS}")
+        try:
+            while True:
+                first = self._queue.get()
+                if first is None:
+                    return
+                batch = [first]
+                stop = self._collect(batch)
+                self._commit(conn, batch)
+                if stop:
+                    return
+        finally:
+            conn.close()
+
+    def _collect(self, batch: list) -> bool:
+        """Add whatever arrives within the batch window, True if close() was requested."""
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                unit = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                return False
+            if unit is None:
+                return True
+            batch.append(unit)
+        return False
+
+    def _commit(self, conn: sqlite3.Connection, batch: list):
+        try:
+            results = self._transaction(conn, batch)
+        except Exception as e:
+            # anything else (a bad parameter, ...) fails its units too instead of killing
+            # the writer thread, which would leave every future waiting forever
+            if len(batch) == 1:
+                batch[0].future.set_exception(e)
+                return
+            # one bad unit (e.g. unknown receiver) mustn't fail the others: redo them one by one
+            for unit in batch:
+                self._commit(conn, [unit])
+            return
+
+        for unit, result in zip(batch, results):
+            unit.future.set_result(result)
+
+    def _transaction(self, conn: sqlite3.Connection, batch: list) -> list:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            count = sum(unit.new_ids() for unit in batch) if self.allocate_ids is not None else 0
+            # the shard's id counter is part of this transaction, so its ids commit in order
+            new_ids = iter(self.allocate_ids(conn, count)) if count else itertools.repeat(None)
+            results = [unit.apply(conn, new_ids) for unit in batch]
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return results
+
+
+_writers: dict[str, WriteQueue] = {}
+_writer_lock = threading.Lock()
+
+def get_writer(path: str | None = None) -> WriteQueue:
+    """
+    The writer of this process for path (default: the current database.DB_PATH),
+    started on first use (and again after a fork).
+    Writers of shard files take their message ids from shards.allocate_ids.
+    """
+    path = path or db.DB_PATH
+    with _writer_lock:
+        writer = _writers.get(path)
+        if writer is None or writer.pid != os.getpid():
+            writer = _writers[path] = WriteQueue(path, allocate_ids=shards.id_allocator(path))
+        return writer
+
+def close_writer():
+    """Commit what is queued and stop every writer of this process"""
+    with _writer_lock:
+        for writer in _writers.values():
+            if writer.pid == os.getpid():
+                writer.close()
+        _writers.clear()
@@ -0,0 +1,141 @@
+### Wire codecs for the shared datatypes
+###
+### JSON always works (orjson when installed, the stdlib otherwise). msgpack is
+### a compact binary alternative when the msgpack package is installed, it
+### carries file contents as raw bytes instead of base64. Client and server
+### pick one through the Accept / Content-Type headers.
+
+import codecs
+import json
+from typing import Iterable, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    mimetype = "application/json"
+    binary = False  # bytes have to be base64 encoded
+
+    def dumps(self, obj) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj).encode("utf-8")
+
+    def loads(self, data: bytes | str):
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+    def dumps_str(self, obj) -> str:
+        return self.dumps(obj).decode("utf-8")
+
+    def dumps_iter(self, batches: Iterable[list]) -> Iterator[bytes]:
+        """A JSON array written piece by piece, one piece per batch of objects"""
+        yield b"["
+        first = True
+        for batch in batches:
+            if not batch:
+                continue
+            piece = b",".join(self.dumps(obj) for obj in batch)
+            yield piece if first else b"," + piece
+            first = False
+        yield b"]"
+
+
+class MsgpackCodec:
+    mimetype = "application/x-msgpack"
+    binary = True   # bytes are sent as they are
+
+    def dumps(self, obj) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data: bytes):
+        return msgpack.unpackb(data, raw=False)
+
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec() if msgpack is not None else None
+
+# available codecs by mimetype, in order of preference
+CODECS = {codec.mimetype: codec for codec in (MSGPACK, JSON) if codec is not None}
+
+
+def for_content_type(content_type: str | None):
+    """
+    Codec for a Content-Type header, None if it isn't supported.
+    A missing Content-Type is treated as JSON.
+    """
+    if not content_type:
+        return JSON
+    return CODECS.get(content_type.split(";", 1)[0].strip().lower())
+
+def negotiate(accept: str | None):
+    """
+    Best available codec for an Accept header, JSON if nothing better is accepted.
+    """
+    if not accept:
+        return JSON
+    best, best_q = JSON, 0.0
+    for part in accept.split(","):
+        mimetype, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codec = CODECS.get(mimetype.strip().lower())
+        # on a tie the codec listed first in CODECS (the more compact one) wins
+        if codec is not None and (q > best_q or (q == best_q and codec is MSGPACK)):
+            best, best_q = codec, q
+    return best
+
+def accept_header() -> str:
+    """
+    Accept header for clients: the binary codec if available, JSON as fallback.
+    """
+    if MSGPACK is not None:
+        return f"{MSGPACK.mimetype}, {JSON.mimetype};q=0.9"
+    return JSON.mimetype
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator:
+    """
+    Parse a JSON array of objects incrementally from byte chunks (e.g. a streamed response),
+    yielding every element as soon as it is complete.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buf, pos, started = "", 0, False
+    for chunk in chunks:
+        buf = buf[pos:] + text.decode(chunk)
+        pos = 0
+        while True:
+            # skip whitespace and separators up to the next element
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break   # element not complete yet, wait for more data
+            yield obj
+    raise ValueError("JSON array ended early")
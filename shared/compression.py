@@ -0,0 +1,262 @@
+### Content codings for bodies on the wire and blobs at rest
+###
+### gzip always works (zlib). zstd is used when Python's compression.zstd
+### (3.14+) or the backports.zstd package is available, the same module
+### urllib3 decodes zstd responses with. Client and server pick a coding
+### through the Accept-Encoding / Content-Encoding headers.
+
+import mimetypes
+import zlib
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        from backports import zstd
+    except ImportError:
+        zstd = None
+
+MIN_SIZE = 1024                     # smaller bodies aren't worth the CPU time
+MAX_DECOMPRESSED = 256 * 1024 ** 2  # refuse to inflate a request body beyond this
+READ_SIZE = 64 * 1024
+
+# MIME types whose data is already compressed, compressing it again only costs time
+COMPRESSED_TYPES = {
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-bzip2",
+    "application/x-xz", "application/zstd", "application/x-7z-compressed",
+    "application/x-rar-compressed", "application/vnd.rar", "application/pdf",
+    "application/epub+zip", "application/java-archive",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "application/vnd.oasis.opendocument.text", "application/vnd.oasis.opendocument.spreadsheet",
+}
+COMPRESSED_PREFIXES = ("image/", "video/", "audio/", "font/woff")
+# exceptions to the prefixes above: uncompressed media formats
+UNCOMPRESSED_MEDIA = {"image/svg+xml", "image/bmp", "image/x-ms-bmp", "image/tiff", "audio/wav", "audio/x-wav"}
+
+
+class _ZlibDecoder:
+    """zlib decompressobj with the needs_input / eof interface of zstd.ZstdDecompressor"""
+
+    def __init__(self, wbits: int):
+        self.obj = zlib.decompressobj(wbits)
+
+    @property
+    def needs_input(self) -> bool:
+        return not self.obj.unconsumed_tail
+
+    @property
+    def eof(self) -> bool:
+        return self.obj.eof
+
+    def decompress(self, data: bytes, max_length: int = -1) -> bytes:
+        data = self.obj.unconsumed_tail + data
+        try:
+            return self.obj.decompress(data, max(max_length, 0))
+        except zlib.error as e:
+            raise ValueError(str(e)) from e
+
+
+class _ZstdDecoder:
+    """ZstdDecompressor raising ValueError on corrupt data, like _ZlibDecoder"""
+
+    def __init__(self):
+        self.obj = zstd.ZstdDecompressor()
+
+    @property
+    def needs_input(self) -> bool:
+        return self.obj.needs_input
+
+    @property
+    def eof(self) -> bool:
+        return self.obj.eof
+
+    def decompress(self, data: bytes, max_length: int = -1) -> bytes:
+        try:
+            return self.obj.decompress(data, max_length)
+        except zstd.ZstdError as e:
+            raise ValueError(str(e)) from e
+
+
+class _ZlibEncoder:
+    def __init__(self, level: int, wbits: int):
+        self.obj = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.obj.compress(data)
+
+    def sync(self) -> bytes:
+        """Everything compressed so far, decodable by the receiver right away"""
+        return self.obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.obj.flush(zlib.Z_FINISH)
+
+
+class _ZstdEncoder:
+    def __init__(self, level: int):
+        self.obj = zstd.ZstdCompressor(level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.obj.compress(data)
+
+    def sync(self) -> bytes:
+        return self.obj.flush(zstd.ZstdCompressor.FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self.obj.flush(zstd.ZstdCompressor.FLUSH_FRAME)
+
+
+class Coding:
+    name = None
+    suffix = None   # file name suffix of blobs stored with this coding
+
+    def encoder(self):
+        raise NotImplementedError
+
+    def decoder(self):
+        raise NotImplementedError
+
+    def compress(self, data: bytes) -> bytes:
+        encoder = self.encoder()
+        return encoder.compress(data) + encoder.finish()
+
+    def decompress(self, data: bytes, limit: int = MAX_DECOMPRESSED) -> bytes:
+        """Whole body, ValueError if it is corrupt, truncated or inflates beyond limit"""
+        decoder = self.decoder()
+        out = decoder.decompress(data, limit + 1)
+        if len(out) > limit:
+            raise ValueError(f"{self.name} body inflates beyond {limit} bytes")
+        if not decoder.eof:
+            raise ValueError(f"{self.name} body is truncated")
+        return out
+
+    def compress_stream(self, chunks):
+        """Compress an iterable of chunks, every chunk is flushed so the receiver can decode it right away"""
+        encoder = self.encoder()
+        for chunk in chunks:
+            piece = encoder.compress(chunk) + encoder.sync()
+            if piece:
+                yield piece
+        yield encoder.finish()
+
+
+class GzipCoding(Coding):
+    name = "gzip"
+    suffix = ".gz"
+    level = 6
+
+    def encoder(self):
+        return _ZlibEncoder(self.level, 31)     # 31: gzip header and trailer
+
+    def decoder(self):
+        return _ZlibDecoder(31)
+
+
+class ZstdCoding(Coding):
+    name = "zstd"
+    suffix = ".zst"
+    level = 3
+
+    def encoder(self):
+        return _ZstdEncoder(self.level)
+
+    def decoder(self):
+        return _ZstdDecoder()
+
+
+class DecodingReader:
+    """
+    File-like reader that decompresses another file-like object while it is read,
+    for compressed request bodies and compressed blobs.
+    """
+
+    def __init__(self, raw, coding: Coding):
+        self.raw = raw
+        self.decoder = coding.decoder()
+
+    def read(self, n: int = -1) -> bytes:
+        out = bytearray()
+        while (n < 0 or len(out) < n) and not self.decoder.eof:
+            data = b""
+            if self.decoder.needs_input:
+                data = self.raw.read(READ_SIZE)
+                if not data:
+                    raise ValueError("compressed data ends early")
+            out += self.decoder.decompress(data, READ_SIZE if n < 0 else n - len(out))
+        return bytes(out)
+
+    def close(self):
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+GZIP = GzipCoding()
+ZSTD = ZstdCoding() if zstd is not None else None
+
+# available codings by name, in order of preference
+CODINGS = {coding.name: coding for coding in (ZSTD, GZIP) if coding is not None}
+PREFERRED = next(iter(CODINGS.values()))
+
+
+def by_name(name: str | None) -> Coding | None:
+    """Coding for a Content-Encoding value, None for identity or unknown codings"""
+    if not name:
+        return None
+    return CODINGS.get(name.strip().lower())
+
+def accepted(accept_encoding: str | None) -> dict[str, float]:
+    """{coding: q} of an Accept-Encoding header"""
+    result = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            result[name.strip().lower()] = q
+    return result
+
+def negotiate(accept_encoding: str | None) -> Coding | None:
+    """Best available coding the client accepts, None if it accepts none of them"""
+    weights = accepted(accept_encoding)
+    best, best_q = None, 0.0
+    for name, coding in CODINGS.items():
+        q = weights.get(name, weights.get("*", 0.0))
+        # on a tie the coding listed first in CODINGS wins
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+def accepts(accept_encoding: str | None, name: str) -> bool:
+    weights = accepted(accept_encoding)
+    return weights.get(name, weights.get("*", 0.0)) > 0
+
+def is_compressed_type(mimetype: str | None) -> bool:
+    if not mimetype:
+        return False
+    mimetype = mimetype.split(";", 1)[0].strip().lower()
+    if mimetype in UNCOMPRESSED_MEDIA:
+        return False
+    return mimetype in COMPRESSED_TYPES or mimetype.startswith(COMPRESSED_PREFIXES)
+
+def worth_compressing(file_name: str | None = None, mimetype: str | None = None) -> bool:
+    """
+    False for data that is already compressed, judged by its MIME type and the type
+    and encoding mimetypes.guess_type derives from file_name (.zip, .jpg, .pdf, .tar.gz, ...)
+    """
+    guessed, encoding = mimetypes.guess_type(file_name) if file_name else (None, None)
+    if encoding is not None:
+        return False
+    return not (is_compressed_type(mimetype) or is_compressed_type(guessed))
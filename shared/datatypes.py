@@ -1,8 +1,13 @@
 import base64
+import itertools
 import json
-from typing import List, Optional
+from typing import Iterable, Optional
+
+from shared import codec as c
 
 class User:
+    __slots__ = ("verified", "name", "access_key", "op")
+
     def __init__(self, verified: bool, name: str, access_key: str, op: bool):
         self.verified = verified
         self.name = name
@@ -34,8 +39,13 @@ class User:
 
 
 class Message:
+    __slots__ = ("message_id", "sender_id", "receiver_id", "timestamp",
+                 "file_name", "file_type", "file_contents", "queue_deletion",
+                 "content_length", "content_kind")
+
     def __init__(self, message_id, sender_id, receiver_id, timestamp,
-                 file_name, file_type, file_contents, queue_deletion):
+                 file_name, file_type, file_contents, queue_deletion,
+                 content_length=None, content_kind=None):
         self.message_id = message_id
         self.sender_id = sender_id
         self.receiver_id = receiver_id
@@ -44,8 +54,11 @@ class Message:
         self.file_type = file_type
         self.file_contents = file_contents
         self.queue_deletion = queue_deletion
+        self.content_length = content_length    # bytes of the text or file, None if unknown
+        self.content_kind = content_kind        # "text" or "file", None if unknown
 
-    def to_dict(self) -> dict:
+    def to_dict(self, raw_bytes: bool = False) -> dict:
+        """raw_bytes keeps file contents as bytes (for binary codecs) instead of base64"""
         return {
             "id": self.message_id,
             "sender_id": self.sender_id,
@@ -53,29 +66,33 @@ class Message:
             "timestamp": self.timestamp,
             "file_name": self.file_name,
             "file_type": self.file_type,
-            "file_contents": (
-                base64.b64encode(self.file_contents).decode("utf-8")
-                if isinstance(self.file_contents, (bytes, bytearray))
-                else self.file_contents
-            ),
-            "queue_deletion": self.queue_deletion
+            "file_contents": _contents_to_dict(self.file_contents, raw_bytes),
+            "queue_deletion": self.queue_deletion,
+            "content_length": self.content_length,
+            "content_kind": self.content_kind
         }
 
     def serialize(self) -> str:
         """Convert to JSON string"""
-        return json.dumps(self.to_dict())
+        return c.JSON.dumps_str(self.to_dict())
+
+    def encode(self, codec=c.JSON) -> bytes:
+        """Encode with a wire codec"""
+        return codec.dumps(self.to_dict(raw_bytes=codec.binary))
 
     @staticmethod
     def deserialize(data: str) -> "Message":
         """Create Message from JSON string"""
-        obj = json.loads(data)
-        file_contents = obj["file_contents"]
-        if isinstance(file_contents, str):
-            try:
-                # try decode base64 back to bytes
-                file_contents = base64.b64decode(file_contents.encode("utf-8"))
-            except Exception:
-                pass
+        return Message.from_dict(c.JSON.loads(data))
+
+    @staticmethod
+    def decode(data: bytes, codec=c.JSON) -> "Message":
+        """Create Message from data encoded with a wire codec"""
+        return Message.from_dict(codec.loads(data))
+
+    @staticmethod
+    def from_dict(obj: dict) -> "Message":
+        """Create Message from an already parsed dict"""
         return Message(
             message_id=obj["id"],
             sender_id=obj["sender_id"],
@@ -83,27 +100,197 @@ class Message:
             timestamp=obj["timestamp"],
             file_name=obj["file_name"],
             file_type=obj["file_type"],
-            file_contents=file_contents,
-            queue_deletion=obj["queue_deletion"]
+            file_contents=_contents_from_dict(obj["file_contents"]),
+            queue_deletion=obj["queue_deletion"],
+            content_length=obj.get("content_length"),
+            content_kind=obj.get("content_kind")
         )
 
 
+def _contents_to_dict(file_contents, raw_bytes: bool):
+    if isinstance(file_contents, (bytes, bytearray)) and not raw_bytes:
+        return base64.b64encode(file_contents).decode("utf-8")
+    return file_contents
+
+def _contents_from_dict(file_contents):
+    if isinstance(file_contents, str):
+        try:
+            # try decode base64 back to bytes
+            return base64.b64decode(file_contents.encode("utf-8"))
+        except Exception:
+            pass
+    return file_contents
+
+
 class Messages:
-    """Container for multiple Message objects"""
+    """
+    Container for multiple messages, stored column by column.
+    A Message object is only built when an item is accessed, a header-only list (no file_contents)
+    doesn't keep a contents column at all
+    """
+    __slots__ = ("ids", "sender_ids", "receiver_ids", "timestamps",
+                 "file_names", "file_types", "file_contents", "queue_deletions",
+                 "content_lengths", "content_kinds")
+
+    def __init__(self, messages: Optional[Iterable[Message]] = None):
+        self.ids = []
+        self.sender_ids = []
+        self.receiver_ids = []
+        self.timestamps = []
+        self.file_names = []
+        self.file_types = []
+        self.file_contents = None   # list once any message has contents
+        self.queue_deletions = []
+        self.content_lengths = []
+        self.content_kinds = []
+        for m in messages or ():
+            self.append(m)
+
+    def append(self, m: Message):
+        self._append(m.message_id, m.sender_id, m.receiver_id, m.timestamp,
+                     m.file_name, m.file_type, m.file_contents, m.queue_deletion,
+                     m.content_length, m.content_kind)
+
+    def _append(self, message_id, sender_id, receiver_id, timestamp,
+                file_name, file_type, file_contents, queue_deletion,
+                content_length=None, content_kind=None):
+        if file_contents is not None and self.file_contents is None:
+            self.file_contents = [None] * len(self.ids)
+        self.ids.append(message_id)
+        self.sender_ids.append(sender_id)
+        self.receiver_ids.append(receiver_id)
+        self.timestamps.append(timestamp)
+        self.file_names.append(file_name)
+        self.file_types.append(file_type)
+        if self.file_contents is not None:
+            self.file_contents.append(file_contents)
+        self.queue_deletions.append(queue_deletion)
+        self.content_lengths.append(content_length)
+        self.content_kinds.append(content_kind)
 
-    def __init__(self, messages: Optional[List[Message]] = None):
-        self.messages = messages or []
+    def __len__(self) -> int:
+        return len(self.ids)
 
-    def to_dict(self) -> list[dict]:
-        return [m.to_dict() for m in self.messages]
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            part = Messages()
+            for name in Messages.__slots__:
+                column = getattr(self, name)
+                setattr(part, name, column[index] if column is not None else None)
+            return part
+        return Message(
+            message_id=self.ids[index],
+            sender_id=self.sender_ids[index],
+            receiver_id=self.receiver_ids[index],
+            timestamp=self.timestamps[index],
+            file_name=self.file_names[index],
+            file_type=self.file_types[index],
+            file_contents=self.file_contents[index] if self.file_contents is not None else None,
+            queue_deletion=self.queue_deletions[index],
+            content_length=self.content_lengths[index],
+            content_kind=self.content_kinds[index]
+        )
+
+    def __iter__(self):
+        for i in range(len(self.ids)):
+            yield self[i]
+
+    @property
+    def messages(self) -> list[Message]:
+        """The messages as a list of Message objects (built on every access)"""
+        return list(self)
+
+    def _contents(self):
+        if self.file_contents is None:
+            return itertools.repeat(None)
+        return self.file_contents
+
+    def to_dict(self, raw_bytes: bool = False) -> list[dict]:
+        return [
+            {
+                "id": message_id,
+                "sender_id": sender_id,
+                "receiver_id": receiver_id,
+                "timestamp": timestamp,
+                "file_name": file_name,
+                "file_type": file_type,
+                "file_contents": _contents_to_dict(file_contents, raw_bytes),
+                "queue_deletion": queue_deletion,
+                "content_length": content_length,
+                "content_kind": content_kind
+            }
+            for (message_id, sender_id, receiver_id, timestamp, file_name, file_type, file_contents, queue_deletion,
+                 content_length, content_kind)
+            in zip(self.ids, self.sender_ids, self.receiver_ids, self.timestamps,
+                   self.file_names, self.file_types, self._contents(), self.queue_deletions,
+                   self.content_lengths, self.content_kinds)
+        ]
 
     def serialize(self) -> str:
         """Convert to JSON string"""
-        return json.dumps(self.to_dict())
+        return c.JSON.dumps_str(self.to_dict())
+
+    def encode(self, codec=c.JSON) -> bytes:
+        """Encode with a wire codec"""
+        return codec.dumps(self.to_dict(raw_bytes=codec.binary))
 
     @staticmethod
     def deserialize(data: str) -> "Messages":
         """Create Messages container from JSON string"""
-        arr = json.loads(data)
-        messages = [Message.deserialize(json.dumps(m)) for m in arr]
-        return Messages(messages)
+        return Messages.from_list(c.JSON.loads(data))
+
+    @staticmethod
+    def decode(data: bytes, codec=c.JSON) -> "Messages":
+        """Create Messages container from data encoded with a wire codec"""
+        return Messages.from_list(codec.loads(data))
+
+    @staticmethod
+    def from_list(arr: list[dict]) -> "Messages":
+        """Create Messages container from already parsed dicts, each one is parsed only once"""
+        messages = Messages()
+        for obj in arr:
+            messages._append(obj["id"], obj["sender_id"], obj["receiver_id"], obj["timestamp"],
+                             obj["file_name"], obj["file_type"], _contents_from_dict(obj["file_contents"]),
+                             obj["queue_deletion"], obj.get("content_length"), obj.get("content_kind"))
+        return messages
+
+    @staticmethod
+    def from_rows(rows, strings: Optional[dict] = None) -> "Messages":
+        """
+        Create Messages container from
+        (id, sender_id, receiver_id, timestamp, file_name, file_type, queue_deletion, content_length, content_kind)
+        rows, file_contents are None.
+        User names and file types repeat a lot, every distinct one is kept only once
+        (pass the same strings dict to share them between containers)
+        """
+        messages = Messages()
+        messages._extend_rows(rows, {} if strings is None else strings)
+        return messages
+
+    @staticmethod
+    def from_cursor(cursor, batch_size: int = 1000) -> "Messages":
+        """
+        Create Messages container from a cursor over rows like from_rows.
+        Rows are read in batches and dropped once copied into the columns
+        """
+        messages = Messages()
+        strings = {}
+        while rows := cursor.fetchmany(batch_size):
+            messages._extend_rows(rows, strings)
+        return messages
+
+    def _extend_rows(self, rows, strings: dict):
+        share = strings.setdefault
+        ids, sender_ids, receiver_ids = self.ids, self.sender_ids, self.receiver_ids
+        timestamps, file_names, file_types = self.timestamps, self.file_names, self.file_types
+        queue_deletions, content_lengths, content_kinds = self.queue_deletions, self.content_lengths, self.content_kinds
+        for message_id, sender_id, receiver_id, timestamp, file_name, file_type, queue_deletion, content_length, content_kind in rows:
+            ids.append(message_id)
+            sender_ids.append(share(sender_id, sender_id))
+            receiver_ids.append(share(receiver_id, receiver_id))
+            timestamps.append(timestamp)
+            file_names.append(file_name)
+            file_types.append(share(file_type, file_type))
+            queue_deletions.append(queue_deletion)
+            content_lengths.append(content_length)
+            content_kinds.append(share(content_kind, content_kind))
@@ -21,3 +21,13 @@ def verify_signature(sender_id: str, key: str, secret: str, signature: str) -> b
     """
     expected_sig = sign_message(sender_id, key, secret)
     return hmac.compare_digest(expected_sig, signature)
+
+## signature key for starting a chunked upload. it covers the SHA-256 of the
+## whole file, the server only accepts the upload if the received bytes match it
+def upload_key(file_name: str, file_size: int, sha256: str) -> str:
+    return f"{file_name}:{file_size}:{sha256}"
+
+## signature key for reading several messages at once (/read_many). it covers
+## the requested ids, "UNRD" asks for the unread messages instead
+def read_many_key(message_ids: list[int]) -> str:
+    return "READ:" + ",".join(str(message_id) for message_id in message_ids)